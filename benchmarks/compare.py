@@ -0,0 +1,49 @@
+"""
+Compares two load_test.py results, route by route.
+
+    $ python benchmarks/compare.py before.json after.json --threshold 10
+
+Prints the p50/p95/p99 and rps change of every route and exits with status 1
+when a p95 got worse by more than --threshold percent.
+"""
+import sys
+import json
+import argparse
+
+def change(before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0, help="p95 regression in percent that fails the comparison")
+    args = parser.parse_args()
+
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print("{} -> {}".format((before['git']['commit'] or '?')[:10], (after['git']['commit'] or '?')[:10]))
+
+    regressions = []
+    before_sizes = {size['size']: size for size in before['sizes']}
+    for size in after['sizes']:
+        old = before_sizes.get(size['size'])
+        if old is None:
+            continue
+        print("\nsize {}  peak RSS {} -> {} MB".format(size['size'], old['peak_rss_mb'], size['peak_rss_mb']))
+        print("{:<26}{:>18}{:>18}{:>18}{:>18}".format('route', 'p50 ms', 'p95 ms', 'p99 ms', 'rps'))
+        for name, result in size['routes'].items():
+            previous = old['routes'].get(name)
+            if previous is None:
+                continue
+            cells = ["{:>8} {:>+8.1f}%".format(result[key], change(previous[key], result[key])) for key in ('p50_ms', 'p95_ms', 'p99_ms', 'rps')]
+            print("{:<26}{}".format(name, ''.join(cells)))
+            if change(previous['p95_ms'], result['p95_ms']) > args.threshold:
+                regressions.append("{} at size {}".format(name, size['size']))
+
+    if regressions:
+        print("\np95 regressions over {}%: {}".format(args.threshold, ", ".join(regressions)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Favorites lookup latency before and after the indexes added in migration
+8c87630db338, on a seeded SQLite database.
+
+    $ python benchmarks/favorites_lookup.py --favorites 1000000 --users 10000
+
+Prints a JSON document with the latency percentiles of both runs.
+"""
+import os
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+
+SCHEMA = """
+CREATE TABLE user (id INTEGER PRIMARY KEY, name VARCHAR(120), email VARCHAR(120) NOT NULL UNIQUE, password VARCHAR(80) NOT NULL, is_active BOOLEAN NOT NULL);
+CREATE TABLE planet (id INTEGER PRIMARY KEY, name VARCHAR(250) NOT NULL, climate VARCHAR(250), population INTEGER);
+CREATE TABLE character (id INTEGER PRIMARY KEY, name VARCHAR(250), species VARCHAR(250), gender VARCHAR(250));
+CREATE TABLE vehicle_starship (id INTEGER PRIMARY KEY, name VARCHAR(20) UNIQUE);
+CREATE TABLE favorite_planets (id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES user(id), planet_id INTEGER REFERENCES planet(id));
+CREATE TABLE favorite_characters (id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES user(id), character_id INTEGER REFERENCES character(id));
+CREATE TABLE favorite_vehicles_starships (id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES user(id), vehicle_starship_id INTEGER REFERENCES vehicle_starship(id));
+"""
+
+# same indexes as migrations/versions/8c87630db338_.py
+INDEXES = """
+CREATE UNIQUE INDEX ix_favorite_planets_user_id_planet_id ON favorite_planets (user_id, planet_id);
+CREATE INDEX ix_favorite_planets_planet_id ON favorite_planets (planet_id);
+CREATE UNIQUE INDEX ix_favorite_characters_user_id_character_id ON favorite_characters (user_id, character_id);
+CREATE INDEX ix_favorite_characters_character_id ON favorite_characters (character_id);
+CREATE UNIQUE INDEX ix_favorite_vehicles_starships_user_id_vehicle_starship_id ON favorite_vehicles_starships (user_id, vehicle_starship_id);
+CREATE INDEX ix_favorite_vehicles_starships_vehicle_starship_id ON favorite_vehicles_starships (vehicle_starship_id);
+CREATE INDEX ix_planet_name ON planet (name);
+CREATE INDEX ix_character_name ON character (name);
+CREATE INDEX ix_character_species ON character (species);
+ANALYZE;
+"""
+
+# the shape of the favorites lookup when those indexes were added
+LOOKUP = """
+SELECT * FROM (
+    SELECT 'planet' AS kind, f.id AS favorite_id, f.user_id, p.id AS target_id, p.name, p.climate AS attr_1, CAST(p.population AS VARCHAR) AS attr_2
+    FROM favorite_planets f JOIN planet p ON f.planet_id = p.id WHERE f.user_id IN ({ids})
+    UNION ALL
+    SELECT 'character', f.id, f.user_id, c.id, c.name, c.species, c.gender
+    FROM favorite_characters f JOIN character c ON f.character_id = c.id WHERE f.user_id IN ({ids})
+    UNION ALL
+    SELECT 'vehicle_starship', f.id, f.user_id, v.id, v.name, NULL, NULL
+    FROM favorite_vehicles_starships f JOIN vehicle_starship v ON f.vehicle_starship_id = v.id WHERE f.user_id IN ({ids})
+) ORDER BY user_id, kind, favorite_id LIMIT 101
+"""
+
+def seed(connection, users, targets, favorites):
+    connection.executescript(SCHEMA)
+    connection.executemany("INSERT INTO user (id, name, email, password, is_active) VALUES (?, ?, ?, ?, 1)",
+                           ((i, "user {}".format(i), "user{}@example.com".format(i), "x") for i in range(1, users + 1)))
+    connection.executemany("INSERT INTO planet (id, name, climate, population) VALUES (?, ?, 'temperate', ?)",
+                           ((i, "planet {}".format(i), i * 1000) for i in range(1, targets + 1)))
+    connection.executemany("INSERT INTO character (id, name, species, gender) VALUES (?, ?, 'human', 'n/a')",
+                           ((i, "character {}".format(i)) for i in range(1, targets + 1)))
+    connection.executemany("INSERT INTO vehicle_starship (id, name) VALUES (?, ?)",
+                           ((i, "ship {}".format(i)) for i in range(1, targets + 1)))
+    for table, column in (('favorite_planets', 'planet_id'), ('favorite_characters', 'character_id'), ('favorite_vehicles_starships', 'vehicle_starship_id')):
+        # (user, target) pairs are unique: for a given user the targets are consecutive
+        connection.executemany(
+            "INSERT INTO {} (user_id, {}) VALUES (?, ?)".format(table, column),
+            ((i % users + 1, (i // users + (i % users) * 7) % targets + 1) for i in range(favorites))
+        )
+    connection.commit()
+
+def measure(connection, users, lookups, batch):
+    rng = random.Random(42)
+    timings = []
+    for _ in range(lookups):
+        user_ids = [rng.randint(1, users) for _ in range(batch)]
+        query = LOOKUP.format(ids=",".join("?" * batch))
+        start = time.perf_counter()
+        connection.execute(query, user_ids * 3).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "lookups": lookups,
+        "p50_ms": round(timings[len(timings) // 2], 3),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 3),
+        "max_ms": round(timings[-1], 3),
+        "mean_ms": round(sum(timings) / len(timings), 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--targets', type=int, default=100000, help="planets, characters and vehicles each")
+    parser.add_argument('--favorites', type=int, default=1000000, help="rows per favorite table")
+    parser.add_argument('--lookups', type=int, default=50)
+    parser.add_argument('--batch', type=int, default=1, help="user ids per lookup")
+    parser.add_argument('--database', help="SQLite file to use, a temporary one by default")
+    args = parser.parse_args()
+
+    path = args.database or os.path.join(tempfile.mkdtemp(), 'favorites_benchmark.db')
+    connection = sqlite3.connect(path)
+    start = time.perf_counter()
+    seed(connection, args.users, args.targets, args.favorites)
+    seed_seconds = time.perf_counter() - start
+
+    before = measure(connection, args.users, args.lookups, args.batch)
+    start = time.perf_counter()
+    connection.executescript(INDEXES)
+    index_seconds = time.perf_counter() - start
+    after = measure(connection, args.users, args.lookups, args.batch)
+
+    print(json.dumps({
+        "benchmark": "favorites_lookup",
+        "users": args.users,
+        "favorites_per_table": args.favorites,
+        "batch": args.batch,
+        "seed_seconds": round(seed_seconds, 2),
+        "index_build_seconds": round(index_seconds, 2),
+        "before": before,
+        "after": after,
+        "p50_speedup": round(before["p50_ms"] / after["p50_ms"], 1) if after["p50_ms"] else None,
+    }, indent=2))
+    if not args.database:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+if __name__ == '__main__':
+    main()
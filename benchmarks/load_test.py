@@ -0,0 +1,313 @@
+"""
+Load test of every API route against seeded databases of several sizes
+(EXCLUDED lists the few that are not driven, and why).
+
+    $ python benchmarks/load_test.py --sizes 1000,100000 --concurrency 8 --output before.json
+    $ python benchmarks/compare.py before.json after.json
+
+For every size a fresh database is migrated and seeded with `size` planets,
+characters and vehicles, size / 100 users and `size` rows per favorite table,
+then each route is driven by `--concurrency` threads, every thread with its
+own Flask test client (in process, no network). Each size runs in its own
+subprocess so the peak RSS is not shared between sizes.
+
+The output is a JSON document with p50/p95/p99 latency and requests per
+second per route, tagged with the git commit, so runs of two commits can be
+compared. The random generator is seeded: the same arguments replay the same
+requests. The response cache is off unless --cache is given, the numbers are
+those of the database path.
+
+--database-url runs against an existing, EMPTY throwaway database (e.g. a
+local Postgres); by default a temporary SQLite file is used per size.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import itertools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED_BATCH = 10000
+
+def percentile(values, fraction):
+    # nearest rank, values are sorted
+    return values[max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))]
+
+# routes not driven, with the reason
+EXCLUDED = {
+    'GET /': "sitemap of the routes, static",
+    'GET /swagger.json': "API description, built once",
+    'GET /internal/stats/pool, /internal/stats/slow_queries, /metrics': "monitoring, not client traffic",
+    'GET /changes?wait=': "a long poll answers after its timeout, the latency is the wait",
+    'GET /jobs/<id>/result': "needs a worker to have written an export file, no worker runs here",
+}
+# measured requests of the routes transferring a whole table each time
+REQUEST_CAPS = {'GET /export csv': 20}
+# the internal routes (/export, /import, /jobs) refuse every request without a token
+INTERNAL_TOKEN = 'load-test'
+JSON_PATCH = 'application/json-patch+json'
+
+def routes(size, users):
+    """
+    (name, method, request builder) of every route, reads first so writes
+    don't evict them, deletes last so they remove rows created by the writes.
+    A builder returns (path, body) or (path, body, content type); a str body
+    is sent as is, anything else as JSON.
+    """
+    created = itertools.count(1)
+    page = max(size // 2, 1)
+    # the rows created by POST /planet, /character and /user get the ids after the seeded ones
+    new_planets, new_characters, new_users = itertools.count(size + 1), itertools.count(size + 1), itertools.count(users + 1)
+    # far above the ids POST /vehicles_starships/bulk creates
+    imported = itertools.count(10 ** 8 + 1)
+    # the n-th pilot added is removed by the n-th DELETE
+    added_pilots, removed_pilots = itertools.count(), itertools.count()
+    jobs = itertools.count(1)
+
+    def planet_id(rng):
+        return rng.randint(1, size)
+
+    def pilot_path(n):
+        return '/vehicle_starship/{}/pilots/{}'.format(n % size + 1, (n // size + n) % size + 1)
+
+    def import_body(rng):
+        start = next(imported)
+        for _ in range(99):
+            next(imported)
+        rows = ({"table": "vehicle_starship", "row": {"id": start + offset, "name": "imported ship {}".format(start + offset)}} for offset in range(100))
+        return '/import?import_id=load-{}'.format(start), "".join(json.dumps(row) + "\n" for row in rows), 'application/x-ndjson'
+
+    return [
+        ('GET /users', 'GET', lambda rng: ('/users?limit=100', None)),
+        ('GET /user/<id>', 'GET', lambda rng: ('/user/{}'.format(rng.randint(1, users)), None)),
+        ('GET /planets', 'GET', lambda rng: ('/planets?limit=100', None)),
+        ('GET /planets after', 'GET', lambda rng: ('/planets?limit=100&after={}'.format(rng.randint(1, page)), None)),
+        ('GET /planets sorted', 'GET', lambda rng: ('/planets?limit=100&sort=-population', None)),
+        ('GET /planets filtered', 'GET', lambda rng: ('/planets?limit=100&population__gte={}'.format(rng.randint(1, size) * 1000), None)),
+        ('GET /planet/<id>', 'GET', lambda rng: ('/planet/{}'.format(planet_id(rng)), None)),
+        ('GET /characters', 'GET', lambda rng: ('/characters?limit=100&fields=name,species', None)),
+        ('GET /characters include', 'GET', lambda rng: ('/characters?limit=100&include=homeworld', None)),
+        ('GET /character/<id>', 'GET', lambda rng: ('/character/{}'.format(rng.randint(1, size)), None)),
+        ('GET /vehicles_starships', 'GET', lambda rng: ('/vehicles_starships?limit=100', None)),
+        ('GET /search', 'GET', lambda rng: ('/search?q=planet {}'.format(rng.randint(1, 99)), None)),
+        ('GET /user/favorites', 'GET', lambda rng: ('/user/favorites?limit=100', {"user_id": rng.randint(1, users)})),
+        ('GET /leaderboards/planets', 'GET', lambda rng: ('/leaderboards/planets', None)),
+        ('GET /leaderboards/characters', 'GET', lambda rng: ('/leaderboards/characters', None)),
+        ('GET /leaderboards/vehicles_starships', 'GET', lambda rng: ('/leaderboards/vehicles_starships', None)),
+        ('POST /users/favorites', 'POST', lambda rng: ('/users/favorites?limit=100', {"user_ids": [rng.randint(1, users) for _ in range(20)]})),
+        ('GET /changes', 'GET', lambda rng: ('/changes', None)),
+        ('GET /export csv', 'GET', lambda rng: ('/export?format=csv&tables=planet', None)),
+        # the seeded passwords are marked legacy plain text, the first login of a user rehashes it
+        ('POST /login', 'POST', lambda rng: ('/login', {"email": "user{}@example.com".format(rng.randint(1, users)), "password": "x"})),
+        ('POST /planet', 'POST', lambda rng: ('/planet', {"name": "load planet {}".format(next(created)), "climate": "arid", "population": rng.randint(1, 10 ** 9)})),
+        ('POST /character', 'POST', lambda rng: ('/character', {"name": "load character {}".format(next(created)), "species": "human", "homeworld_id": planet_id(rng)})),
+        ('PUT /planet/<id>', 'PUT', lambda rng: ('/planet/{}'.format(planet_id(rng)), {"population": rng.randint(1, 10 ** 9)})),
+        ('PATCH /planet/<id>', 'PATCH', lambda rng: ('/planet/{}'.format(planet_id(rng)), {"climate": "frozen"})),
+        ('PATCH /planet/<id> json patch', 'PATCH', lambda rng: ('/planet/{}'.format(planet_id(rng)), [{"op": "replace", "path": "/population", "value": rng.randint(1, 10 ** 9)}], JSON_PATCH)),
+        ('PUT /character/<id>', 'PUT', lambda rng: ('/character/{}'.format(rng.randint(1, size)), {"species": "species {}".format(rng.randint(1, 50))})),
+        ('PUT /user/<id>', 'PUT', lambda rng: ('/user/{}'.format(rng.randint(1, users)), {"is_active": rng.random() < 0.5})),
+        ('POST /planets/bulk', 'POST', lambda rng: ('/planets/bulk', [
+            {"name": "load planet {}".format(next(created)), "climate": "temperate", "population": rng.randint(1, 10 ** 9)} for _ in range(100)
+        ])),
+        ('POST /characters/bulk', 'POST', lambda rng: ('/characters/bulk', [
+            {"name": "load character {}".format(next(created)), "species": "species 1", "homeworld_id": planet_id(rng)} for _ in range(100)
+        ])),
+        ('POST /vehicles_starships/bulk', 'POST', lambda rng: ('/vehicles_starships/bulk', [{"name": "load ship {}".format(next(created))} for _ in range(100)])),
+        ('POST /vehicles_starships/bulk upsert', 'POST', lambda rng: ('/vehicles_starships/bulk?upsert=true', [
+            {"name": "ship {}".format(rng.randint(1, size))} for _ in range(100)
+        ])),
+        ('POST /import', 'POST', import_body),
+        ('POST /vehicle_starship/<id>/pilots', 'POST', lambda rng: (pilot_path(next(added_pilots)), None)),
+        ('DELETE /vehicle_starship/<id>/pilots', 'DELETE', lambda rng: (pilot_path(next(removed_pilots)), None)),
+        ('POST /user/<id>/favorites', 'POST', lambda rng: ('/user/{}/favorites/planet/{}'.format(rng.randint(1, users), planet_id(rng)), None)),
+        ('DELETE /user/<id>/favorites', 'DELETE', lambda rng: ('/user/{}/favorites/planet/{}'.format(rng.randint(1, users), planet_id(rng)), None)),
+        ('POST /user', 'POST', lambda rng: ('/user', {"name": "load user", "email": "load{}@example.com".format(next(created)), "password": "benchmark", "is_active": True})),
+        # jobs are only queued, no worker runs during the benchmark
+        ('POST /jobs', 'POST', lambda rng: ('/jobs', {"type": "prune_changes", "params": {"days": 30}})),
+        ('GET /jobs', 'GET', lambda rng: ('/jobs?limit=100', None)),
+        ('GET /jobs/<id>', 'GET', lambda rng: ('/jobs/{}'.format(rng.randint(1, 20)), None)),
+        ('DELETE /jobs/<id>', 'DELETE', lambda rng: ('/jobs/{}'.format(next(jobs)), None)),
+        ('GET /changes since', 'GET', lambda rng: ('/changes?since={}&limit=100'.format(rng.randint(0, 1000)), None)),
+        ('DELETE /character/<id>', 'DELETE', lambda rng: ('/character/{}'.format(next(new_characters)), None)),
+        ('DELETE /planet/<id>', 'DELETE', lambda rng: ('/planet/{}'.format(next(new_planets)), None)),
+        ('DELETE /user/<id>', 'DELETE', lambda rng: ('/user/{}'.format(next(new_users)), None)),
+    ]
+
+def seed(connection, size, users):
+    """Core inserts in batches, much faster than the API or the ORM"""
+    from models import User, Planet, Character, Vehicle_Starship, FavoritePlanet, FavoriteCharacter, FavoriteVehicleStarship
+
+    def insert(table, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, SEED_BATCH))
+            if not batch:
+                break
+            connection.execute(table.insert(), batch)
+
+    climates = ('arid', 'temperate', 'frozen', 'tropical', 'murky')
+    insert(User.__table__, ({"id": i, "name": "user {}".format(i), "email": "user{}@example.com".format(i), "password": "plain$x", "is_active": True} for i in range(1, users + 1)))
+    insert(Planet.__table__, ({"id": i, "name": "planet {}".format(i), "climate": climates[i % 5], "population": i * 1000} for i in range(1, size + 1)))
+    insert(Character.__table__, ({"id": i, "name": "character {}".format(i), "species": "species {}".format(i % 50), "gender": "n/a", "homeworld_id": i % size + 1} for i in range(1, size + 1)))
+    insert(Vehicle_Starship.__table__, ({"id": i, "name": "ship {}".format(i)} for i in range(1, size + 1)))
+    for model, column in ((FavoritePlanet, 'planet_id'), (FavoriteCharacter, 'character_id'), (FavoriteVehicleStarship, 'vehicle_starship_id')):
+        # (user, target) pairs are unique: for a given user the targets are consecutive
+        insert(model.__table__, ({"user_id": i % users + 1, column: (i // users + (i % users) * 7) % size + 1} for i in range(size)))
+
+def drive(app, name, method, build, requests, concurrency, seed_value):
+    local = threading.local()
+    rng_lock = threading.Lock()
+    rng = random.Random(seed_value)
+
+    def one(_):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        with rng_lock:
+            path, body, *content_type = build(rng)
+        data = {'data': body} if isinstance(body, str) else {'json': body}
+        start = time.perf_counter()
+        response = client.open(path, method=method, content_type=content_type[0] if content_type else None,
+                               headers={'X-Internal-Token': INTERNAL_TOKEN}, **data)
+        response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(one, range(requests)))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(seconds * 1000 for seconds, status in samples)
+    statuses = {}
+    for seconds, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": requests,
+        "errors": sum(count for status, count in statuses.items() if int(status) >= 500),
+        "statuses": statuses,
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "max_ms": round(latencies[-1], 3),
+        "rps": round(requests / wall, 1),
+    }
+
+def run_size(args):
+    """Runs in the subprocess of one size, prints its JSON result"""
+    database_url = args.database_url
+    path = None
+    if not database_url:
+        path = os.path.join(tempfile.mkdtemp(), 'load_test_{}.db'.format(args.size))
+        database_url = 'sqlite:///' + path
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['CACHE_BACKEND'] = args.cache
+    # every simulated client has the same address
+    os.environ['RATE_LIMIT_BACKEND'] = 'none'
+    os.environ['INTERNAL_STATS_TOKEN'] = INTERNAL_TOKEN
+    os.environ.setdefault('SLOW_QUERY_MS', '10000')
+    sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+    from flask_migrate import upgrade
+    from app import app
+    from models import db
+    from favorite_writes import reconcile_favorite_counts
+
+    users = max(args.size // 100, 10)
+    start = time.perf_counter()
+    with app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+        with db.engine.begin() as connection:
+            seed(connection, args.size, users)
+        reconcile_favorite_counts()
+        db.session.execute(db.text("ANALYZE"))
+        db.session.commit()
+    seed_seconds = time.perf_counter() - start
+
+    results = {}
+    for index, (name, method, build) in enumerate(routes(args.size, users)):
+        # warm up connections, caches and the code paths before measuring
+        requests = min(args.requests, REQUEST_CAPS.get(name, args.requests))
+        drive(app, name, method, build, min(requests, 20), args.concurrency, args.seed + index)
+        results[name] = drive(app, name, method, build, requests, args.concurrency, args.seed + index)
+
+    with app.app_context():
+        db.engine.dispose()
+    if path:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / 1024 / 1024 if sys.platform == 'darwin' else peak_rss / 1024
+    print(json.dumps({
+        "size": args.size,
+        "users": users,
+        "seed_seconds": round(seed_seconds, 2),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "routes": results,
+    }))
+
+def git_commit():
+    def git(*command):
+        return subprocess.run(('git',) + command, cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return {"commit": git('rev-parse', 'HEAD') or None, "dirty": bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000', help="comma separated, e.g. 1000,100000,1000000")
+    parser.add_argument('--requests', type=int, default=500, help="measured requests per route")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--cache', default='none', help="CACHE_BACKEND during the run")
+    parser.add_argument('--database-url', help="empty throwaway database to seed, a temporary SQLite file by default")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="file to write the JSON result to, stdout by default")
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size:
+        run_size(args)
+        return
+
+    if args.database_url and ',' in args.sizes:
+        parser.error("--database-url can only be seeded once, pass a single size")
+
+    sizes = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        command = [sys.executable, os.path.abspath(__file__), '--size', str(size), '--requests', str(args.requests),
+                   '--concurrency', str(args.concurrency), '--cache', args.cache, '--seed', str(args.seed)]
+        if args.database_url:
+            command += ['--database-url', args.database_url]
+        print("size {}...".format(size), file=sys.stderr)
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            sys.stderr.write(completed.stderr)
+            sys.exit(completed.returncode)
+        sizes.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    document = json.dumps({
+        "benchmark": "load_test",
+        "git": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "concurrency": args.concurrency,
+        "requests_per_route": args.requests,
+        "cache": args.cache,
+        "database": "custom" if args.database_url else "sqlite",
+        "sizes": sizes,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(document + '\n')
+    else:
+        print(document)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Cold start benchmark: time and memory to import the app and serve the first
+request, per startup profile (APP_PROFILE, see src/profiles.py).
+
+    $ python benchmarks/startup.py --runs 10 --output startup.json
+
+Every run is a fresh interpreter, like a new gunicorn worker without
+preload_app. It reports the import time of the app, the first request to
+/ and, in the full profile, the first /admin request (when the admin is
+built), the process wall time and its peak RSS. A last run per profile with
+`python -X importtime` lists the slowest top level imports.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, 'src')
+PROFILES = ('full', 'api')
+
+# runs in the child interpreter, prints one JSON line
+CHILD = """
+import json, sys, time, resource
+start = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+client = app.test_client()
+client.get('/')
+first_request = time.perf_counter()
+loaded = {'admin_loaded': 'flask_admin' in sys.modules, 'swagger_loaded': 'flask_swagger' in sys.modules}
+admin = None
+if app.config['APP_PROFILE'] == 'full':
+    client.get('/admin/')
+    admin = time.perf_counter() - first_request
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_request_ms": (first_request - imported) * 1000,
+    "admin_first_request_ms": admin * 1000 if admin is not None else None,
+    **loaded,
+    "peak_rss_mb": peak_rss / 1024 / 1024 if sys.platform == 'darwin' else peak_rss / 1024,
+}))
+"""
+
+def child_env(profile, database_url):
+    env = dict(os.environ, APP_PROFILE=profile, CACHE_BACKEND='none', PYTHONPATH=SRC)
+    env.setdefault('DATABASE_URL', database_url)
+    return env
+
+def run_once(profile, database_url):
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-c', CHILD], cwd=SRC, env=child_env(profile, database_url), capture_output=True, text=True)
+    if completed.returncode != 0:
+        sys.stderr.write(completed.stderr)
+        sys.exit(completed.returncode)
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    # includes the interpreter start, what a new worker really waits for
+    result['process_ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+def slowest_imports(profile, database_url, top):
+    """(module, cumulative ms) of the slowest imports made directly by the app modules"""
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=SRC,
+                               env=child_env(profile, database_url), capture_output=True, text=True)
+    imports = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # `import app` is top level (one space), what it imports is indented by two more
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            imports.append((name.strip(), int(cumulative) / 1000))
+    return [{"module": module, "cumulative_ms": round(ms, 1)} for module, ms in sorted(imports, key=lambda item: -item[1])[:top]]
+
+def summary(runs, key):
+    values = sorted(run[key] for run in runs if run[key] is not None)
+    if not values:
+        return None
+    return {"median": round(median(values), 1), "min": round(values[0], 1), "max": round(values[-1], 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="fresh interpreters per profile")
+    parser.add_argument('--profiles', default=','.join(PROFILES))
+    parser.add_argument('--database-url', default='sqlite:////tmp/startup_benchmark.db', help="the app connects lazily, any URL works")
+    parser.add_argument('--top', type=int, default=15, help="slowest imports listed")
+    parser.add_argument('--output', help="file to write the JSON result to, stdout by default")
+    args = parser.parse_args()
+
+    # same tagging as the load test, so results of two commits can be told apart
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from load_test import git_commit
+
+    profiles = {}
+    for profile in args.profiles.split(','):
+        print("profile {}...".format(profile), file=sys.stderr)
+        runs = [run_once(profile, args.database_url) for _ in range(args.runs)]
+        profiles[profile] = {
+            "admin_loaded_at_start": runs[0]['admin_loaded'],
+            "swagger_loaded_at_start": runs[0]['swagger_loaded'],
+            **{key: summary(runs, key) for key in ('import_ms', 'first_request_ms', 'admin_first_request_ms', 'process_ms', 'peak_rss_mb')},
+            "slowest_imports": slowest_imports(profile, args.database_url, args.top),
+        }
+
+    document = json.dumps({
+        "benchmark": "startup",
+        "git": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "runs": args.runs,
+        "profiles": profiles,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(document + '\n')
+    else:
+        print(document)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""widen user.password for scrypt hashes
+
+Revision ID: 3f9a61c27e84
+Revises: b071decf3949
+Create Date: 2026-10-18 14:10:37.402915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a61c27e84'
+down_revision = 'b071decf3949'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.alter_column('password', existing_type=sa.String(length=80), type_=sa.String(length=255), existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.alter_column('password', existing_type=sa.String(length=255), type_=sa.String(length=80), existing_nullable=False)
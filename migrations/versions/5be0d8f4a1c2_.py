@@ -0,0 +1,31 @@
+"""import checkpoints for resumable catalog imports
+
+Revision ID: 5be0d8f4a1c2
+Revises: a7c3e5d19b60
+Create Date: 2026-10-18 15:21:54.870142
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5be0d8f4a1c2'
+down_revision = 'a7c3e5d19b60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('import_checkpoint',
+    sa.Column('import_id', sa.String(length=120), nullable=False),
+    sa.Column('records', sa.BigInteger(), nullable=False),
+    sa.Column('byte_offset', sa.BigInteger(), nullable=False),
+    sa.Column('finished', sa.Boolean(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('import_id')
+    )
+
+
+def downgrade():
+    op.drop_table('import_checkpoint')
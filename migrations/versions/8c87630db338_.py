@@ -0,0 +1,44 @@
+"""favorites and name lookup indexes
+
+Revision ID: 8c87630db338
+Revises: 93cd02d4349f
+Create Date: 2026-10-18 11:03:17.551902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c87630db338'
+down_revision = '93cd02d4349f'
+branch_labels = None
+depends_on = None
+
+FAVORITE_TABLES = (
+    ('favorite_planets', 'planet_id'),
+    ('favorite_characters', 'character_id'),
+    ('favorite_vehicles_starships', 'vehicle_starship_id'),
+)
+
+
+def upgrade():
+    for table, target_id in FAVORITE_TABLES:
+        # keep the oldest row of every duplicated favorite so the unique index can be built
+        op.execute(
+            "DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY user_id, {target_id})".format(table=table, target_id=target_id)
+        )
+        op.create_index('ix_{}_user_id_{}'.format(table, target_id), table, ['user_id', target_id], unique=True)
+        op.create_index('ix_{}_{}'.format(table, target_id), table, [target_id], unique=False)
+    op.create_index('ix_planet_name', 'planet', ['name'], unique=False)
+    op.create_index('ix_character_name', 'character', ['name'], unique=False)
+    op.create_index('ix_character_species', 'character', ['species'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_character_species', table_name='character')
+    op.drop_index('ix_character_name', table_name='character')
+    op.drop_index('ix_planet_name', table_name='planet')
+    for table, target_id in reversed(FAVORITE_TABLES):
+        op.drop_index('ix_{}_{}'.format(table, target_id), table_name=table)
+        op.drop_index('ix_{}_user_id_{}'.format(table, target_id), table_name=table)
@@ -0,0 +1,35 @@
+"""table versions for conditional GET
+
+Revision ID: 93cd02d4349f
+Revises: 6851b4618887
+Create Date: 2026-10-18 10:12:41.208733
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '93cd02d4349f'
+down_revision = '6851b4618887'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_version = op.create_table('table_version',
+    sa.Column('table_name', sa.String(length=80), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(table_version, [
+        {'table_name': table_name, 'version': 0, 'updated_at': now}
+        for table_name in ('user', 'planet', 'character', 'vehicle_starship')
+    ])
+
+
+def downgrade():
+    op.drop_table('table_version')
@@ -0,0 +1,54 @@
+"""mark the legacy plain text passwords
+
+Revision ID: 9d4e2b7f1a38
+Revises: f3b8c5d21e96
+Create Date: 2026-10-18 23:41:07.502316
+
+"""
+import re
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4e2b7f1a38'
+down_revision = 'f3b8c5d21e96'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+LEGACY_PREFIX = 'plain$'
+# the full hash format, a plain text password may well start with "scrypt$"
+HASHED = re.compile(r'scrypt\$\d+\$\d+\$\d+\$[A-Za-z0-9+/]+={0,2}\$[A-Za-z0-9+/]+={0,2}\Z')
+
+user = sa.table('user', sa.column('id', sa.Integer), sa.column('password', sa.String))
+
+
+def _rewrite(mark):
+    """Runs `mark` over every stored password, in batches of users"""
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(user.c.id, user.c.password).where(user.c.id > last_id).order_by(user.c.id).limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            return
+        changed = [
+            {'user_id': user_id, 'new_password': mark(password)}
+            for user_id, password in rows if mark(password) != password
+        ]
+        if changed:
+            connection.execute(
+                user.update().where(user.c.id == sa.bindparam('user_id')).values(password=sa.bindparam('new_password')),
+                changed
+            )
+        last_id = rows[-1].id
+
+
+def upgrade():
+    _rewrite(lambda password: password if HASHED.match(password) else LEGACY_PREFIX + password)
+
+
+def downgrade():
+    _rewrite(lambda password: password[len(LEGACY_PREFIX):] if password.startswith(LEGACY_PREFIX) else password)
@@ -0,0 +1,67 @@
+"""favorite_count on planets, characters and vehicles
+
+Revision ID: a7c3e5d19b60
+Revises: 3f9a61c27e84
+Create Date: 2026-10-18 14:48:12.530871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e5d19b60'
+down_revision = '3f9a61c27e84'
+branch_labels = None
+depends_on = None
+
+# (target table, favorite table, favorite column)
+COUNTED = (
+    ('planet', 'favorite_planets', 'planet_id'),
+    ('character', 'favorite_characters', 'character_id'),
+    ('vehicle_starship', 'favorite_vehicles_starships', 'vehicle_starship_id'),
+)
+# search index triggers of d41e7a9c05b2: (table, kind, indexed columns)
+SEARCH_TABLES = (
+    ('planet', 0, ('name', 'NULL')),
+    ('character', 1, ('name', 'species')),
+    ('vehicle_starship', 2, ('name', 'NULL')),
+)
+
+
+def _sqlite_row(kind, name, extra):
+    name = name if name == 'NULL' else 'new.' + name
+    extra = extra if extra == 'NULL' else 'new.' + extra
+    return "new.id * 4 + {}, {}, {}".format(kind, name, extra)
+
+
+def _search_update_triggers(only_indexed_columns):
+    # counter updates must not rewrite the FTS rows, only changes to the indexed columns do
+    for table, kind, columns in SEARCH_TABLES:
+        of = ' OF ' + ', '.join(column for column in columns if column != 'NULL') if only_indexed_columns else ''
+        op.execute("DROP TRIGGER {}_search_update".format(table))
+        op.execute(
+            "CREATE TRIGGER {table}_search_update AFTER UPDATE{of} ON {table} BEGIN "
+            "DELETE FROM search_index WHERE rowid = old.id * 4 + {kind}; "
+            "INSERT INTO search_index (rowid, name, extra) VALUES ({row}); END".format(table=table, of=of, kind=kind, row=_sqlite_row(kind, *columns))
+        )
+
+
+def upgrade():
+    for table, favorites, column in COUNTED:
+        op.add_column(table, sa.Column('favorite_count', sa.Integer(), server_default='0', nullable=False))
+        target, favorite = sa.table(table, sa.column('id'), sa.column('favorite_count')), sa.table(favorites, sa.column(column))
+        count = sa.select(sa.func.count()).select_from(favorite).where(favorite.c[column] == target.c.id).scalar_subquery()
+        op.execute(target.update().values(favorite_count=count))
+        op.create_index('ix_{}_favorite_count'.format(table), table, ['favorite_count'], unique=False)
+    if op.get_bind().dialect.name == 'sqlite':
+        _search_update_triggers(True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        _search_update_triggers(False)
+    for table, favorites, column in COUNTED:
+        op.drop_index('ix_{}_favorite_count'.format(table), table_name=table)
+        # not a batch operation, recreating the table would drop its search triggers (SQLite 3.35+ drops columns)
+        op.drop_column(table, 'favorite_count')
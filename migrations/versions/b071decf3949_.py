@@ -0,0 +1,24 @@
+"""index on planet population for sorted listings
+
+Revision ID: b071decf3949
+Revises: d41e7a9c05b2
+Create Date: 2026-10-18 13:02:44.118520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b071decf3949'
+down_revision = 'd41e7a9c05b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_planet_population', 'planet', ['population'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_planet_population', table_name='planet')
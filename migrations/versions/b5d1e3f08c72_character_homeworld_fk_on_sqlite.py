@@ -0,0 +1,46 @@
+"""character homeworld foreign key on SQLite
+
+Revision ID: b5d1e3f08c72
+Revises: 9d4e2b7f1a38
+Create Date: 2026-10-19 00:12:36.840519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5d1e3f08c72'
+down_revision = '9d4e2b7f1a38'
+branch_labels = None
+depends_on = None
+
+FK_NAME = 'fk_character_homeworld_id_planet'
+
+
+def _rebuild_character(alter):
+    """
+    SQLite adds and drops constraints by copying the table (batch mode), which
+    drops its triggers (the search index ones): they are created again after
+    """
+    connection = op.get_bind()
+    triggers = connection.execute(
+        sa.text("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'character'")
+    ).scalars().all()
+    with op.batch_alter_table('character', recreate='always') as batch_op:
+        alter(batch_op)
+    for sql in triggers:
+        op.execute(sql)
+
+
+def upgrade():
+    # c2e8f7a94d13 created it on the other databases
+    if op.get_bind().dialect.name == 'sqlite':
+        _rebuild_character(lambda batch_op: batch_op.create_foreign_key(
+            FK_NAME, 'planet', ['homeworld_id'], ['id'], ondelete='SET NULL'
+        ))
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        _rebuild_character(lambda batch_op: batch_op.drop_constraint(FK_NAME, type_='foreignkey'))
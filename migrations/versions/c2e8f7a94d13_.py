@@ -0,0 +1,44 @@
+"""character homeworld and vehicle pilots
+
+Revision ID: c2e8f7a94d13
+Revises: 5be0d8f4a1c2
+Create Date: 2026-10-18 15:02:41.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2e8f7a94d13'
+down_revision = '5be0d8f4a1c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('character', sa.Column('homeworld_id', sa.Integer(), nullable=True))
+    if op.get_bind().dialect.name != 'sqlite':
+        # SQLite only adds constraints by recreating the table (batch mode), which would drop its search triggers
+        op.create_foreign_key('fk_character_homeworld_id_planet', 'character', 'planet', ['homeworld_id'], ['id'], ondelete='SET NULL')
+    op.create_index(op.f('ix_character_homeworld_id'), 'character', ['homeworld_id'], unique=False)
+    op.create_table('vehicle_pilots',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('vehicle_starship_id', sa.Integer(), nullable=False),
+    sa.Column('character_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['character_id'], ['character.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['vehicle_starship_id'], ['vehicle_starship.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_vehicle_pilots_character_id'), 'vehicle_pilots', ['character_id'], unique=False)
+    op.create_index('ix_vehicle_pilots_vehicle_starship_id_character_id', 'vehicle_pilots', ['vehicle_starship_id', 'character_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_vehicle_pilots_vehicle_starship_id_character_id', table_name='vehicle_pilots')
+    op.drop_index(op.f('ix_vehicle_pilots_character_id'), table_name='vehicle_pilots')
+    op.drop_table('vehicle_pilots')
+    op.drop_index(op.f('ix_character_homeworld_id'), table_name='character')
+    if op.get_bind().dialect.name != 'sqlite':
+        op.drop_constraint('fk_character_homeworld_id_planet', 'character', type_='foreignkey')
+    op.drop_column('character', 'homeworld_id')
@@ -0,0 +1,68 @@
+"""search index over planets, characters and vehicles
+
+Revision ID: d41e7a9c05b2
+Revises: 8c87630db338
+Create Date: 2026-10-18 12:26:09.730114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41e7a9c05b2'
+down_revision = '8c87630db338'
+branch_labels = None
+depends_on = None
+
+# (table, kind number stored in the FTS rowid, indexed columns) - keep in sync with src/search.py
+SEARCH_TABLES = (
+    ('planet', 0, ('name', 'NULL')),
+    ('character', 1, ('name', 'species')),
+    ('vehicle_starship', 2, ('name', 'NULL')),
+)
+TRIGRAM_COLUMNS = (('planet', 'name'), ('character', 'name'), ('character', 'species'), ('vehicle_starship', 'name'))
+
+
+def _sqlite_row(table, kind, name, extra, prefix):
+    name = name if name == 'NULL' else '{}.{}'.format(prefix, name)
+    extra = extra if extra == 'NULL' else '{}.{}'.format(prefix, extra)
+    return "{prefix}.id * 4 + {kind}, {name}, {extra}".format(prefix=prefix, kind=kind, name=name, extra=extra)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for table, column in TRIGRAM_COLUMNS:
+            op.execute('CREATE INDEX ix_{0}_{1}_trgm ON "{0}" USING gin ({1} gin_trgm_ops)'.format(table, column))
+    elif dialect == 'sqlite':
+        # the rowid encodes the source row: id * 4 + kind
+        op.execute("CREATE VIRTUAL TABLE search_index USING fts5(name, extra, tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+        for table, kind, (name, extra) in SEARCH_TABLES:
+            op.execute("INSERT INTO search_index (rowid, name, extra) SELECT {} FROM {} AS new".format(_sqlite_row(table, kind, name, extra, 'new'), table))
+            op.execute(
+                "CREATE TRIGGER {table}_search_insert AFTER INSERT ON {table} BEGIN "
+                "INSERT INTO search_index (rowid, name, extra) VALUES ({row}); END".format(table=table, row=_sqlite_row(table, kind, name, extra, 'new'))
+            )
+            op.execute(
+                "CREATE TRIGGER {table}_search_update AFTER UPDATE ON {table} BEGIN "
+                "DELETE FROM search_index WHERE rowid = old.id * 4 + {kind}; "
+                "INSERT INTO search_index (rowid, name, extra) VALUES ({row}); END".format(table=table, kind=kind, row=_sqlite_row(table, kind, name, extra, 'new'))
+            )
+            op.execute(
+                "CREATE TRIGGER {table}_search_delete AFTER DELETE ON {table} BEGIN "
+                "DELETE FROM search_index WHERE rowid = old.id * 4 + {kind}; END".format(table=table, kind=kind)
+            )
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        for table, column in TRIGRAM_COLUMNS:
+            op.execute('DROP INDEX ix_{}_{}_trgm'.format(table, column))
+    elif dialect == 'sqlite':
+        for table, kind, columns in SEARCH_TABLES:
+            for event in ('insert', 'update', 'delete'):
+                op.execute("DROP TRIGGER {}_search_{}".format(table, event))
+        op.execute("DROP TABLE search_index")
@@ -0,0 +1,30 @@
+"""row versions for optimistic concurrency
+
+Revision ID: f3b8c5d21e96
+Revises: e6f29a1c7b40
+Create Date: 2026-10-18 21:08:52.114873
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8c5d21e96'
+down_revision = 'e6f29a1c7b40'
+branch_labels = None
+depends_on = None
+
+TABLES = ('user', 'planet', 'character')
+
+
+def upgrade():
+    # a plain ADD COLUMN, no table copy on SQLite (that would drop the search triggers)
+    for table in TABLES:
+        op.add_column(table, sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    # SQLite 3.35+ drops a column without copying the table
+    for table in TABLES:
+        op.drop_column(table, 'version')
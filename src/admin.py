@@ -1,7 +1,17 @@
 import os
+from flask import Flask
 from flask_admin import Admin
 from models import db, User, Planet, Character, Vehicle_Starship, FavoritePlanet,FavoriteCharacter,FavoriteVehicleStarship
 from flask_admin.contrib.sqla import ModelView
+from passwords import hash_password, is_hashed
+
+class UserView(ModelView):
+    column_exclude_list = ('password',)
+
+    def on_model_change(self, form, model, is_created):
+        # a password typed in the admin form is stored hashed like the API does
+        if not is_hashed(model.password):
+            model.password = hash_password(model.password)
 
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
@@ -10,7 +20,7 @@ def setup_admin(app):
 
     
     # Add your models here, for example this is how we add a the User model to the admin
-    admin.add_view(ModelView(User, db.session))
+    admin.add_view(UserView(User, db.session))
     admin.add_view(ModelView(Planet, db.session))
     admin.add_view(ModelView(FavoritePlanet, db.session))
     admin.add_view(ModelView(Character, db.session))
@@ -19,4 +29,12 @@ def setup_admin(app):
     admin.add_view(ModelView(FavoriteVehicleStarship, db.session))
 
     # You can duplicate that line to add mew models
-    # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
+    # admin.add_view(ModelView(YourModelName, db.session))
+
+def create_admin_app(api_app):
+    """A separate app serving /admin, on the database of the API app"""
+    admin_app = Flask(__name__)
+    admin_app.config.update({key: value for key, value in api_app.config.items() if key.startswith('SQLALCHEMY_')})
+    db.init_app(admin_app)
+    setup_admin(admin_app)
+    return admin_app
@@ -0,0 +1,249 @@
+"""
+Admission control: per-client token bucket rate limits and a concurrency
+limit with a bounded wait queue. setup_admission is called before the other
+setups, so its check runs before any other work (replica routing, cache
+lookups); only the request metrics start earlier, so rejections are counted.
+
+Clients are identified by their X-API-Key when it is one of RATE_LIMIT_API_KEYS
+(`key=rate/burst,...`, each key gets its own rate), by their IP otherwise.
+Every request takes a token from the client's bucket, which refills at
+RATE_LIMIT_RATE tokens per second up to RATE_LIMIT_BURST. An empty bucket is
+a 429 with Retry-After.
+
+Rate limits are off by default (RATE_LIMIT_BACKEND=none). The buckets live
+in the worker memory (memory, a few microseconds per request, limits are per
+worker), or in a SQLite file shared by the workers of a host (sqlite) or in
+Redis (redis) so the limits hold across workers.
+
+Behind a router (Heroku, Render) every request comes from the router's
+address: set RATE_LIMIT_TRUST_PROXY=true there, or all the clients share one
+bucket.
+
+MAX_CONCURRENT_REQUESTS (per worker, 0 disables it) caps the requests being
+processed at once. Up to ADMISSION_QUEUE_SIZE more wait at most
+ADMISSION_QUEUE_TIMEOUT_MS for a slot, the rest get a 503 with Retry-After.
+Views marked @long_lived (long polls, event streams) take no slot. A sync
+gunicorn worker (the default) serves one request at a time, so there the
+limit is effectively 1 whatever its value: it only matters with threaded
+workers (--threads) or the ASGI server.
+"""
+import os
+import math
+import time
+import random
+import sqlite3
+import threading
+from collections import OrderedDict
+from flask import current_app, request, g
+from utils import APIException
+from pool import env_bool
+
+class MemoryBuckets:
+    """Buckets of this worker, the least recently seen clients are forgotten past max_clients"""
+
+    def __init__(self, max_clients=100000):
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Returns (allowed, tokens left, seconds until a token is available)"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return allowed, tokens, 0.0 if allowed else (1 - tokens) / rate
+
+class SQLiteBuckets:
+    """Buckets shared by all the workers of a host, stored in a SQLite file"""
+
+    # rows idle for longer are full buckets again and can be dropped
+    IDLE_SECONDS = 3600
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self._connection().execute("CREATE TABLE IF NOT EXISTS rate_limit (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            self.local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM rate_limit WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            connection.execute("INSERT OR REPLACE INTO rate_limit (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            if random.random() < 0.001:
+                connection.execute("DELETE FROM rate_limit WHERE updated < ?", (now - self.IDLE_SECONDS,))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return allowed, tokens, 0.0 if allowed else (1 - tokens) / rate
+
+class RedisBuckets:
+    """Buckets shared by every worker and host, updated atomically by a Lua script"""
+
+    SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        allowed, tokens = self.script(keys=['rate_limit:' + key], args=[rate, burst, time.time()])
+        tokens = float(tokens)
+        return bool(allowed), tokens, 0.0 if allowed else (1 - tokens) / rate
+
+class ConcurrencyLimit:
+    def __init__(self, limit, queue_size, timeout):
+        self.slots = threading.BoundedSemaphore(limit)
+        # requests allowed to wait for a slot, the next ones are rejected right away
+        self.queue = threading.BoundedSemaphore(queue_size) if queue_size else None
+        self.timeout = timeout
+
+    def acquire(self):
+        if self.slots.acquire(blocking=False):
+            return True
+        if self.queue is None or not self.queue.acquire(blocking=False):
+            return False
+        try:
+            return self.slots.acquire(timeout=self.timeout)
+        finally:
+            self.queue.release()
+
+    def release(self):
+        self.slots.release()
+
+def parse_api_keys(value, default_burst):
+    """{key: (rate, burst)} from `key=rate/burst,key=rate` (the burst defaults to RATE_LIMIT_BURST)"""
+    keys = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        key, _, limits = item.strip().partition('=')
+        rate, _, burst = limits.partition('/')
+        keys[key] = (float(rate), float(burst) if burst else default_burst)
+    return keys
+
+class Admission:
+    def __init__(self, buckets, rate, burst, api_keys, trust_proxy, concurrency):
+        self.buckets = buckets
+        self.rate = rate
+        self.burst = burst
+        self.api_keys = api_keys
+        self.trust_proxy = trust_proxy
+        self.concurrency = concurrency
+
+    def client(self):
+        """(bucket key, rate, burst) of the current request"""
+        api_key = request.headers.get('X-API-Key')
+        if api_key in self.api_keys:
+            return ('key:' + api_key,) + self.api_keys[api_key]
+        address = request.remote_addr
+        if self.trust_proxy and request.access_route:
+            # the address appended by the proxy in front of us, the earlier ones are the client's to make up
+            address = request.access_route[-1]
+        return 'ip:{}'.format(address), self.rate, self.burst
+
+    def admit(self):
+        if self.buckets is not None:
+            key, rate, burst = self.client()
+            allowed, tokens, wait = self.buckets.take(key, rate, burst)
+            g.rate_limit = (burst, tokens)
+            if not allowed:
+                raise APIException("Too many requests, slow down", status_code=429,
+                                   headers={'Retry-After': str(max(1, math.ceil(wait)))})
+        if self.concurrency is not None and not getattr(current_app.view_functions.get(request.endpoint), 'long_lived', False):
+            if not self.concurrency.acquire():
+                raise APIException("Server busy, try again later", status_code=503, headers={'Retry-After': '1'})
+            g.admitted = True
+
+def long_lived(view):
+    """
+    Marks a view that holds its request open while waiting (long poll, event
+    stream): it is still rate limited but takes no concurrency slot.
+    """
+    view.long_lived = True
+    return view
+
+def _admit():
+    current_app.extensions['admission'].admit()
+
+def _rate_limit_headers(response):
+    if 'rate_limit' in g:
+        burst, tokens = g.rate_limit
+        response.headers['X-RateLimit-Limit'] = str(int(burst))
+        response.headers['X-RateLimit-Remaining'] = str(int(tokens))
+    return response
+
+def _release(error=None):
+    if g.pop('admitted', False):
+        current_app.extensions['admission'].concurrency.release()
+
+def setup_admission(app):
+    backend_name = os.environ.get('RATE_LIMIT_BACKEND', 'none')
+    burst = float(os.environ.get('RATE_LIMIT_BURST', 100))
+    if backend_name == 'none':
+        buckets = None
+    elif backend_name == 'sqlite':
+        buckets = SQLiteBuckets(os.environ.get('RATE_LIMIT_URL', '/tmp/rate_limit.db'))
+    elif backend_name == 'redis':
+        buckets = RedisBuckets(os.environ.get('RATE_LIMIT_URL', 'redis://localhost:6379/0'))
+    else:
+        buckets = MemoryBuckets(int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', 100000)))
+    max_concurrent = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 0))
+    concurrency = ConcurrencyLimit(
+        max_concurrent,
+        int(os.environ.get('ADMISSION_QUEUE_SIZE', 0)),
+        float(os.environ.get('ADMISSION_QUEUE_TIMEOUT_MS', 1000)) / 1000,
+    ) if max_concurrent else None
+    if buckets is None and concurrency is None:
+        return None
+    admission = Admission(
+        buckets,
+        rate=float(os.environ.get('RATE_LIMIT_RATE', 50)),
+        burst=burst,
+        api_keys=parse_api_keys(os.environ.get('RATE_LIMIT_API_KEYS'), burst),
+        trust_proxy=env_bool('RATE_LIMIT_TRUST_PROXY', False),
+        concurrency=concurrency,
+    )
+    app.extensions['admission'] = admission
+    app.before_request(_admit)
+    app.after_request(_rate_limit_headers)
+    app.teardown_request(_release)
+    return admission
@@ -2,16 +2,37 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for, Blueprint
+from flask import Flask, request, jsonify, url_for, Blueprint, Response, stream_with_context, send_file
 from flask_migrate import Migrate
-from flask_swagger import swagger
 from flask_cors import CORS
+from sqlalchemy.orm.exc import StaleDataError
 from utils import APIException, generate_sitemap
-from admin import setup_admin
-from models import db, User, Planet, Character, Vehicle_Starship, FavoriteCharacter, FavoritePlanet, FavoriteVehicleStarship
+from pagination import get_page_args, get_offset_args, wants_stream, keyset_page, stream_collection
+from bulk import bulk_write
+from search import search, include_object, KINDS as SEARCH_KINDS
+from favorites import load_favorites, validate_user_ids, leaderboard, parse_leaderboard_size
+from favorite_writes import setup_favorite_writes, flush_users, TARGETS as FAVORITE_TARGETS
+from changes import setup_changes, changes_request
+from jobs import setup_jobs, enqueue as enqueue_job, enqueue_request, list_jobs_request, cancel_job, wants_async, enqueue_import_request, export_path
+from catalog import catalog_cli, parse_tables, export_ndjson, export_csv, import_request, MIMETYPES as CATALOG_MIMETYPES
+from passwords import setup_passwords, hash_password, verify_password, needs_rehash
+from profiles import setup_profile
+from cache import setup_cache, cached
+from pool import engine_options, pool_status
+from serialization import FastJSONProvider, get_fields
+from formats import negotiate, collection_response, document_response
+from includes import get_includes, expand
+from filters import get_listing
+from versioning import conditional
+from updates import update_args, conditional_update, updated_response
+from metrics import setup_metrics, prometheus_text, registry as metrics_registry
+from admission import setup_admission, long_lived
+from replicas import setup_replicas, replicas_status
+from models import db, Job, User, Planet, Character, Vehicle_Starship, VehiclePilot, FavoriteCharacter, FavoritePlanet, FavoriteVehicleStarship
 #from models import Person
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 app.url_map.strict_slashes = False
 
 db_url = os.getenv("DATABASE_URL")
@@ -20,47 +41,191 @@ if db_url is not None:
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 
-MIGRATE = Migrate(app, db)
+MIGRATE = Migrate(app, db, include_object=include_object)
 db.init_app(app)
+# metrics and admission first: their hooks run before those of the other setups
+setup_metrics(app)
+setup_admission(app)
+setup_replicas(app)
 CORS(app)
-setup_admin(app)
+setup_profile(app)
+setup_cache(app)
+favorite_writes = setup_favorite_writes(app)
+app.cli.add_command(catalog_cli)
+setup_changes(app)
+setup_jobs(app)
+setup_passwords(app)
 
 # Handle/serialize errors like a JSON object
 @app.errorhandler(APIException)
 def handle_invalid_usage(error):
-    return jsonify(error.to_dict()), error.status_code
+    return jsonify(error.to_dict()), error.status_code, error.headers
+
+# an ORM write (admin, deletes) found the row changed since it was loaded
+@app.errorhandler(StaleDataError)
+def handle_stale_data(error):
+    db.session.rollback()
+    return jsonify({"message": "The row was modified or deleted meanwhile, try again"}), 409
 
 # generate sitemap with all your endpoints
 @app.route('/')
 def sitemap():
     return generate_sitemap(app)
 
+@app.route('/swagger.json', methods=['GET'])
+def get_swagger():
+    if app.config['APP_PROFILE'] != 'full':
+        return jsonify({"message": "Not found"}), 404
+    # imported on first use, API-only workers never load it
+    from flask_swagger import swagger
+    return jsonify(swagger(app)), 200
+
+# Internal Routes
+def internal_forbidden(required=False):
+    """
+    True when the request doesn't carry the INTERNAL_STATS_TOKEN. The stats are
+    open while no token is configured, `required` routes (they read and write
+    the data) are closed
+    """
+    token = os.getenv('INTERNAL_STATS_TOKEN')
+    if not token:
+        return required
+    return request.headers.get('X-Internal-Token') != token
+
+@app.route('/internal/stats/pool', methods=['GET'])
+def get_pool_stats():
+    if internal_forbidden():
+        return jsonify({"message": "Forbidden"}), 403
+    return jsonify({"msg": "ok", "pool": pool_status(db.engine.pool), "replicas": replicas_status()}), 200
+
+@app.route('/internal/stats/slow_queries', methods=['GET'])
+def get_slow_queries():
+    if internal_forbidden():
+        return jsonify({"message": "Forbidden"}), 403
+    return jsonify({"msg": "ok", "result": list(reversed(metrics_registry.slow_queries))}), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if internal_forbidden():
+        return jsonify({"message": "Forbidden"}), 403
+    gauges = [
+        ('db_pool_{}'.format(name), 'Connection pool {}'.format(name.replace('_', ' ')), value)
+        for name, value in pool_status(db.engine.pool).items()
+    ]
+    replicas = replicas_status()
+    if replicas:
+        gauges += [
+            ('db_replicas', 'Configured read replicas', len(replicas)),
+            ('db_replicas_healthy', 'Read replicas in rotation', sum(replica['healthy'] for replica in replicas)),
+        ]
+    return Response(prometheus_text(gauges), mimetype='text/plain; version=0.0.4')
+
+# Catalog export / import
+@app.route('/export', methods=['GET'])
+def export_catalog():
+    if internal_forbidden(required=True):
+        return jsonify({"message": "Forbidden"}), 403
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in CATALOG_MIMETYPES:
+        return jsonify({"message": "format must be one of: {}".format(", ".join(CATALOG_MIMETYPES))}), 400
+    tables = parse_tables(request.args.get('tables'), export_format == 'csv')
+    if wants_async():
+        return job_accepted(enqueue_job('export', {"format": export_format, "tables": tables}))
+    chunks = export_csv(tables[0]) if export_format == 'csv' else export_ndjson(tables)
+    response = Response(stream_with_context(chunks), mimetype=CATALOG_MIMETYPES[export_format])
+    response.headers['Content-Disposition'] = 'attachment; filename=catalog.{}'.format(export_format)
+    return response
+
+@app.route('/import', methods=['POST'])
+def import_catalog():
+    if internal_forbidden(required=True):
+        return jsonify({"message": "Forbidden"}), 403
+    if wants_async():
+        return job_accepted(enqueue_import_request())
+    return jsonify({"msg": "ok", **import_request()}), 200
+
+# Job Routes
+def job_accepted(job):
+    return jsonify({"msg": "ok", "result": job.serialize()}), 202, {"Location": url_for('get_job', job_id=job.id)}
+
+@app.route('/jobs', methods=['POST'])
+def add_job():
+    if internal_forbidden(required=True):
+        return jsonify({"message": "Forbidden"}), 403
+    return job_accepted(enqueue_request())
+
+@app.route('/jobs', methods=['GET'])
+def get_jobs():
+    if internal_forbidden(required=True):
+        return jsonify({"message": "Forbidden"}), 403
+    return jsonify({"msg": "ok", "result": list_jobs_request()}), 200
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    if internal_forbidden(required=True):
+        return jsonify({"message": "Forbidden"}), 403
+    job = db.session.get(Job, job_id)
+    if job:
+        return jsonify({"msg": "ok", "result": job.serialize()}), 200
+    return jsonify({"message": "Job not found"}), 404
+
+@app.route('/jobs/<int:job_id>', methods=['DELETE'])
+def delete_job(job_id):
+    if internal_forbidden(required=True):
+        return jsonify({"message": "Forbidden"}), 403
+    job = db.session.get(Job, job_id)
+    if job:
+        return jsonify({"msg": "ok", "result": cancel_job(job).serialize()}), 200
+    return jsonify({"message": "Job not found"}), 404
+
+@app.route('/jobs/<int:job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    if internal_forbidden(required=True):
+        return jsonify({"message": "Forbidden"}), 403
+    job = db.session.get(Job, job_id)
+    path = export_path(job) if job else None
+    if path is None:
+        return jsonify({"message": "No file for this job"}), 404
+    export_format = job.serialize()["params"]["format"]
+    return send_file(path, mimetype=CATALOG_MIMETYPES[export_format], as_attachment=True, download_name='catalog.{}'.format(export_format))
+
+# Change feed
+@app.route('/changes', methods=['GET'])
+@long_lived
+def get_changes():
+    return changes_request()
+
 # User Routes
 @app.route('/users', methods=['GET'])
+@negotiate(columnar=True)
+@conditional('user')
+@cached('user')
 def get_users():
-    users = User.query.all()
-
-    users_serialized = []
-    for user in users:
-        users_serialized.append(user.serialize())
-
-    response_body = {
-        "msg": "ok",
-        "result": users_serialized
-    }
-
-    return jsonify(response_body), 200
+    limit = get_page_args()
+    fields = get_fields(User)
+    listing = get_listing(User)
+    includes = get_includes(User)
+    if wants_stream():
+        return stream_collection(User, fields, listing, includes)
+    users, next_cursor = keyset_page(User, limit, fields, listing)
+    return collection_response(User, fields, users, next_cursor, includes)
 
 @app.route('/user', methods=['POST'])
 def add_user():
     data = request.json
-    new_user = User(name=data['name'], email=data['email'], password=data['password'], is_active=data['is_active'])
+    if not isinstance(data.get('password'), str):
+        raise APIException("password must be a string", status_code=400)
+    new_user = User(name=data['name'], email=data['email'], password=hash_password(data['password']), is_active=data['is_active'])
     db.session.add(new_user)
     db.session.commit()
     return jsonify("User successfully added"), 201
 
 @app.route('/user/<int:user_id>', methods=['GET'])
+@negotiate()
+@conditional('user', 'user_id')
+@cached('user', 'user_id')
 def get_user(user_id):
     user = User.query.get(user_id)
     if user:
@@ -69,19 +234,19 @@ def get_user(user_id):
             "username": user.name,
             "email": user.email,
         }
-        return jsonify({"message": "User founded", "user": user_data}), 200
+        return document_response({"message": "User founded", "user": user_data})
     return jsonify({"message": "User not found"}), 404
 
-@app.route('/user/<int:user_id>', methods=['PUT'])
+@app.route('/user/<int:user_id>', methods=['PUT', 'PATCH'])
 def update_user(user_id):
-    user = User.query.get(user_id)
-    if user:
-        data = request.json
-        user.email = data.get('email', user.email)
-        user.password = data.get('password', user.password)
-        user.is_active = data.get('is_active', user.is_active)
-        db.session.commit()
-        return jsonify({"message": "User updated"}), 200
+    values, tests = update_args(User, ('email', 'password', 'is_active'))
+    if 'password' in values:
+        values['password'] = hash_password(values['password'])
+    if 'password' in tests:
+        raise APIException("password can't be tested", status_code=400)
+    version = conditional_update(User, user_id, values, tests)
+    if version is not None:
+        return updated_response("User updated", 'user', user_id, version)
     return jsonify({"message": "User not found"}), 404
 
 @app.route('/user/<int:user_id>', methods=['DELETE'])
@@ -93,21 +258,34 @@ def delete_user(user_id):
         return jsonify({"message": "User deleted"}), 200
     return jsonify({"message": "User not found"}), 404
 
+@app.route('/login', methods=['POST'])
+def login():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('email'), str) or not isinstance(data.get('password'), str):
+        return jsonify({"message": "email and password are required"}), 400
+    user = User.query.filter_by(email=data['email']).first()
+    if not verify_password(data['password'], user.password if user else None):
+        return jsonify({"message": "Invalid email or password"}), 401
+    if needs_rehash(user.password):
+        # legacy plain text password (or old parameters), upgrade it now that we know it
+        user.password = hash_password(data['password'])
+        db.session.commit()
+    return jsonify({"msg": "ok", "user": user.serialize()}), 200
+
 # Planet Routes
 @app.route('/planets', methods=['GET'])
+@negotiate(columnar=True)
+@conditional('planet')
+@cached('planet')
 def get_planets():
-    planets = Planet.query.all()
-
-    planets_serialized = []
-    for planet in planets:
-        planets_serialized.append(planet.serialize())
-
-    response_body = {
-        "msg": "ok",
-        "result": planets_serialized
-    }
-
-    return jsonify(response_body), 200
+    limit = get_page_args()
+    fields = get_fields(Planet)
+    listing = get_listing(Planet)
+    includes = get_includes(Planet)
+    if wants_stream():
+        return stream_collection(Planet, fields, listing, includes)
+    planets, next_cursor = keyset_page(Planet, limit, fields, listing)
+    return collection_response(Planet, fields, planets, next_cursor, includes)
 
 @app.route('/planet', methods=['POST'])
 def add_planet():
@@ -117,8 +295,18 @@ def add_planet():
     db.session.commit()
     return jsonify("Planet successfully added"), 201
 
+@app.route('/planets/bulk', methods=['POST'])
+def add_planets_bulk():
+    key = 'name' if request.args.get('upsert') == 'true' else None
+    results, counts = bulk_write(Planet, ('name', 'climate', 'population'), ('name',), key=key)
+    return jsonify({"msg": "ok", **counts, "results": results}), 200
+
 @app.route('/planet/<int:planet_id>', methods=['GET'])
+@negotiate()
+@conditional('planet', 'planet_id')
+@cached('planet', 'planet_id')
 def get_planet(planet_id):
+    includes = get_includes(Planet)
     planet = Planet.query.get(planet_id)
     if planet:
         planet_data = {
@@ -126,26 +314,27 @@ def get_planet(planet_id):
             "name": planet.name,
             "climate": planet.climate,
             "population": planet.population,
+            "favorite_count": planet.favorite_count,
         }
-        return jsonify({"message": "Planet found", "planet": planet_data}), 200
+        expand(Planet, [planet_data], includes)
+        return document_response({"message": "Planet found", "planet": planet_data})
     return jsonify({"message": "Planet not found"}), 404
 
-@app.route('/planet/<int:planet_id>', methods=['PUT'])
+@app.route('/planet/<int:planet_id>', methods=['PUT', 'PATCH'])
 def update_planet(planet_id):
-    planet = Planet.query.get(planet_id)
-    if planet:
-        data = request.json
-        planet.name = data.get('name', planet.name)
-        planet.climate = data.get('climate', planet.climate)
-        planet.population = data.get('population', planet.population)
-        db.session.commit()
-        return jsonify({"message": "Planet updated"}), 200
+    values, tests = update_args(Planet, ('name', 'climate', 'population'))
+    version = conditional_update(Planet, planet_id, values, tests)
+    if version is not None:
+        return updated_response("Planet updated", 'planet', planet_id, version)
     return jsonify({"message": "Planet not found"}), 404
 
 @app.route('/planet/<int:planet_id>', methods=['DELETE'])
 def delete_planet(planet_id):
     planet = Planet.query.get(planet_id)
     if planet:
+        # SQLite doesn't enforce the ON DELETE SET NULL
+        for resident in Character.query.filter_by(homeworld_id=planet_id):
+            resident.homeworld_id = None
         db.session.delete(planet)
         db.session.commit()
         return jsonify({"message": "Planet deleted"}), 200
@@ -153,31 +342,48 @@ def delete_planet(planet_id):
 
 # Character Routes
 @app.route('/characters', methods=['GET'])
+@negotiate(columnar=True)
+@conditional('character')
+@cached('character')
 def get_characters():
-    characters = Character.query.all()
-
-    characters_serialized = []
-    for character in characters:
-        characters_serialized.append(character.serialize())
-
-    response_body = {
-        "msg": "ok",
-        "result": characters_serialized
-    }
-
-    return jsonify(response_body), 200
+    limit = get_page_args()
+    fields = get_fields(Character)
+    listing = get_listing(Character)
+    includes = get_includes(Character)
+    if wants_stream():
+        return stream_collection(Character, fields, listing, includes)
+    characters, next_cursor = keyset_page(Character, limit, fields, listing)
+    return collection_response(Character, fields, characters, next_cursor, includes)
+
+def homeworld_arg(data, current=None):
+    """homeworld_id of a character body ("homeworld" is accepted too), the planet must exist"""
+    homeworld_id = data.get('homeworld_id', data.get('homeworld', current))
+    if homeworld_id is not None and (not isinstance(homeworld_id, int) or isinstance(homeworld_id, bool)):
+        raise APIException("homeworld_id must be an integer", status_code=400)
+    if homeworld_id is not None and homeworld_id != current and Planet.query.get(homeworld_id) is None:
+        raise APIException("Planet {} not found".format(homeworld_id), status_code=400)
+    return homeworld_id
 
-    
 @app.route('/character', methods=['POST'])
 def add_characters():
     data = request.json
-    new_character = Character(name=data['name'], species=data['species'], homeworld=data['homeworld'])
+    new_character = Character(name=data['name'], species=data['species'], gender=data.get('gender'), homeworld_id=homeworld_arg(data))
     db.session.add(new_character)
     db.session.commit()
     return jsonify("Character successfully added"), 201
 
+@app.route('/characters/bulk', methods=['POST'])
+def add_characters_bulk():
+    key = 'name' if request.args.get('upsert') == 'true' else None
+    results, counts = bulk_write(Character, ('name', 'species', 'gender', 'homeworld_id'), ('name',), key=key)
+    return jsonify({"msg": "ok", **counts, "results": results}), 200
+
 @app.route('/character/<int:character_id>', methods=['GET'])
+@negotiate()
+@conditional('character', 'character_id')
+@cached('character', 'character_id')
 def get_character(character_id):
+    includes = get_includes(Character)
     character = Character.query.get(character_id)
     if character:
         character_data = {
@@ -185,31 +391,92 @@ def get_character(character_id):
             "name": character.name,
             "species": character.species,
             "gender": character.gender,
+            "homeworld_id": character.homeworld_id,
+            "favorite_count": character.favorite_count,
         }
-        return jsonify({"message": "Character found", "character": character_data}), 200
+        expand(Character, [character_data], includes)
+        return document_response({"message": "Character found", "character": character_data})
     return jsonify({"message": "Character not found"}), 404
 
-@app.route('/character/<int:character_id>', methods=['PUT'])
+@app.route('/character/<int:character_id>', methods=['PUT', 'PATCH'])
 def update_character(character_id):
-    character = Character.query.get(character_id)
-    if character:
-        data = request.json
-        character.name = data.get('name', character.name)
-        character.species = data.get('species', character.species)
-        character.homeworld = data.get('homeworld', character.homeworld)
-        db.session.commit()
-        return jsonify({"message": "Character updated"}), 200
+    values, tests = update_args(Character, ('name', 'species', 'gender', 'homeworld_id', 'homeworld'))
+    if 'homeworld' in values or 'homeworld_id' in values:
+        values['homeworld_id'] = homeworld_arg(values)
+        values.pop('homeworld', None)
+    if 'homeworld' in tests:
+        tests['homeworld_id'] = tests.pop('homeworld')
+    version = conditional_update(Character, character_id, values, tests)
+    if version is not None:
+        return updated_response("Character updated", 'character', character_id, version)
     return jsonify({"message": "Character not found"}), 404
 
 @app.route('/character/<int:character_id>', methods=['DELETE'])
 def delete_character(character_id):
     character = Character.query.get(character_id)
     if character:
+        # SQLite doesn't enforce the ON DELETE CASCADE
+        for pilot in VehiclePilot.query.filter_by(character_id=character_id):
+            db.session.delete(pilot)
         db.session.delete(character)
         db.session.commit()
         return jsonify({"message": "Character deleted"}), 200
     return jsonify({"message": "Character not found"}), 404
 
+# Vehicle/Starship Routes
+@app.route('/vehicles_starships/bulk', methods=['POST'])
+def add_vehicles_starships_bulk():
+    key = 'name' if request.args.get('upsert') == 'true' else None
+    results, counts = bulk_write(Vehicle_Starship, ('name',), ('name',), key=key)
+    return jsonify({"msg": "ok", **counts, "results": results}), 200
+
+@app.route('/vehicle_starship/<int:vehicle_starship_id>/pilots/<int:character_id>', methods=['POST'])
+def add_pilot(vehicle_starship_id, character_id):
+    if Vehicle_Starship.query.get(vehicle_starship_id) is None:
+        return jsonify({"message": "Vehicle starship not found"}), 404
+    if Character.query.get(character_id) is None:
+        return jsonify({"message": "Character not found"}), 404
+    if VehiclePilot.query.filter_by(vehicle_starship_id=vehicle_starship_id, character_id=character_id).first() is None:
+        db.session.add(VehiclePilot(vehicle_starship_id=vehicle_starship_id, character_id=character_id))
+        db.session.commit()
+    return jsonify({"msg": "ok"}), 200
+
+@app.route('/vehicle_starship/<int:vehicle_starship_id>/pilots/<int:character_id>', methods=['DELETE'])
+def remove_pilot(vehicle_starship_id, character_id):
+    pilot = VehiclePilot.query.filter_by(vehicle_starship_id=vehicle_starship_id, character_id=character_id).first()
+    if pilot is None:
+        return jsonify({"message": "Pilot not found"}), 404
+    db.session.delete(pilot)
+    db.session.commit()
+    return jsonify({"msg": "ok"}), 200
+
+# Search Routes
+@app.route('/search', methods=['GET'])
+def search_catalog():
+    q = request.args.get('q', '').strip()
+    if not q or len(q) > 200:
+        return jsonify({"message": "q is required and must be at most 200 characters"}), 400
+    kinds = [kind for kind in request.args.get('type', ','.join(SEARCH_KINDS)).split(',') if kind]
+    if not kinds or any(kind not in SEARCH_KINDS for kind in kinds):
+        return jsonify({"message": "type must be a list of: {}".format(", ".join(SEARCH_KINDS))}), 400
+    limit, offset = get_offset_args()
+    results, next_offset = search(q, kinds, limit, offset)
+    return jsonify({"msg": "ok", "result": results, "next_offset": next_offset}), 200
+
+@app.route('/vehicles_starships', methods=['GET'])
+@negotiate(columnar=True)
+@conditional('vehicle_starship')
+@cached('vehicle_starship')
+def get_vehicles_starships():
+    limit = get_page_args()
+    fields = get_fields(Vehicle_Starship)
+    listing = get_listing(Vehicle_Starship)
+    includes = get_includes(Vehicle_Starship)
+    if wants_stream():
+        return stream_collection(Vehicle_Starship, fields, listing, includes)
+    vehicles_starships, next_cursor = keyset_page(Vehicle_Starship, limit, fields, listing)
+    return collection_response(Vehicle_Starship, fields, vehicles_starships, next_cursor, includes)
+
 # Favorite Routes
 
 @app.route('/user/favorites', methods=['GET'])
@@ -222,23 +489,66 @@ def favorites_user():
     user = User.query.get(body['user_id'])
     if user is None:
         return jsonify({'msg': "El usuario con el id {} no existe".format(body['user_id'])}), 404
-    favorite_planets = db.session.query(FavoritePlanet, Planet).join(Planet).filter(FavoritePlanet.user_id==body['user_id']).all()
-    favorite_planets_serialized = []
-    for favorite_item, planet_item in favorite_planets:
-        favorite_planets_serialized.append({"favorite_planet_id": favorite_item.id, "planet": planet_item.serialize()})
-        return jsonify({"msg": "ok", "results": favorite_planets_serialized})
-    favorite_character= db.session.query(FavoriteCharacter, Character).join(Character).filter(FavoriteCharacter.user_id==body['user_id']).all()
-    favorite_character_serialized = []
-    for favorite_item, character_item in favorite_character:
-        favorite_character_serialized.append({"favorite_character_id": favorite_item.id, "character": character_item.serialize()})
-        return jsonify({"msg": "ok", "results": favorite_character_serialized})
-    favorite_vehicle_starship= db.session.query(FavoriteVehicleStarship, Vehicle_Starship).join(Vehicle_Starship).filter(FavoriteVehicleStarship.user_id==body['user_id']).all()
-    favorite_vehicle_starship_serialized = []
-    for favorite_item, vehicle_starship_item in favorite_vehicle_starship:
-        favorite_vehicle_starship_serialized.append({"favorite_vehicle_starship_id": favorite_item.id, "starship": vehicle_starship_item.serialize()})
-        return jsonify({"msg": "ok", "results": favorite_vehicle_starship_serialized})
-    print(user)
-    return jsonify({'msg': 'ok'})
+    limit, offset = get_offset_args()
+    flush_users([user.id])
+    favorites, next_offset = load_favorites([user.id], limit, offset)
+    return jsonify({"msg": "ok", "results": favorites[user.id], "next_offset": next_offset}), 200
+
+@app.route('/users/favorites', methods=['POST'])
+def favorites_users():
+    body = request.get_json(silent=True)
+    if body is None:
+        return jsonify({'msg': "debes enviar informacion en el body"}), 400
+    user_ids, error = validate_user_ids(body)
+    if error:
+        return jsonify({'msg': error}), 400
+    limit, offset = get_offset_args()
+    flush_users(user_ids)
+    favorites, next_offset = load_favorites(user_ids, limit, offset)
+    return jsonify({"msg": "ok", "results": favorites, "next_offset": next_offset}), 200
+
+def queue_favorite(user_id, kind, target_id, op):
+    if kind not in FAVORITE_TARGETS:
+        return jsonify({"message": "kind must be one of: {}".format(", ".join(FAVORITE_TARGETS))}), 400
+    if User.query.get(user_id) is None:
+        return jsonify({"message": "User not found"}), 404
+    target_model = FAVORITE_TARGETS[kind][2]
+    if op == 'add' and target_model.query.get(target_id) is None:
+        return jsonify({"message": "{} not found".format(kind.replace('_', ' ').capitalize())}), 404
+    favorite_writes.submit(user_id, kind, target_id, op)
+    if favorite_writes.durability == 'batched':
+        return jsonify({"msg": "queued"}), 202
+    return jsonify({"msg": "ok"}), 200
+
+@app.route('/user/<int:user_id>/favorites/<kind>/<int:target_id>', methods=['POST'])
+def add_favorite(user_id, kind, target_id):
+    return queue_favorite(user_id, kind, target_id, 'add')
+
+@app.route('/user/<int:user_id>/favorites/<kind>/<int:target_id>', methods=['DELETE'])
+def remove_favorite(user_id, kind, target_id):
+    return queue_favorite(user_id, kind, target_id, 'remove')
+
+# Leaderboard Routes
+@app.route('/leaderboards/planets', methods=['GET'])
+@negotiate()
+@conditional('planet')
+@cached('planet')
+def get_planets_leaderboard():
+    return document_response({"msg": "ok", "result": leaderboard(Planet, parse_leaderboard_size(request.args))})
+
+@app.route('/leaderboards/characters', methods=['GET'])
+@negotiate()
+@conditional('character')
+@cached('character')
+def get_characters_leaderboard():
+    return document_response({"msg": "ok", "result": leaderboard(Character, parse_leaderboard_size(request.args))})
+
+@app.route('/leaderboards/vehicles_starships', methods=['GET'])
+@negotiate()
+@conditional('vehicle_starship')
+@cached('vehicle_starship')
+def get_vehicles_starships_leaderboard():
+    return document_response({"msg": "ok", "result": leaderboard(Vehicle_Starship, parse_leaderboard_size(request.args))})
 
     
 
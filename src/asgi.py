@@ -0,0 +1,262 @@
+"""
+Async (ASGI) entry point. The read endpoints run as async handlers on an
+async SQLAlchemy engine, so one worker multiplexes many slow queries on its
+event loop. Every other route is passed to the regular Flask app, which runs
+in a thread pool. The native handlers still run inside a Flask request
+context with the app's before / after request hooks, so admission control,
+metrics, Server-Timing and CORS apply to them as to the Flask routes. They
+don't go through the response cache (cache.py): they answer from the
+database, with the same ETags, so conditional requests still get 304s. Run it
+with:
+
+    $ uvicorn asgi:application --app-dir src --port 3000
+
+The WSGI entry point (wsgi.py) is unchanged and stays the default.
+"""
+import os
+import re
+import json
+import asyncio
+from urllib.parse import parse_qsl
+from email.utils import parsedate_to_datetime
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.test import EnvironBuilder
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from app import app as flask_app
+from models import User, Planet, Character, Vehicle_Starship
+from utils import APIException
+from pagination import parse_page_args, parse_offset_args, keyset_statement, split_page
+from favorites import favorites_statement, group_favorites, validate_user_ids
+from favorite_writes import flush_users
+from versioning import depends_on, table_versions_statement, read_table_versions, row_versions_statement, read_row_versions, resource_etag
+from pool import async_engine_options
+from serialization import encode, parse_fields, rows_to_dicts
+from filters import parse_listing
+from formats import negotiate_format, JSON
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+}
+
+def async_database_url(url):
+    scheme, rest = url.split('://', 1)
+    return ASYNC_DRIVERS.get(scheme.split('+')[0], scheme) + '://' + rest
+
+database_url = flask_app.config['SQLALCHEMY_DATABASE_URI']
+engine = create_async_engine(async_database_url(database_url), **async_engine_options(database_url))
+Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+wsgi_fallback = WsgiToAsgi(flask_app)
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope['query_string'].decode('latin-1')
+        # like Flask's request.args: blank values kept, repeated keys too (get() returns the first)
+        self.args = MultiDict(parse_qsl(self.query_string, keep_blank_values=True))
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.body = body
+
+    @property
+    def full_path(self):
+        # same as werkzeug's Request.full_path, so ETags match the WSGI ones
+        return self.path + '?' + self.query_string
+
+    def json(self):
+        try:
+            return json.loads(self.body) if self.body else None
+        except ValueError:
+            return None
+
+async def not_modified_or_etag(session, request, table, row_id=None):
+    """Returns (etag, last_modified, not_modified) as the versioning.conditional decorator does"""
+    # runs in the Flask request context of the request, see application
+    tables = depends_on(table, row_id is not None)
+    row_version = None
+    if row_id is None:
+        versions = read_table_versions((await session.execute(table_versions_statement(tables))).all(), tables)
+    else:
+        rows = (await session.execute(row_versions_statement(table, row_id, tables))).all()
+        row_version, versions = read_row_versions(rows, tables)
+    etag, updated_at = resource_etag(tables, versions, request.full_path, row_id is not None, row_version)
+    if_none_match = request.headers.get('if-none-match')
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_none_match:
+        not_modified = if_none_match.strip() == '*' or etag in [tag.strip().strip('"') for tag in if_none_match.split(',')]
+    elif if_modified_since and updated_at is not None:
+        try:
+            not_modified = updated_at.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since).replace(tzinfo=None)
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+    return etag, updated_at, not_modified
+
+def collection_handler(model, table):
+    async def handler(request, session):
+        limit = parse_page_args(request.args)
+        fields = parse_fields(model, request.args.get('fields'))
+        listing = parse_listing(model, request.args)
+        etag, updated_at, not_modified = await not_modified_or_etag(session, request, table)
+        if not_modified:
+            return 304, None, etag, updated_at
+        rows = (await session.execute(keyset_statement(model, limit, fields, listing))).all()
+        rows, next_cursor = split_page(rows, limit, listing)
+        body = {"msg": "ok", "result": rows_to_dicts(fields, rows), "next": next_cursor}
+        return 200, body, etag, updated_at
+    return handler
+
+def detail_handler(model, table, label, found_message, not_found_message, fields):
+    async def handler(request, session, row_id):
+        etag, updated_at, not_modified = await not_modified_or_etag(session, request, table, int(row_id))
+        if not_modified:
+            return 304, None, etag, updated_at
+        row = await session.get(model, int(row_id))
+        if row is None:
+            return 404, {"message": not_found_message}, None, None
+        data = {key: getattr(row, attribute) for key, attribute in fields}
+        return 200, {"message": found_message, label: data}, etag, updated_at
+    return handler
+
+async def favorites_user(request, session):
+    body = request.json()
+    if body is None:
+        return 400, {'msg': "debes enviar informacion en el body"}, None, None
+    if 'user_id' not in body:
+        return 400, {'msg': 'El campo user_id es obligatorio'}, None, None
+    user = await session.get(User, body['user_id'])
+    if user is None:
+        return 404, {'msg': "El usuario con el id {} no existe".format(body['user_id'])}, None, None
+    limit, offset = parse_offset_args(request.args)
+    await asyncio.to_thread(flush_users, [user.id])
+    rows = (await session.execute(favorites_statement([user.id], limit, offset))).all()
+    favorites, next_offset = group_favorites(rows, [user.id], limit, offset)
+    return 200, {"msg": "ok", "results": favorites[user.id], "next_offset": next_offset}, None, None
+
+async def favorites_users(request, session):
+    body = request.json()
+    if body is None:
+        return 400, {'msg': "debes enviar informacion en el body"}, None, None
+    user_ids, error = validate_user_ids(body)
+    if error:
+        return 400, {'msg': error}, None, None
+    limit, offset = parse_offset_args(request.args)
+    await asyncio.to_thread(flush_users, user_ids)
+    rows = (await session.execute(favorites_statement(user_ids, limit, offset))).all()
+    favorites, next_offset = group_favorites(rows, user_ids, limit, offset)
+    return 200, {"msg": "ok", "results": favorites, "next_offset": next_offset}, None, None
+
+# (method, path pattern, handler). Streaming and the write endpoints stay on Flask
+ROUTES = [
+    ('GET', r'/users', collection_handler(User, 'user')),
+    ('GET', r'/user/(?P<row_id>\d+)', detail_handler(User, 'user', 'user', "User founded", "User not found",
+                                                       (('id', 'id'), ('username', 'name'), ('email', 'email')))),
+    ('GET', r'/planets', collection_handler(Planet, 'planet')),
+    ('GET', r'/planet/(?P<row_id>\d+)', detail_handler(Planet, 'planet', 'planet', "Planet found", "Planet not found",
+                                                         (('id', 'id'), ('name', 'name'), ('climate', 'climate'), ('population', 'population'), ('favorite_count', 'favorite_count')))),
+    ('GET', r'/characters', collection_handler(Character, 'character')),
+    ('GET', r'/character/(?P<row_id>\d+)', detail_handler(Character, 'character', 'character', "Character found", "Character not found",
+                                                            (('id', 'id'), ('name', 'name'), ('species', 'species'), ('gender', 'gender'), ('homeworld_id', 'homeworld_id'), ('favorite_count', 'favorite_count')))),
+    ('GET', r'/vehicles_starships', collection_handler(Vehicle_Starship, 'vehicle_starship')),
+    ('GET', r'/user/favorites', favorites_user),
+    ('POST', r'/users/favorites', favorites_users),
+]
+ROUTES = [(method, re.compile('^' + pattern + '/?$'), handler) for method, pattern, handler in ROUTES]
+
+def accept_header(scope):
+    for name, value in scope['headers']:
+        if name == b'accept':
+            return value.decode('latin-1')
+    return None
+
+def match_route(scope):
+    if scope['type'] != 'http':
+        return None, None
+    for method, pattern, handler in ROUTES:
+        match = pattern.match(scope['path'])
+        if match and scope['method'] == method:
+            # the Flask streaming mode keeps serving ?stream=true and ?include=, Flask also serves the binary formats
+            keys = {key for key, value in parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True)}
+            if keys & {'stream', 'include'} or negotiate_format(accept_header(scope), columnar=True) != JSON:
+                return None, None
+            return handler, match.groupdict()
+    return None, None
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+def flask_environ(scope, body):
+    """WSGI environ of an ASGI request, for the Flask request context the native handlers run in"""
+    client = scope.get('client')
+    return EnvironBuilder(
+        path=scope['path'],
+        method=scope['method'],
+        query_string=scope['query_string'].decode('latin-1'),
+        headers=Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']]),
+        data=body,
+        environ_base={'REMOTE_ADDR': client[0]} if client else None,
+    ).get_environ()
+
+def json_response(status, body, etag=None, last_modified=None):
+    response = flask_app.response_class(encode(body) if body is not None else b'', status=status, mimetype='application/json')
+    response.vary.add('Accept')
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified.replace(microsecond=0)
+    return response
+
+async def dispatch(request, handler, params):
+    """Runs a native handler between the before and after request hooks of the Flask app"""
+    try:
+        # admission may wait for a concurrency slot, off the event loop
+        response = await asyncio.to_thread(flask_app.preprocess_request)
+        if response is None:
+            async with Session() as session:
+                response = json_response(*await handler(request, session, **params))
+        else:
+            response = flask_app.make_response(response)
+    except APIException as error:
+        response = flask_app.make_response(flask_app.handle_user_exception(error))
+    return flask_app.process_response(response)
+
+async def send_response(send, response):
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response.headers.items()]
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    handler, params = match_route(scope)
+    if handler is None:
+        return await wsgi_fallback(scope, receive, send)
+    body = await read_body(receive)
+    # popping the context runs the teardown hooks, which free the admission slot
+    with flask_app.request_context(flask_environ(scope, body)):
+        response = await dispatch(Request(scope, body), handler, params)
+        await send_response(send, response)
+
+# this only runs if `$ python src/asgi.py` is executed
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application, host='0.0.0.0', port=int(os.environ.get('PORT', 3000)))
@@ -0,0 +1,224 @@
+"""
+Bulk create / upsert of catalog rows from a JSON array or an NDJSON stream,
+written in batched executemany statements inside a single transaction
+"""
+import json
+from flask import request
+from sqlalchemy import select, insert, update, bindparam, func
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from models import db
+from utils import APIException
+import tracking
+
+BATCH_SIZE = 1000
+# bound parameters per statement, the lowest default of the SQLite versions still around
+SQLITE_MAX_VARIABLES = 999
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl', 'application/json-seq')
+
+def read_items():
+    """Yields (index, item) from the request body, item is None for lines that are not valid JSON"""
+    if request.mimetype in NDJSON_MIMETYPES:
+        index = 0
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                yield index, json.loads(line)
+            except ValueError:
+                yield index, None
+            index += 1
+        return
+    body = request.get_json(silent=True)
+    if not isinstance(body, list):
+        raise APIException("the body must be a JSON array or an NDJSON stream", status_code=400)
+    for index, item in enumerate(body):
+        yield index, item
+
+def insert_ignoring_duplicates(table, dialect):
+    """INSERT that skips rows conflicting with a unique constraint"""
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return insert(table).prefix_with('OR IGNORE')
+    return insert(table).prefix_with('IGNORE')
+
+def _batches(items):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _validate(item, fields, required):
+    if not isinstance(item, dict):
+        return None, "item must be a JSON object"
+    missing = [field for field in required if item.get(field) is None]
+    if missing:
+        return None, "missing required fields: {}".format(", ".join(missing))
+    if any(isinstance(item.get(field), (dict, list)) for field in fields):
+        return None, "fields must be plain values"
+    return {field: item[field] for field in fields if field in item}, None
+
+def unique_fields(table, fields):
+    """The fields whose value is unique on its own (unique column or single-column unique index)"""
+    return [
+        field for field in fields
+        if table.c[field].unique or any(index.unique and list(index.columns) == [table.c[field]] for index in table.indexes)
+    ]
+
+def _foreign_keys(table, fields):
+    """{field: referenced column} of the fields pointing to another table"""
+    return {field: next(iter(table.c[field].foreign_keys)).column for field in fields if table.c[field].foreign_keys}
+
+def _is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _check_references(valid, references):
+    """Errors of the items whose foreign keys point to no row, {index: error}"""
+    errors = {}
+    for field, column in references.items():
+        wanted = {values[field] for index, values in valid if _is_id(values.get(field))}
+        found = set(db.session.execute(select(column).where(column.in_(wanted))).scalars()) if wanted else set()
+        for index, values in valid:
+            value = values.get(field)
+            if value is None or index in errors:
+                continue
+            if not _is_id(value):
+                errors[index] = "{} must be an integer".format(field)
+            elif value not in found:
+                errors[index] = "{} {} does not exist".format(field, value)
+    return errors
+
+def _check_unique(table, valid, fields, seen):
+    """
+    Errors of the items repeating a unique value, of an existing row or of an
+    earlier item (`seen`, {field: values}, spans the batches), {index: error}
+    """
+    errors = {}
+    for field in fields:
+        wanted = {values[field] for index, values in valid if values.get(field) is not None}
+        taken = set(db.session.execute(select(table.c[field]).where(table.c[field].in_(wanted))).scalars()) if wanted else set()
+        earlier = seen.setdefault(field, set())
+        for index, values in valid:
+            value = values.get(field)
+            if value is None or index in errors:
+                continue
+            if value in taken:
+                errors[index] = "{} {!r} already exists".format(field, value)
+            elif value in earlier:
+                errors[index] = "{} {!r} repeats an earlier item".format(field, value)
+            else:
+                earlier.add(value)
+    return errors
+
+def insert_rows(table, rows):
+    """Inserts `rows` (dicts with the same keys), returns their new ids in the same order"""
+    session = db.session
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # ids taken from the sequence first, so each row's id is known
+        sequence = func.pg_get_serial_sequence(table.name, 'id')
+        ids = session.execute(select(func.nextval(sequence)).select_from(func.generate_series(1, len(rows)))).scalars().all()
+        session.execute(insert(table), [dict(row, id=row_id) for row, row_id in zip(rows, ids)])
+        return ids
+    if dialect == 'sqlite':
+        ids = []
+        # one multi-row INSERT per chunk: with a single writer its rows get consecutive rowids
+        per_statement = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+        for start in range(0, len(rows), per_statement):
+            chunk = rows[start:start + per_statement]
+            session.execute(insert(table).values(chunk))
+            last = session.execute(select(func.last_insert_rowid())).scalar()
+            ids += range(last - len(chunk) + 1, last + 1)
+        return ids
+    return [session.execute(insert(table).values(row)).inserted_primary_key[0] for row in rows]
+
+def bulk_write(model, fields, required, key=None):
+    """
+    Inserts every valid item of the request. With `key` (a unique column such
+    as the name of a vehicle), items whose key already exists are updated
+    instead. Items repeating a unique value or pointing to a missing row are
+    reported as errors. Returns the per-item results, with the id of each row
+    written; the whole request is one transaction.
+    """
+    table = model.__table__
+    if key is not None and not unique_fields(table, (key,)):
+        raise APIException("upsert needs a unique key, {} of {} is not unique".format(key, table.name), status_code=400)
+    references = _foreign_keys(table, fields)
+    checked_unique = [field for field in unique_fields(table, fields) if field != key]
+    seen = {}
+    results = []
+    counts = {"created": 0, "updated": 0, "error": 0}
+    try:
+        for batch in _batches(read_items()):
+            valid = []
+            for index, item in batch:
+                values, error = _validate(item, fields, required) if item is not None else (None, "invalid JSON")
+                if error:
+                    results.append({"index": index, "status": "error", "error": error})
+                    counts["error"] += 1
+                else:
+                    valid.append((index, values))
+            errors = _check_references(valid, references)
+            errors.update(_check_unique(table, [(index, values) for index, values in valid if index not in errors], checked_unique, seen))
+            for index, error in errors.items():
+                results.append({"index": index, "status": "error", "error": error})
+                counts["error"] += 1
+            valid = [(index, values) for index, values in valid if index not in errors]
+
+            existing = {}
+            if key is not None:
+                keys = {values[key] for index, values in valid}
+                existing = dict(db.session.execute(select(table.c[key], table.c.id).where(table.c[key].in_(keys))).all())
+
+            inserts = {}
+            inserted_results = {}
+            updates = {}
+            for index, values in valid:
+                if key is not None and values[key] in existing:
+                    # rows with the same set of columns go in the same executemany
+                    updates.setdefault(tuple(sorted(values)), []).append(dict(values, _id=existing[values[key]]))
+                    results.append({"index": index, "status": "updated", "id": existing[values[key]]})
+                    counts["updated"] += 1
+                elif key is not None and values[key] in inserts:
+                    # repeated key in the same batch, the last item wins
+                    inserts[values[key]].update(values)
+                    result = {"index": index, "status": "updated"}
+                    inserted_results[values[key]].append(result)
+                    results.append(result)
+                    counts["updated"] += 1
+                else:
+                    item_key = values[key] if key is not None else index
+                    inserts[item_key] = {field: values.get(field) for field in fields}
+                    result = {"index": index, "status": "created"}
+                    inserted_results[item_key] = [result]
+                    results.append(result)
+                    counts["created"] += 1
+
+            if inserts:
+                for item_key, new_id in zip(inserts, insert_rows(table, list(inserts.values()))):
+                    for result in inserted_results[item_key]:
+                        result["id"] = new_id
+            for columns, rows in updates.items():
+                statement = update(table).where(table.c.id == bindparam('_id')).values({column: bindparam(column) for column in columns})
+                if 'version' in table.c:
+                    statement = statement.values(version=table.c.version + 1)
+                db.session.execute(statement, rows)
+        if counts["created"] or counts["updated"]:
+            tracking.record_write(db.session, table.name, op='bulk')
+        db.session.commit()
+    except APIException:
+        db.session.rollback()
+        raise
+    except SQLAlchemyError as error:
+        db.session.rollback()
+        raise APIException(
+            "bulk write failed, nothing was saved: {}".format(error.__class__.__name__),
+            status_code=409 if isinstance(error, IntegrityError) else 400
+        )
+    results.sort(key=lambda result: result["index"])
+    return results, counts
@@ -0,0 +1,162 @@
+"""
+Read-through response cache for the GET endpoints, with TTL + LRU eviction.
+
+Entries are keyed on the ETag @conditional computes from the table and row
+versions stored in the database, so a write committed by any worker or host
+moves the readers to new keys: a cached body is never older than the
+versions read for the request, whatever the backend.
+"""
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request, make_response, g
+from replicas import cache_ttl
+
+class MemoryBackend:
+    """
+    In-process LRU cache. Every worker keeps its own copy, a shared backend
+    saves the other workers from rendering the same responses again.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class SQLiteBackend:
+    """
+    Cache shared by all the workers of a host, stored in a SQLite file.
+    Good as a local stand-in for a shared cache server.
+    """
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value BLOB, expires_at REAL, accessed_at REAL)"
+        )
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        connection = self._connection()
+        row = connection.execute("SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] < now:
+            connection.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            return None
+        connection.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO response_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, pickle.dumps(value), now + ttl if ttl else None, now)
+        )
+        # evict the least recently used entries once over the limit
+        connection.execute(
+            "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+class RedisBackend:
+    """
+    Cache shared by every worker and host. LRU eviction is left to the
+    server (maxmemory-policy allkeys-lru).
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, pickle.dumps(value), ex=int(ttl) if ttl else None)
+
+class ResponseCache:
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+
+    def key(self, table, pk, etag):
+        return "{}:{}:{}".format(table, pk if pk is not None else "list", etag)
+
+def setup_cache(app):
+    backend_name = os.environ.get('CACHE_BACKEND', 'memory')
+    if backend_name == 'none':
+        return
+    max_entries = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+    if backend_name == 'sqlite':
+        backend = SQLiteBackend(os.environ.get('CACHE_URL', '/tmp/response_cache.db'), max_entries)
+    elif backend_name == 'redis':
+        backend = RedisBackend(os.environ.get('CACHE_URL', 'redis://localhost:6379/0'))
+    else:
+        backend = MemoryBackend(max_entries)
+    cache = ResponseCache(backend, ttl=int(os.environ.get('CACHE_TTL', 300)))
+    app.extensions['response_cache'] = cache
+
+def cached(table, id_arg=None):
+    """
+    Caches the successful responses of a GET endpoint, under its
+    @conditional. `table` is the table the endpoint reads, `id_arg` the view
+    argument holding the row id for detail endpoints.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = current_app.extensions.get('response_cache')
+            etag = g.get('resource_etag')
+            if cache is None or etag is None or 'stream' in request.args:
+                return view(*args, **kwargs)
+            key = cache.key(table, kwargs.get(id_arg) if id_arg else None, etag)
+            hit = cache.backend.get(key)
+            if hit is not None:
+                body, status, mimetype = hit
+                response = current_app.response_class(body, status=status, mimetype=mimetype)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                cache.backend.set(key, (response.get_data(), response.status_code, response.mimetype), cache_ttl(cache.ttl))
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
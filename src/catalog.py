@@ -0,0 +1,316 @@
+"""
+Export and import of the whole catalog as NDJSON or CSV, over HTTP
+(/export, /import) and with `flask catalog export|import`.
+
+NDJSON holds every table, one {"table": ..., "row": {...}} per line, parents
+before children so the file can be imported in order. CSV holds one table
+with a header line; empty fields are NULL.
+
+Exports read from a server-side cursor in chunks and imports insert in
+chunks of CHUNK_SIZE records, so memory stays flat whatever the size. Each
+import chunk is committed together with its checkpoint (records done and
+their end offset in the input): a failed import is resumed by sending the
+same input again with the same import_id, committed records are skipped.
+The CLI seeks straight to the offset instead of reading the skipped part.
+
+/export and /import need the X-Internal-Token header and are refused while
+INTERNAL_STATS_TOKEN is unset.
+
+User password hashes are only exported by the CLI. An HTTP export imports
+back over HTTP as is: a user row without a password is created disabled
+(is_active false) with a password nothing verifies against, until it is given
+a new one with PUT /user/<id>. With on_conflict=skip existing users keep
+their password. The CLI round trip keeps the hashes.
+"""
+import io
+import csv
+import json
+from datetime import datetime
+import click
+from flask import request
+from flask.cli import AppGroup
+from sqlalchemy import select, insert, text
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from models import db, User, Planet, Character, Vehicle_Starship, VehiclePilot, FavoritePlanet, FavoriteCharacter, FavoriteVehicleStarship, ImportCheckpoint
+from serialization import encode
+from passwords import is_hashed, unusable_password
+from bulk import insert_ignoring_duplicates
+from utils import APIException
+import tracking
+
+# parents before children, the import order of an NDJSON export
+EXPORT_MODELS = (User, Planet, Character, Vehicle_Starship, VehiclePilot, FavoritePlanet, FavoriteCharacter, FavoriteVehicleStarship)
+TABLES = {model.__tablename__: model.__table__ for model in EXPORT_MODELS}
+SECRET_COLUMNS = {'user': {'password'}}
+CHUNK_SIZE = 1000
+FORMATS = ('ndjson', 'csv')
+CONFLICT_MODES = ('error', 'skip')
+MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+catalog_cli = AppGroup('catalog', help="Catalog export and import")
+
+def parse_tables(names, csv_format):
+    tables = [name for name in (names or '').split(',') if name] or list(TABLES)
+    unknown = [name for name in tables if name not in TABLES]
+    if unknown:
+        raise APIException("unknown tables: {}".format(", ".join(unknown)), status_code=400)
+    if csv_format and len(tables) != 1:
+        raise APIException("a CSV export holds exactly one table, pass ?tables=<name>", status_code=400)
+    return tables
+
+def export_columns(table_name, with_secrets):
+    hidden = set() if with_secrets else SECRET_COLUMNS.get(table_name, set())
+    return [column for column in TABLES[table_name].columns if column.key not in hidden]
+
+def _chunks(table_name, with_secrets):
+    """Yields (column names, rows) chunks of a table, from a server-side cursor"""
+    columns = export_columns(table_name, with_secrets)
+    statement = select(*columns).order_by(TABLES[table_name].c.id)
+    result = db.session.execute(statement.execution_options(stream_results=True, yield_per=CHUNK_SIZE))
+    names = [column.key for column in columns]
+    for chunk in result.partitions(CHUNK_SIZE):
+        yield names, chunk
+
+def export_ndjson(tables, with_secrets=False):
+    for table_name in tables:
+        for names, chunk in _chunks(table_name, with_secrets):
+            yield b''.join(encode({"table": table_name, "row": dict(zip(names, row))}) + b'\n' for row in chunk)
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+def export_csv(table_name, with_secrets=False):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.key for column in export_columns(table_name, with_secrets)])
+    for names, chunk in _chunks(table_name, with_secrets):
+        writer.writerows([[_csv_value(value) for value in row] for row in chunk])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # the header of an empty table
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def _counted_lines(stream, position):
+    """Decoded lines of a binary stream, position['offset'] is kept at the end of the last line read"""
+    for line in stream:
+        position['offset'] += len(line)
+        yield line.decode('utf-8')
+
+def read_ndjson(stream, offset=0):
+    """Yields (table name, row, end offset) from NDJSON lines"""
+    position = {'offset': offset}
+    for line in _counted_lines(stream, position):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            table_name, row = record['table'], record['row']
+        except (ValueError, TypeError, KeyError):
+            raise ValueError("invalid NDJSON record")
+        yield table_name, row, position['offset']
+
+def read_csv_header(line):
+    return next(csv.reader([line.decode('utf-8')]))
+
+def read_csv(stream, table_name, offset=0, header=None):
+    """Yields (table name, row, end offset) from CSV lines, the header comes first unless given"""
+    position = {'offset': offset}
+    reader = csv.reader(_counted_lines(stream, position))
+    if header is None:
+        header = next(reader, None)
+        if header is None:
+            return
+    for values in reader:
+        if len(values) != len(header):
+            raise ValueError("expected {} fields, got {}".format(len(header), len(values)))
+        yield table_name, dict(zip(header, values)), position['offset']
+
+def _coerce_csv(column, value):
+    if value == '':
+        return None
+    python_type = column.type.python_type
+    if python_type is bool:
+        return value.lower() in ('true', '1')
+    return python_type(value)
+
+def _prepare(table_name, row, from_csv, trusted):
+    table = TABLES.get(table_name)
+    if table is None:
+        raise ValueError("unknown table {}".format(table_name))
+    if not isinstance(row, dict):
+        raise ValueError("row must be an object")
+    unknown = [key for key in row if key not in table.c]
+    if unknown:
+        raise ValueError("unknown columns for {}: {}".format(table_name, ", ".join(unknown)))
+    if from_csv:
+        row = {key: _coerce_csv(table.c[key], value) for key, value in row.items()}
+    if table_name == 'user' and not trusted:
+        if row.get('password') is None:
+            # an HTTP export has no hashes, the user comes back disabled and without a usable password
+            row = dict(row, password=unusable_password(), is_active=False)
+        elif not is_hashed(row['password']):
+            # over HTTP a user can only be imported with a password hash
+            raise ValueError("user password must be a password hash")
+    return row
+
+def get_checkpoint(import_id):
+    return db.session.get(ImportCheckpoint, import_id)
+
+def _write_chunk(chunk, checkpoint, end_offset, on_conflict, dialect):
+    """Inserts the chunk and moves the checkpoint forward, in one transaction"""
+    # executemany needs the same columns in every row
+    groups = {}
+    for table_name, row in chunk:
+        groups.setdefault((table_name, tuple(sorted(row))), []).append(row)
+    for (table_name, columns), rows in groups.items():
+        table = TABLES[table_name]
+        statement = insert_ignoring_duplicates(table, dialect) if on_conflict == 'skip' else insert(table)
+        db.session.execute(statement, rows)
+        tracking.record_write(db.session, table_name, op='bulk')
+    checkpoint.records += len(chunk)
+    checkpoint.byte_offset = end_offset
+    checkpoint.updated_at = datetime.utcnow()
+    db.session.commit()
+
+def _reset_sequences(table_names):
+    # rows were inserted with explicit ids, the id sequences must continue after them
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    preparer = db.session.get_bind().dialect.identifier_preparer
+    for table_name in table_names:
+        db.session.execute(
+            text("SELECT setval(pg_get_serial_sequence(:table, 'id'), COALESCE((SELECT MAX(id) FROM {}), 1))".format(preparer.quote(table_name))),
+            {'table': preparer.quote(table_name)}
+        )
+    db.session.commit()
+
+def import_records(records, import_id, on_conflict='error', from_csv=False, trusted=False, skip=None, progress=None):
+    """
+    Imports (table name, row, end offset) records in committed chunks.
+    `skip` is the number of leading records already imported, by default the
+    checkpoint of `import_id` (the input starts from the beginning again).
+    `progress(records, byte offset)` is called after each committed chunk.
+    Returns {"imported", "skipped", "records"}; failures raise an
+    APIException that reports how far the checkpoint got.
+    """
+    checkpoint = get_checkpoint(import_id)
+    if checkpoint is None:
+        checkpoint = ImportCheckpoint(import_id=import_id, records=0, byte_offset=0, finished=False, updated_at=datetime.utcnow())
+        db.session.add(checkpoint)
+        db.session.commit()
+    if checkpoint.finished:
+        return {"imported": 0, "skipped": checkpoint.records, "records": checkpoint.records, "finished": True}
+    skip = checkpoint.records if skip is None else skip
+    dialect = db.session.get_bind().dialect.name
+
+    imported = 0
+    position = checkpoint.records - skip
+    chunk = []
+    touched = set()
+    try:
+        for table_name, row, end_offset in records:
+            position += 1
+            if position <= checkpoint.records:
+                continue
+            chunk.append((table_name, _prepare(table_name, row, from_csv, trusted)))
+            touched.add(table_name)
+            if len(chunk) >= CHUNK_SIZE:
+                _write_chunk(chunk, checkpoint, end_offset, on_conflict, dialect)
+                imported += len(chunk)
+                chunk = []
+                if progress is not None:
+                    progress(checkpoint.records, checkpoint.byte_offset)
+        if chunk:
+            _write_chunk(chunk, checkpoint, end_offset, on_conflict, dialect)
+            imported += len(chunk)
+        checkpoint.finished = True
+        checkpoint.updated_at = datetime.utcnow()
+        db.session.commit()
+        _reset_sequences(touched)
+    except (ValueError, SQLAlchemyError) as error:
+        db.session.rollback()
+        failed_record = checkpoint.records + len(chunk) if isinstance(error, SQLAlchemyError) else position
+        message = error.__class__.__name__ if isinstance(error, SQLAlchemyError) else str(error)
+        raise APIException(
+            "import failed near record {}: {}".format(failed_record, message),
+            status_code=409 if isinstance(error, IntegrityError) else 400,
+            payload={"import_id": import_id, "records_committed": checkpoint.records},
+        )
+    return {"imported": imported, "skipped": skip, "records": checkpoint.records, "finished": True}
+
+def import_args(args):
+    """(format, table of a CSV, import_id, on_conflict) of an /import request"""
+    import_format = args.get('format', 'ndjson')
+    if import_format not in FORMATS:
+        raise APIException("format must be one of: {}".format(", ".join(FORMATS)), status_code=400)
+    on_conflict = args.get('on_conflict', 'error')
+    if on_conflict not in CONFLICT_MODES:
+        raise APIException("on_conflict must be one of: {}".format(", ".join(CONFLICT_MODES)), status_code=400)
+    import_id = (args.get('import_id') or '').strip()
+    if not import_id or len(import_id) > 120:
+        raise APIException("import_id is required (at most 120 characters), reuse it to resume a failed import", status_code=400)
+    table_name = parse_tables(args.get('table'), csv_format=True)[0] if import_format == 'csv' else None
+    return import_format, table_name, import_id, on_conflict
+
+def import_request():
+    """Imports the body of the current request, see the /import endpoint"""
+    import_format, table_name, import_id, on_conflict = import_args(request.args)
+    if import_format == 'csv':
+        records = read_csv(request.stream, table_name)
+    else:
+        records = read_ndjson(request.stream)
+    return dict(import_records(records, import_id, on_conflict, from_csv=import_format == 'csv'), import_id=import_id)
+
+def import_file(path, import_format, table_name, import_id, on_conflict, trusted=False, progress=None):
+    """
+    Imports a file, reading it from the byte offset of its checkpoint so the
+    records imported by a previous attempt are not read again
+    """
+    checkpoint = get_checkpoint(import_id)
+    offset = checkpoint.byte_offset if checkpoint else 0
+    with open(path, 'rb') as stream:
+        if import_format == 'csv':
+            header_line = stream.readline()
+            offset = max(offset, len(header_line))
+            stream.seek(offset)
+            records = read_csv(stream, table_name, offset, header=read_csv_header(header_line))
+        else:
+            stream.seek(offset)
+            records = read_ndjson(stream, offset)
+        # the file is read from the checkpoint on, nothing to skip
+        return import_records(records, import_id, on_conflict, from_csv=import_format == 'csv', trusted=trusted, skip=0, progress=progress)
+
+@catalog_cli.command('export')
+@click.option('--format', 'export_format', type=click.Choice(FORMATS), default='ndjson')
+@click.option('--tables', help="comma separated, every table by default (exactly one for CSV)")
+@click.option('--output', type=click.File('wb'), default='-', help="file to write, stdout by default")
+def export_command(export_format, tables, output):
+    """Exports the catalog, user password hashes included"""
+    tables = parse_tables(tables, export_format == 'csv')
+    chunks = export_csv(tables[0], with_secrets=True) if export_format == 'csv' else export_ndjson(tables, with_secrets=True)
+    for chunk in chunks:
+        output.write(chunk)
+
+@catalog_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'import_format', type=click.Choice(FORMATS), default='ndjson')
+@click.option('--table', help="table of a CSV file")
+@click.option('--import-id', help="checkpoint name, the file path by default")
+@click.option('--on-conflict', type=click.Choice(CONFLICT_MODES), default='error')
+def import_command(path, import_format, table, import_id, on_conflict):
+    """Imports an export file, resuming from its checkpoint after a failure"""
+    import_id = import_id or path
+    checkpoint = get_checkpoint(import_id)
+    done = checkpoint.records if checkpoint else 0
+    table_name = parse_tables(table, csv_format=True)[0] if import_format == 'csv' else None
+    try:
+        result = import_file(path, import_format, table_name, import_id, on_conflict, trusted=True)
+    except APIException as error:
+        raise click.ClickException("{} ({} records committed, run the same command again to resume)".format(error.message, error.payload["records_committed"]))
+    click.echo("{} records imported, {} done by a previous run".format(result["imported"], done))
@@ -0,0 +1,322 @@
+"""
+Change feed for incremental client sync.
+
+Every write to the catalog tables is appended to change_log, in the
+transaction that makes it, with a monotonic sequence number (seq). Rows
+written through the ORM or with a known id get one entry each; statements
+writing many rows at once (bulk endpoints, imports, batched favorites) get
+one "bulk" entry per table and transaction, meaning "fetch that collection
+again".
+
+    GET /changes                   {"next": <seq>}, where to sync from after a full download
+    GET /changes?since=<seq>       the entries after `since`, with the current row
+                                   (null once deleted) and the `next` seq to ask from
+    GET /changes?since=<seq>&wait=25     long poll, answers as soon as there is a change
+    Accept: text/event-stream      server-sent events, resumed with Last-Event-ID
+
+?tables=planet,character keeps the entries of those tables only. A commit
+wakes the waiting requests of its worker at once, the other workers see it
+within CHANGES_POLL_MS.
+
+A waiting request holds its thread, and a sync gunicorn worker has only one:
+there a single long poll or event stream stalls every other request of the
+worker. At most CHANGES_MAX_WAITERS requests of a worker wait at once, the
+next ones get a 503 (a poll with something to return is always answered).
+Set it to 0 with sync workers (render.yaml does), long polls and event
+streams are for threaded (--threads), gevent or ASGI workers.
+
+With PostgreSQL, concurrent transactions can commit out of seq order. An
+entry following a missing seq is held back while it is younger than
+CHANGES_GAP_SECONDS, so a client never moves past a change still being
+committed; an older gap is a rolled back transaction.
+
+`flask changes prune` drops the entries older than CHANGES_RETENTION_DAYS, but
+the newest. A client asking from before the oldest entry kept gets a 410 and must
+download the collections again.
+"""
+import os
+import time
+import threading
+from datetime import datetime, timedelta
+from collections import defaultdict
+import click
+from flask import request, jsonify, Response, stream_with_context
+from flask.cli import AppGroup
+from sqlalchemy import event, select, insert, delete, func
+from sqlalchemy.orm import Session
+from models import db, ChangeLog
+from catalog import TABLES, export_columns
+from serialization import encode
+from pagination import get_page_args
+from utils import APIException
+import tracking
+
+CHANGE_TABLES = set(TABLES)
+MAX_WAIT_SECONDS = int(os.environ.get('CHANGES_MAX_WAIT_SECONDS', 30))
+POLL_SECONDS = float(os.environ.get('CHANGES_POLL_MS', 1000)) / 1000
+GAP_SECONDS = float(os.environ.get('CHANGES_GAP_SECONDS', 5))
+# an event stream is closed after this long, EventSource reconnects with Last-Event-ID
+STREAM_SECONDS = int(os.environ.get('CHANGES_STREAM_SECONDS', 300))
+HEARTBEAT_SECONDS = 15
+RETRY_AFTER_SECONDS = 5
+IN_BATCH_SIZE = 1000
+
+changes_cli = AppGroup('changes', help="Change feed maintenance")
+
+def record_change(session, table, pk=None, op='update'):
+    """Write listener, queues the change_log entry of a write"""
+    if table not in CHANGE_TABLES:
+        return
+    if op == 'count':
+        op = 'update'
+    if pk is None:
+        bulk = session.info.setdefault('bulk_changes', set())
+        if table in bulk:
+            return
+        bulk.add(table)
+        op = 'bulk'
+    session.info.setdefault('changes', []).append(
+        {'table_name': table, 'row_id': pk, 'op': op, 'changed_at': datetime.utcnow()}
+    )
+
+@event.listens_for(Session, 'after_flush')
+@event.listens_for(Session, 'before_commit')
+def _write_changes(session, flush_context=None):
+    # after_flush covers the ORM writes (the ones of commit's own flush too), before_commit the core ones
+    changes = session.info.pop('changes', None)
+    if changes:
+        session.connection().execute(insert(ChangeLog.__table__), changes)
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _reset_changes(session):
+    session.info.pop('changes', None)
+    session.info.pop('bulk_changes', None)
+
+tracking.write_listeners.append(record_change)
+
+class ChangeSignal:
+    """Wakes the requests of this worker waiting for changes when a transaction commits some"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+
+    def notify(self, writes):
+        if any(table in CHANGE_TABLES for table, _ in writes):
+            with self.condition:
+                self.generation += 1
+                self.condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """Waits until a commit after `generation` was read, or for `timeout` seconds"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+
+signal = ChangeSignal()
+tracking.commit_listeners.append(signal.notify)
+
+class Waiters:
+    """The requests of this worker waiting for changes, refused past `limit`"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def enter(self):
+        with self.lock:
+            if self.count >= self.limit:
+                raise APIException("Too many clients waiting for changes, poll without wait or try again later",
+                                   status_code=503, headers={'Retry-After': str(RETRY_AFTER_SECONDS)})
+            self.count += 1
+
+    def leave(self):
+        with self.lock:
+            self.count -= 1
+
+waiters = Waiters(int(os.environ.get('CHANGES_MAX_WAITERS', 8)))
+
+def latest_seq():
+    return db.session.execute(select(func.max(ChangeLog.seq))).scalar() or 0
+
+def settled(entries, since):
+    """The leading entries that can be served: stops at a gap younger than GAP_SECONDS"""
+    now = datetime.utcnow()
+    expected = since + 1
+    for index, entry in enumerate(entries):
+        if entry.seq != expected and (now - entry.changed_at).total_seconds() < GAP_SECONDS:
+            return entries[:index]
+        expected = entry.seq + 1
+    return entries
+
+def current_rows(entries):
+    """{(table, id): row} of the rows the entries point to that still exist"""
+    ids = defaultdict(set)
+    for entry in entries:
+        if entry.row_id is not None and entry.op != 'delete':
+            ids[entry.table_name].add(entry.row_id)
+    rows = {}
+    for table_name, table_ids in ids.items():
+        columns = export_columns(table_name, False)
+        table_ids = sorted(table_ids)
+        for start in range(0, len(table_ids), IN_BATCH_SIZE):
+            batch = table_ids[start:start + IN_BATCH_SIZE]
+            for row in db.session.execute(select(*columns).where(TABLES[table_name].c.id.in_(batch))):
+                rows[(table_name, row.id)] = dict(row._mapping)
+    return rows
+
+def read_changes(since, limit, tables=None):
+    """(entries as dicts, next seq, more entries waiting) for the entries after `since`"""
+    entries = db.session.execute(
+        select(ChangeLog.seq, ChangeLog.table_name, ChangeLog.row_id, ChangeLog.op, ChangeLog.changed_at)
+        .where(ChangeLog.seq > since).order_by(ChangeLog.seq).limit(limit)
+    ).all()
+    if entries and entries[0].seq != since + 1:
+        oldest = db.session.execute(select(func.min(ChangeLog.seq))).scalar()
+        if since < oldest - 1:
+            raise APIException("changes before {} were pruned, download the collections again".format(oldest), status_code=410)
+    served = settled(entries, since)
+    more = len(served) == limit
+    next_seq = served[-1].seq if served else since
+    if tables is not None:
+        served = [entry for entry in served if entry.table_name in tables]
+    rows = current_rows(served)
+    return [{
+        "seq": entry.seq,
+        "table": entry.table_name,
+        "id": entry.row_id,
+        "op": entry.op,
+        "changed_at": entry.changed_at.isoformat(),
+        "row": rows.get((entry.table_name, entry.row_id)),
+    } for entry in served], next_seq, more
+
+def parse_since(value):
+    try:
+        since = int(value)
+    except ValueError:
+        raise APIException("since must be an integer", status_code=400)
+    if since < 0:
+        raise APIException("since can't be negative", status_code=400)
+    return since
+
+def parse_change_tables(names):
+    if not names:
+        return None
+    tables = set(name.strip() for name in names.split(',') if name.strip())
+    unknown = sorted(tables - CHANGE_TABLES)
+    if unknown:
+        raise APIException("unknown tables: {}".format(", ".join(unknown)), status_code=400)
+    return tables
+
+def parse_wait(value):
+    try:
+        wait = float(value or 0)
+    except ValueError:
+        raise APIException("wait must be a number of seconds", status_code=400)
+    if wait < 0 or wait > MAX_WAIT_SECONDS:
+        raise APIException("wait must be between 0 and {} seconds".format(MAX_WAIT_SECONDS), status_code=400)
+    return wait
+
+def _release_connection():
+    # nothing is held between two polls, a waiting client costs no pooled connection
+    db.session.close()
+
+def wait_for_changes(since, limit, tables, wait):
+    """read_changes, waiting up to `wait` seconds for a first entry"""
+    deadline = time.monotonic() + wait
+    waiting = False
+    try:
+        while True:
+            generation = signal.generation
+            result, since, more = read_changes(since, limit, tables)
+            remaining = deadline - time.monotonic()
+            if result or more or remaining <= 0:
+                return result, since, more
+            if not waiting:
+                waiters.enter()
+                waiting = True
+            _release_connection()
+            signal.wait(generation, min(remaining, POLL_SECONDS))
+    finally:
+        if waiting:
+            waiters.leave()
+
+def event_stream(since, limit, tables):
+    """Server-sent events, one `change` event per entry with its seq as id"""
+    def generate():
+        cursor = since
+        deadline = time.monotonic() + STREAM_SECONDS
+        last_sent = time.monotonic()
+        yield "retry: 1000\n\n"
+        while time.monotonic() < deadline:
+            generation = signal.generation
+            result, cursor, more = read_changes(cursor, limit, tables)
+            _release_connection()
+            for entry in result:
+                yield "id: {}\nevent: change\ndata: {}\n\n".format(entry["seq"], encode(entry).decode())
+                last_sent = time.monotonic()
+            if more:
+                continue
+            if time.monotonic() - last_sent >= HEARTBEAT_SECONDS:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            signal.wait(generation, min(POLL_SECONDS, max(0, deadline - time.monotonic())))
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # proxies must not buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def wants_event_stream():
+    return request.accept_mimetypes.best == 'text/event-stream'
+
+def changes_request():
+    """Serves GET /changes"""
+    tables = parse_change_tables(request.args.get('tables'))
+    limit = get_page_args()
+    since = request.args.get('since', request.headers.get('Last-Event-ID'))
+    if wants_event_stream():
+        since = parse_since(since) if since is not None else latest_seq()
+        # fails with a 410 before the stream starts
+        read_changes(since, 1)
+        waiters.enter()
+        response = event_stream(since, limit, tables)
+        response.call_on_close(waiters.leave)
+        return response
+    if since is None:
+        return jsonify({"msg": "ok", "result": [], "next": latest_seq(), "more": False})
+    result, next_seq, more = wait_for_changes(parse_since(since), limit, tables, parse_wait(request.args.get('wait')))
+    return jsonify({"msg": "ok", "result": result, "next": next_seq, "more": more})
+
+def prune_changes(days, batch_size=10000):
+    """
+    Deletes the entries older than `days`, `batch_size` per transaction. Returns how many.
+    The newest entry is kept, GET /changes reads the seq to sync from off it.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    newest = latest_seq()
+    last = db.session.execute(
+        select(func.max(ChangeLog.seq)).where(ChangeLog.changed_at < cutoff, ChangeLog.seq < newest)
+    ).scalar()
+    deleted = 0
+    if last is None:
+        return deleted
+    while True:
+        first = db.session.execute(select(func.min(ChangeLog.seq))).scalar()
+        if first is None or first > last:
+            return deleted
+        result = db.session.execute(delete(ChangeLog.__table__).where(ChangeLog.seq <= min(last, first + batch_size - 1)))
+        db.session.commit()
+        deleted += result.rowcount
+
+@changes_cli.command('prune')
+@click.option('--days', default=int(os.environ.get('CHANGES_RETENTION_DAYS', 30)), help="entries kept, in days")
+@click.option('--batch-size', default=10000, help="entries per transaction")
+def prune_command(days, batch_size):
+    """Deletes the old change log entries"""
+    click.echo("{} entries deleted".format(prune_changes(days, batch_size)))
+
+def setup_changes(app):
+    app.cli.add_command(changes_cli)
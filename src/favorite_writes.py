@@ -0,0 +1,266 @@
+"""
+Write-behind queue for favorite add/remove operations.
+
+Operations are coalesced per user and (kind, target): only the last one
+counts, so an add followed by a remove leaves a single, idempotent delete.
+A background thread writes the queue in one transaction when it holds
+FAVORITES_BATCH_SIZE operations or every FAVORITES_FLUSH_MS. Reads of a
+user's favorites first flush that user's pending operations, and go to the
+primary for REPLICA_STICKY_SECONDS after the user's last add or remove
+(whoever flushed it), so a client always sees its own writes. The
+favorite_count of the targets is updated in the same transaction, by the
+number of rows each statement actually added or removed.
+
+The queue lives in the memory of one process: read-your-writes only holds
+for requests served by the worker that queued the operations. So batching
+is the default for a single worker only, with WEB_CONCURRENCY > 1 (several
+gunicorn workers) FAVORITES_DURABILITY defaults to immediate, which writes
+every operation in its own transaction before responding. In batched mode
+operations still queued when the process crashes are lost, a clean exit
+flushes them.
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import defaultdict
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, delete, update, func
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, Planet, Character, Vehicle_Starship, FavoritePlanet, FavoriteCharacter, FavoriteVehicleStarship
+from tracking import record_write
+from bulk import insert_ignoring_duplicates, SQLITE_MAX_VARIABLES
+from replicas import read_from_primary, sticky_seconds, mark_written
+
+logger = logging.getLogger('api.favorites')
+
+# kind -> (favorite model, target column, target model)
+TARGETS = {
+    'planet': (FavoritePlanet, 'planet_id', Planet),
+    'character': (FavoriteCharacter, 'character_id', Character),
+    'vehicle_starship': (FavoriteVehicleStarship, 'vehicle_starship_id', Vehicle_Starship),
+}
+DURABILITY_MODES = ('immediate', 'batched')
+# (user_id, target) pairs per statement
+ROWS_PER_STATEMENT = SQLITE_MAX_VARIABLES // 2
+
+queue = None
+favorites_cli = AppGroup('favorites', help="Favorite counters maintenance")
+
+class FavoriteWriteQueue:
+    def __init__(self, app, durability, batch_size, interval):
+        self.app = app
+        self.durability = durability
+        self.batch_size = batch_size
+        self.interval = interval
+        # user_id -> {(kind, target_id): 'add' | 'remove'}
+        self.pending = {}
+        self.size = 0
+        # user_id -> until when its favorites are read from the primary
+        self.sticky = {}
+        self.lock = threading.Lock()
+        # held while a batch is written, so a read waits for writes already taken off the queue
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def submit(self, user_id, kind, target_id, op):
+        self._stick(user_id)
+        if self.durability == 'immediate':
+            self._apply({user_id: {(kind, target_id): op}})
+            return
+        self._ensure_thread()
+        with self.lock:
+            ops = self.pending.setdefault(user_id, {})
+            if (kind, target_id) not in ops:
+                self.size += 1
+            ops[(kind, target_id)] = op
+            full = self.size >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def _stick(self, user_id):
+        seconds = sticky_seconds()
+        if not seconds:
+            return
+        mark_written()
+        with self.lock:
+            self.sticky[user_id] = time.monotonic() + seconds
+
+    def is_sticky(self, user_ids):
+        """True while one of these users has writes the replicas may not have yet"""
+        now = time.monotonic()
+        with self.lock:
+            return any(self.sticky.get(user_id, 0) > now for user_id in user_ids)
+
+    def flush(self):
+        if self.sticky:
+            now = time.monotonic()
+            with self.lock:
+                self.sticky = {user_id: until for user_id, until in self.sticky.items() if until > now}
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending, self.size = self.pending, {}, 0
+            if batch:
+                self._apply(batch)
+
+    def flush_users(self, user_ids):
+        """Writes the pending operations of these users now (read-your-writes)"""
+        with self.flush_lock:
+            with self.lock:
+                batch = {user_id: self.pending.pop(user_id) for user_id in user_ids if user_id in self.pending}
+                self.size -= sum(len(ops) for ops in batch.values())
+            if batch:
+                self._apply(batch)
+            return bool(batch)
+
+    def _ensure_thread(self):
+        # started on first use and again in forked workers, threads don't survive a fork
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            if self.pid != os.getpid():
+                # operations queued before the fork belong to the parent
+                self.pending, self.size = {}, 0
+                atexit.register(self.flush)
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name='favorite-writes', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("favorite write-behind flush failed")
+
+    def _apply(self, batch):
+        with self.app.app_context():
+            try:
+                self._write(batch)
+            except SQLAlchemyError:
+                db.session.rollback()
+                if len(batch) == 1:
+                    raise
+                # one bad user must not drop the writes of everybody else in the batch
+                logger.exception("favorite batch failed, retrying user by user")
+                for user_id, ops in batch.items():
+                    try:
+                        self._write({user_id: ops})
+                    except SQLAlchemyError:
+                        db.session.rollback()
+                        logger.exception("dropped %d favorite operations of user %s", len(ops), user_id)
+
+    def _write(self, batch):
+        session = db.session
+        dialect = session.get_bind().dialect.name
+        # kind -> target_id -> user ids
+        adds = defaultdict(lambda: defaultdict(list))
+        removes = defaultdict(lambda: defaultdict(list))
+        for user_id, ops in batch.items():
+            for (kind, target_id), op in ops.items():
+                (adds if op == 'add' else removes)[kind][target_id].append(user_id)
+
+        for kind in set(adds) | set(removes):
+            model, column, target_model = TARGETS[kind]
+            table = model.__table__
+            # counts move by the rowcount of each statement, not by what was read
+            # before: a row another worker removed or added meanwhile isn't counted twice
+            deltas = defaultdict(int)
+            for target_id, user_ids in removes[kind].items():
+                for start in range(0, len(user_ids), ROWS_PER_STATEMENT):
+                    result = session.execute(
+                        delete(table).where(table.c[column] == target_id, table.c.user_id.in_(user_ids[start:start + ROWS_PER_STATEMENT]))
+                    )
+                    deltas[target_id] -= result.rowcount
+            for target_id, user_ids in adds[kind].items():
+                for start in range(0, len(user_ids), ROWS_PER_STATEMENT):
+                    # one multi-row statement, its rowcount skips the rows the unique index refused
+                    result = session.execute(insert_ignoring_duplicates(table, dialect).values(
+                        [{'user_id': user_id, column: target_id} for user_id in user_ids[start:start + ROWS_PER_STATEMENT]]
+                    ))
+                    deltas[target_id] += result.rowcount
+            record_write(session, table.name, op='bulk')
+            if any(deltas.values()):
+                apply_count_deltas(session, target_model, deltas)
+        session.commit()
+
+def apply_count_deltas(session, target_model, deltas):
+    """favorite_count += delta, one UPDATE per distinct delta"""
+    targets_by_delta = defaultdict(list)
+    for target_id, delta in deltas.items():
+        if delta:
+            targets_by_delta[delta].append(target_id)
+    table = target_model.__table__
+    for delta, target_ids in targets_by_delta.items():
+        session.execute(update(table).where(table.c.id.in_(target_ids)).values(favorite_count=table.c.favorite_count + delta))
+        # one write per target, so the change feed sees which rows changed
+        for target_id in target_ids:
+            record_write(session, table.name, target_id, op='count')
+
+def reconcile_favorite_counts(batch_size=10000):
+    """
+    Recounts favorite_count from the favorite tables, in id ranges of
+    `batch_size` so no transaction holds its locks for long. Fixes any
+    drift (favorites edited in the admin, races between immediate writes).
+    Returns {kind: rows corrected}.
+    """
+    session = db.session
+    corrected = {}
+    for kind, (model, column, target_model) in TARGETS.items():
+        favorites, table = model.__table__, target_model.__table__
+        count = select(func.count()).select_from(favorites).where(favorites.c[column] == table.c.id).scalar_subquery()
+        max_id = session.execute(select(func.max(table.c.id))).scalar() or 0
+        corrected[kind] = 0
+        for start in range(0, max_id, batch_size):
+            result = session.execute(
+                update(table)
+                .where(table.c.id > start, table.c.id <= start + batch_size, table.c.favorite_count != count)
+                .values(favorite_count=count)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount:
+                corrected[kind] += result.rowcount
+                record_write(session, table.name, op='count')
+            session.commit()
+    return corrected
+
+@favorites_cli.command('reconcile')
+@click.option('--batch-size', default=10000, help="ids per transaction")
+def reconcile_command(batch_size):
+    """Recounts favorite_count of planets, characters and vehicles"""
+    for kind, corrected in reconcile_favorite_counts(batch_size).items():
+        click.echo("{}: {} corrected".format(kind, corrected))
+
+def flush_users(user_ids):
+    if queue is None:
+        return
+    queue.flush_users(user_ids)
+    if queue.is_sticky(user_ids):
+        # written now or by the background thread a moment ago, the replicas may not have it yet
+        read_from_primary()
+
+def setup_favorite_writes(app):
+    global queue
+    workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+    durability = os.environ.get('FAVORITES_DURABILITY') or ('immediate' if workers > 1 else 'batched')
+    if durability not in DURABILITY_MODES:
+        raise ValueError("FAVORITES_DURABILITY must be one of: {}".format(", ".join(DURABILITY_MODES)))
+    if durability == 'batched' and workers > 1:
+        logger.warning("batched favorite writes with %d workers: a client may not see its writes queued in another worker", workers)
+    queue = FavoriteWriteQueue(
+        app,
+        durability,
+        int(os.environ.get('FAVORITES_BATCH_SIZE', 500)),
+        float(os.environ.get('FAVORITES_FLUSH_MS', 200)) / 1000,
+    )
+    app.extensions['favorite_writes'] = queue
+    app.cli.add_command(favorites_cli)
+    return queue
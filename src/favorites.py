@@ -0,0 +1,162 @@
+"""
+Read path for the user favorites (planets, characters and vehicles/starships)
+"""
+from sqlalchemy import select, literal, cast, null, func, Integer, String, union_all
+from utils import APIException
+from models import db, Planet, Character, Vehicle_Starship, FavoritePlanet, FavoriteCharacter, FavoriteVehicleStarship
+
+MAX_BATCH_USERS = 500
+LEADERBOARD_SIZE = 20
+MAX_LEADERBOARD_SIZE = 100
+
+def _null(type_):
+    return cast(null(), type_)
+
+def _favorites_union(user_ids):
+    """
+    One UNION ALL over the three favorite tables, each side already joined to
+    its target, so every favorite kind comes back in a single round trip.
+    Every side selects the columns of all the targets, NULL where it has none.
+    """
+    planets = select(
+        literal('planet').label('kind'),
+        FavoritePlanet.id.label('favorite_id'),
+        FavoritePlanet.user_id.label('user_id'),
+        Planet.id.label('target_id'),
+        Planet.name.label('name'),
+        Planet.favorite_count.label('favorite_count'),
+        Planet.climate.label('climate'),
+        Planet.population.label('population'),
+        _null(String).label('species'),
+        _null(String).label('gender'),
+        _null(Integer).label('homeworld_id'),
+    ).select_from(FavoritePlanet).join(Planet, FavoritePlanet.planet_id == Planet.id).where(FavoritePlanet.user_id.in_(user_ids))
+
+    characters = select(
+        literal('character').label('kind'),
+        FavoriteCharacter.id.label('favorite_id'),
+        FavoriteCharacter.user_id.label('user_id'),
+        Character.id.label('target_id'),
+        Character.name.label('name'),
+        Character.favorite_count.label('favorite_count'),
+        _null(String).label('climate'),
+        _null(Integer).label('population'),
+        Character.species.label('species'),
+        Character.gender.label('gender'),
+        Character.homeworld_id.label('homeworld_id'),
+    ).select_from(FavoriteCharacter).join(Character, FavoriteCharacter.character_id == Character.id).where(FavoriteCharacter.user_id.in_(user_ids))
+
+    vehicles_starships = select(
+        literal('vehicle_starship').label('kind'),
+        FavoriteVehicleStarship.id.label('favorite_id'),
+        FavoriteVehicleStarship.user_id.label('user_id'),
+        Vehicle_Starship.id.label('target_id'),
+        Vehicle_Starship.name.label('name'),
+        Vehicle_Starship.favorite_count.label('favorite_count'),
+        _null(String).label('climate'),
+        _null(Integer).label('population'),
+        _null(String).label('species'),
+        _null(String).label('gender'),
+        _null(Integer).label('homeworld_id'),
+    ).select_from(FavoriteVehicleStarship).join(Vehicle_Starship, FavoriteVehicleStarship.vehicle_starship_id == Vehicle_Starship.id).where(FavoriteVehicleStarship.user_id.in_(user_ids))
+
+    return union_all(planets, characters, vehicles_starships).subquery()
+
+# Each builder mirrors the serialize() of the target model
+def _planet_item(row):
+    return {
+        "favorite_planet_id": row.favorite_id,
+        "planet": {"id": row.target_id, "name": row.name, "climate": row.climate, "population": row.population,
+                   "favorite_count": row.favorite_count}
+    }
+
+def _character_item(row):
+    return {
+        "favorite_character_id": row.favorite_id,
+        "character": {"id": row.target_id, "name": row.name, "species": row.species, "gender": row.gender,
+                      "homeworld_id": row.homeworld_id, "favorite_count": row.favorite_count}
+    }
+
+def _vehicle_starship_item(row):
+    return {
+        "favorite_vehicle_starship_id": row.favorite_id,
+        "starship": {"id": row.target_id, "name": row.name, "favorite_count": row.favorite_count}
+    }
+
+KINDS = {
+    'planet': ('planets', _planet_item),
+    'character': ('characters', _character_item),
+    'vehicle_starship': ('vehicles_starships', _vehicle_starship_item),
+}
+
+def validate_user_ids(body):
+    """Returns (user_ids, error message) for the body of a batch favorites request"""
+    user_ids = body.get('user_ids') if isinstance(body, dict) else None
+    if not isinstance(user_ids, list) or not user_ids:
+        return None, 'El campo user_ids debe ser una lista no vacia'
+    if len(user_ids) > MAX_BATCH_USERS:
+        return None, 'Maximo {} usuarios por peticion'.format(MAX_BATCH_USERS)
+    if not all(isinstance(user_id, int) and not isinstance(user_id, bool) for user_id in user_ids):
+        return None, 'Los user_ids deben ser enteros'
+    return list(dict.fromkeys(user_ids)), None
+
+def empty_favorites():
+    return {"planets": [], "characters": [], "vehicles_starships": []}
+
+def favorites_statement(user_ids, limit, offset=0):
+    """
+    Favorites `offset` to `offset + limit` of every user (one more to know if
+    there is a next page): the window is per user, a user with many favorites
+    doesn't crowd the others out of the page.
+    """
+    favorites = _favorites_union(user_ids)
+    position = func.row_number().over(
+        partition_by=favorites.c.user_id, order_by=(favorites.c.kind, favorites.c.favorite_id)
+    ).label('position')
+    numbered = select(favorites, position).subquery()
+    return select(numbered).where(numbered.c.position > offset, numbered.c.position <= offset + limit + 1) \
+        .order_by(numbered.c.user_id, numbered.c.position)
+
+def group_favorites(rows, user_ids, limit, offset=0):
+    """
+    Returns ({user_id: {"planets": [...], "characters": [...], "vehicles_starships": [...]}}, next_offset)
+    from the rows of favorites_statement. next_offset is set while one of the
+    users has more favorites, the others are done and get empty lists.
+    """
+    results = {user_id: empty_favorites() for user_id in user_ids}
+    more = False
+    for row in rows:
+        if row.position > offset + limit:
+            more = True
+            continue
+        group, build_item = KINDS[row.kind]
+        results[row.user_id][group].append(build_item(row))
+    next_offset = offset + limit if more else None
+    return results, next_offset
+
+def load_favorites(user_ids, limit, offset=0):
+    """One page of favorites of each of the given users, see group_favorites"""
+    rows = db.session.execute(favorites_statement(user_ids, limit, offset)).all()
+    return group_favorites(rows, user_ids, limit, offset)
+
+def parse_leaderboard_size(args):
+    try:
+        size = int(args.get('limit', LEADERBOARD_SIZE))
+    except ValueError:
+        raise APIException("limit must be an integer", status_code=400)
+    if size < 1 or size > MAX_LEADERBOARD_SIZE:
+        raise APIException("limit must be between 1 and {}".format(MAX_LEADERBOARD_SIZE), status_code=400)
+    return size
+
+def leaderboard(model, size):
+    """
+    Most favorited rows of `model`, read from the precomputed favorite_count
+    (a walk down its index, no GROUP BY over the favorite tables)
+    """
+    rows = db.session.execute(
+        select(model.id, model.name, model.favorite_count)
+        .where(model.favorite_count > 0)
+        .order_by(model.favorite_count.desc(), model.id)
+        .limit(size)
+    ).all()
+    return [{"rank": rank, "id": row.id, "name": row.name, "favorite_count": row.favorite_count} for rank, row in enumerate(rows, 1)]
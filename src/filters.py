@@ -0,0 +1,178 @@
+"""
+Query string filters and sorting for the collection endpoints, compiled to SQL.
+
+    ?population__gte=1000000000&climate__in=arid,temperate&sort=-population,name
+
+Filters are `field=value` or `field__op=value` with op in ne, gt, gte, lt, lte
+and in (comma separated). `sort` is a list of fields, `-` for descending.
+The first sort field must be backed by an index, so a listing can never turn
+into a full scan plus a sort on the server. Rows without a value in a sort
+field come last, whatever the direction.
+"""
+import json
+import base64
+import operator
+from flask import request
+from sqlalchemy import and_, or_, false
+from utils import APIException
+
+OPERATORS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+}
+# what the databases store in an INTEGER column
+MIN_INTEGER, MAX_INTEGER = -2 ** 63, 2 ** 63 - 1
+# query string parameters that are not filters
+RESERVED = {'limit', 'after', 'offset', 'fields', 'stream', 'sort', 'include'}
+HIDDEN_FIELDS = {'password'}
+
+class Listing:
+    """Filters, order and start position of one collection request"""
+
+    def __init__(self, model, where, order, after):
+        self.model = model
+        self.where = where
+        # [(column, descending)], always ending with the id as tie breaker
+        self.order = order
+        self.after = after
+
+    @property
+    def sorted_by_id(self):
+        return len(self.order) == 1
+
+    def sort_columns(self):
+        """Extra columns to select so the next cursor can be built"""
+        return [column.label('sort_{}'.format(index)) for index, (column, descending) in enumerate(self.order[:-1])]
+
+    def apply(self, statement):
+        statement = statement.where(*self.where)
+        if self.after is not None:
+            statement = statement.where(_keyset_clause(self.order, self.after))
+        return statement.order_by(*[_order(column, descending) for column, descending in self.order])
+
+    def cursor(self, row):
+        # plain ids keep the `after=<id>` form of the unsorted listings
+        if self.sorted_by_id:
+            return row.id
+        values = [getattr(row, 'sort_{}'.format(index)) for index in range(len(self.order) - 1)] + [row.id]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def _order(column, descending):
+    ordered = column.desc() if descending else column.asc()
+    return ordered.nulls_last() if column.nullable else ordered
+
+def _equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+def _after(column, descending, value):
+    """The values coming after `value` in the order of the column, NULLs last"""
+    if value is None:
+        return false()
+    compare = column < value if descending else column > value
+    return or_(compare, column.is_(None)) if column.nullable else compare
+
+def _keyset_clause(order, values):
+    """(a, b, id) > (va, vb, vid) honouring the direction of every column"""
+    clauses = []
+    for position, (column, descending) in enumerate(order):
+        equal = [_equal(order[index][0], values[index]) for index in range(position)]
+        clauses.append(and_(*equal, _after(column, descending, values[position])))
+    return or_(*clauses)
+
+def _field_column(model, field):
+    if field not in model.serialize_fields or field in HIDDEN_FIELDS:
+        raise APIException("unknown field: {}".format(field), status_code=400)
+    return model.__table__.c[field]
+
+def _coerce(column, value):
+    python_type = column.type.python_type
+    try:
+        if python_type is bool:
+            if value.lower() not in ('true', 'false'):
+                raise ValueError(value)
+            return value.lower() == 'true'
+        if python_type is int:
+            # accept 1e9 style numbers
+            number = int(float(value)) if 'e' in value.lower() else int(value)
+            if not MIN_INTEGER <= number <= MAX_INTEGER:
+                raise ValueError(value)
+            return number
+        return python_type(value)
+    except (ValueError, OverflowError):
+        raise APIException("invalid value for {}: {}".format(column.key, value), status_code=400)
+
+def _cursor_value(column, value):
+    """A value of a decoded cursor, checked against the type of its column"""
+    if value is None:
+        if column.nullable:
+            return None
+    elif column.type.python_type is int:
+        if isinstance(value, int) and not isinstance(value, bool) and MIN_INTEGER <= value <= MAX_INTEGER:
+            return value
+    elif isinstance(value, column.type.python_type) and not isinstance(value, bool):
+        return value
+    raise APIException("invalid after cursor", status_code=400)
+
+def is_indexed(column):
+    if column.primary_key or column.unique or column.index:
+        return True
+    return any(list(index.columns)[0] is column for index in column.table.indexes)
+
+def parse_filters(model, args):
+    where = []
+    for key, value in args.items():
+        if key in RESERVED:
+            continue
+        field, _, op = key.partition('__')
+        column = _field_column(model, field)
+        op = op or 'eq'
+        if op == 'in':
+            where.append(column.in_([_coerce(column, item) for item in value.split(',')]))
+        elif op in OPERATORS:
+            where.append(OPERATORS[op](column, _coerce(column, value)))
+        else:
+            raise APIException("unknown filter operator: {}".format(op), status_code=400)
+    return where
+
+def parse_sort(model, sort):
+    order = []
+    for item in (sort or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        descending = item.startswith('-')
+        column = _field_column(model, item.lstrip('-+'))
+        if not order and not is_indexed(column):
+            raise APIException("can't sort by {}, it has no index".format(column.key), status_code=400)
+        if column.key == 'id':
+            # the id is unique, whatever comes after it can't change the order
+            return order + [(column, descending)]
+        order.append((column, descending))
+    order.append((model.__table__.c.id, order[0][1] if order else False))
+    return order
+
+def parse_after(order, after):
+    if after in (None, ''):
+        return None
+    try:
+        if len(order) == 1:
+            values = [int(after)]
+        else:
+            values = json.loads(base64.urlsafe_b64decode(after + '=' * (-len(after) % 4)))
+    except ValueError:
+        raise APIException("invalid after cursor", status_code=400)
+    if not isinstance(values, list) or len(values) != len(order):
+        raise APIException("invalid after cursor", status_code=400)
+    return [_cursor_value(column, value) for (column, descending), value in zip(order, values)]
+
+def get_listing(model):
+    return parse_listing(model, request.args)
+
+def parse_listing(model, args):
+    order = parse_sort(model, args.get('sort'))
+    where = parse_filters(model, args)
+    return Listing(model, where, order, parse_after(order, args.get('after')))
@@ -0,0 +1,123 @@
+"""
+Response formats negotiated with the Accept header:
+
+    application/json                      always available, the default
+    application/msgpack                   needs `msgpack` installed
+    application/vnd.apache.arrow.stream   needs `pyarrow`, collections only
+
+MessagePack responses have the same shape as the JSON ones. Arrow responses
+are a record batch stream built straight from the result columns, one column
+per field, with the next page cursor in the schema metadata ("next").
+A request accepting none of the available formats gets a 406.
+"""
+import json
+import time
+from functools import wraps
+from flask import request, g, current_app, jsonify, make_response
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from utils import APIException
+from pagination import wants_stream
+from serialization import rows_to_dicts
+from metrics import record_timing
+from includes import expand
+
+try:
+    import msgpack
+except ImportError:  # only JSON and Arrow are offered
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # no columnar format
+    pyarrow = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+ARROW = 'application/vnd.apache.arrow.stream'
+# other names clients use for the same formats
+ALIASES = {'application/x-msgpack': MSGPACK}
+
+def available_formats(columnar):
+    formats = [JSON]
+    if msgpack is not None:
+        formats += [MSGPACK, 'application/x-msgpack']
+    if columnar and pyarrow is not None:
+        formats.append(ARROW)
+    return formats
+
+def negotiate_format(accept_header, columnar=False):
+    """The format to respond with for this Accept header, None when nothing acceptable is available"""
+    if not accept_header:
+        return JSON
+    best = parse_accept_header(accept_header, MIMEAccept).best_match(available_formats(columnar))
+    return ALIASES.get(best, best)
+
+def negotiate(columnar=False):
+    """
+    Picks the response format of a GET endpoint before its conditional and
+    cache layers run, so both can key on it. `columnar` endpoints (the
+    collections) also offer Arrow.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # ?stream=true is always JSON, one document streamed chunk by chunk
+            if wants_stream():
+                g.response_format = JSON
+                return view(*args, **kwargs)
+            g.response_format = negotiate_format(request.headers.get('Accept'), columnar)
+            if g.response_format is None:
+                raise APIException("Not acceptable, available formats: {}".format(", ".join(available_formats(columnar))), status_code=406)
+            response = make_response(view(*args, **kwargs))
+            response.vary.add('Accept')
+            return response
+        return wrapper
+    return decorator
+
+def response_format():
+    return g.get('response_format', JSON)
+
+def format_variant(variant):
+    """Cache key / ETag input of a request, JSON keeps the plain URL"""
+    chosen = response_format()
+    return variant if chosen == JSON else "{}|{}".format(variant, chosen)
+
+def document_response(body, status=200):
+    """A JSON or MessagePack response with the same body"""
+    if response_format() == MSGPACK:
+        start = time.perf_counter()
+        payload = msgpack.packb(body, use_bin_type=True)
+        record_timing('serialize', time.perf_counter() - start)
+        return current_app.response_class(payload, status=status, mimetype=MSGPACK)
+    return jsonify(body), status
+
+ARROW_TYPES = {int: 'int64', float: 'float64', bool: 'bool_', str: 'string'}
+
+def _arrow_type(column):
+    try:
+        return getattr(pyarrow, ARROW_TYPES.get(column.type.python_type, 'string'))()
+    except NotImplementedError:
+        return pyarrow.string()
+
+def arrow_stream(model, fields, rows, metadata):
+    # rows may carry extra sort columns after the fields
+    columns = list(zip(*rows))[:len(fields)] if rows else [()] * len(fields)
+    schema = pyarrow.schema([(field, _arrow_type(model.__table__.c[field])) for field in fields], metadata=metadata)
+    batch = pyarrow.record_batch([pyarrow.array(values, type=column.type) for values, column in zip(columns, schema)], schema=schema)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+def collection_response(model, fields, rows, next_cursor, includes=()):
+    """One page of a collection endpoint in the negotiated format"""
+    if response_format() == ARROW:
+        if includes:
+            raise APIException("include is not available in Arrow responses", status_code=406)
+        start = time.perf_counter()
+        body = arrow_stream(model, fields, rows, {'next': json.dumps(next_cursor)})
+        record_timing('serialize', time.perf_counter() - start)
+        return current_app.response_class(body, mimetype=ARROW)
+    return document_response({"msg": "ok", "result": expand(model, rows_to_dicts(fields, rows), includes), "next": next_cursor})
@@ -0,0 +1,26 @@
+"""
+gunicorn settings, passed explicitly from the repository root:
+
+    gunicorn wsgi --chdir ./src/ -c src/gunicorn.conf.py
+
+gunicorn looks for its default config file before applying --chdir, so
+without -c this file is never read.
+
+With preload_app the master imports the app once and forks the workers
+from it: they boot faster and share the imported code and data pages
+copy-on-write. gc.freeze() before each fork keeps the garbage collector
+from writing to (and so copying) those pages in the workers.
+"""
+import gc
+import os
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+def pre_fork(server, worker):
+    gc.freeze()
+
+def post_fork(server, worker):
+    if preload_app:
+        from wsgi import application
+        from profiles import reset_after_fork
+        reset_after_fork(application)
@@ -0,0 +1,86 @@
+"""
+Related rows embedded with ?include= on the catalog endpoints:
+
+    /characters?include=homeworld,vehicles
+    /planets?include=residents
+    /vehicles_starships?include=pilots
+
+The related rows of a whole page are loaded at once, with one IN query per
+include (per IN_BATCH_SIZE ids), so expanding 1000 rows costs as many
+queries as expanding one. They are serialized with the serialize_fields of
+their model: homeworld is an object (or null), the others are lists.
+"""
+from collections import defaultdict
+from flask import request
+from sqlalchemy import select
+from utils import APIException
+from models import db, Planet, Character, Vehicle_Starship, VehiclePilot
+from serialization import columns
+
+IN_BATCH_SIZE = 1000
+
+def _homeworlds(ids):
+    return select(Character.id.label('owner_id'), *columns(Planet, Planet.serialize_fields)) \
+        .join(Planet, Character.homeworld_id == Planet.id).where(Character.id.in_(ids))
+
+def _residents(ids):
+    return select(Character.homeworld_id.label('owner_id'), *columns(Character, Character.serialize_fields)) \
+        .where(Character.homeworld_id.in_(ids)).order_by(Character.id)
+
+def _pilots(ids):
+    return select(VehiclePilot.vehicle_starship_id.label('owner_id'), *columns(Character, Character.serialize_fields)) \
+        .join(Character, VehiclePilot.character_id == Character.id) \
+        .where(VehiclePilot.vehicle_starship_id.in_(ids)).order_by(Character.id)
+
+def _vehicles(ids):
+    return select(VehiclePilot.character_id.label('owner_id'), *columns(Vehicle_Starship, Vehicle_Starship.serialize_fields)) \
+        .join(Vehicle_Starship, VehiclePilot.vehicle_starship_id == Vehicle_Starship.id) \
+        .where(VehiclePilot.character_id.in_(ids)).order_by(Vehicle_Starship.id)
+
+# table -> include -> (related model, tables read, one row or a list, statement for a batch of ids)
+INCLUDES = {
+    'planet': {
+        'residents': (Character, ('character',), False, _residents),
+    },
+    'character': {
+        'homeworld': (Planet, ('planet',), True, _homeworlds),
+        'vehicles': (Vehicle_Starship, ('vehicle_pilots', 'vehicle_starship'), False, _vehicles),
+    },
+    'vehicle_starship': {
+        'pilots': (Character, ('vehicle_pilots', 'character'), False, _pilots),
+    },
+}
+
+def parse_includes(model, requested):
+    if not requested:
+        return ()
+    available = INCLUDES.get(model.__tablename__, {})
+    includes = tuple(dict.fromkeys(name.strip() for name in requested.split(',') if name.strip()))
+    unknown = [name for name in includes if name not in available]
+    if unknown:
+        raise APIException("unknown include: {}, available: {}".format(", ".join(unknown), ", ".join(available) or "none"), status_code=400)
+    return includes
+
+def get_includes(model):
+    return parse_includes(model, request.args.get('include'))
+
+def included_tables(table):
+    """Other tables read because of the ?include= of the current request, for ETags and cache keys"""
+    available = INCLUDES.get(table, {})
+    tables = [related for name in request.args.get('include', '').split(',') if name.strip() in available
+              for related in available[name.strip()][1]]
+    return tuple(dict.fromkeys(name for name in tables if name != table))
+
+def expand(model, records, includes):
+    """Adds the included related rows to `records`, dicts that have an "id" """
+    ids = [record['id'] for record in records]
+    for name in includes:
+        related, tables, single, statement = INCLUDES[model.__tablename__][name]
+        found = defaultdict(list)
+        for start in range(0, len(ids), IN_BATCH_SIZE):
+            for row in db.session.execute(statement(ids[start:start + IN_BATCH_SIZE])):
+                found[row.owner_id].append(dict(zip(related.serialize_fields, row[1:])))
+        for record in records:
+            rows = found.get(record['id'], [])
+            record[name] = (rows[0] if rows else None) if single else rows
+    return records
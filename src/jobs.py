@@ -0,0 +1,562 @@
+"""
+Background jobs, for the work too slow for a request: catalog imports and
+exports, search reindexing, favorite count (leaderboard) recomputation and
+change log pruning.
+
+Jobs are rows of the job table, so no broker is needed. `flask jobs worker`
+runs a pool of JOBS_PROCESSES worker processes and restarts the ones that
+die. A worker claims the oldest due job with a conditional UPDATE: a job
+runs once, and only while fewer jobs of its type than its concurrency
+(JOBS_CONCURRENCY=`type=n,...` overrides the defaults) run across all the
+workers. The claims of a type are serialized (an advisory lock on
+PostgreSQL, SQLite has a single writer anyway), so two workers can't both
+see the last free slot.
+
+A job that raises is queued again after JOBS_BACKOFF_SECONDS * 2^(attempt - 1),
+with jitter and JOBS_MAX_BACKOFF_SECONDS at most, until it used the attempts
+of its type. Invalid input (APIException, JobFailed) fails it at once. A
+running job saves its progress and a heartbeat every JOBS_HEARTBEAT_SECONDS;
+a job without a heartbeat for JOBS_STALE_SECONDS lost its worker and is
+retried like a failure, unless its worker is a process still alive on this
+host (on SQLite the heartbeat waits while the job holds the write lock, a
+long import would run twice). Imports resume from their checkpoint.
+
+Over HTTP (the X-Internal-Token header, every job route is refused while
+INTERNAL_STATS_TOKEN is unset): POST /jobs, GET /jobs, GET /jobs/<id>,
+DELETE /jobs/<id> (cancels it) and GET /jobs/<id>/result, the file written
+by an export. /import?async=1 and /export?async=1 queue a job and answer 202.
+"""
+import os
+import json
+import time
+import uuid
+import random
+import signal
+import socket
+import zlib
+import logging
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+import click
+from flask import current_app, request
+from flask.cli import AppGroup
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.exc import OperationalError
+from models import db, Job
+from utils import APIException
+from pagination import get_page_args
+from catalog import parse_tables, import_args, import_file, export_ndjson, export_csv, FORMATS as CATALOG_FORMATS
+from search import rebuild_search_index
+from favorite_writes import reconcile_favorite_counts
+from changes import prune_changes
+from profiles import reset_after_fork
+
+logger = logging.getLogger('api.jobs')
+
+JOBS_DIR = os.environ.get('JOBS_DIR', '/tmp/jobs')
+# uploaded imports, removed once imported
+UPLOADS_DIR = os.path.join(JOBS_DIR, 'uploads')
+EXPORTS_DIR = os.path.join(JOBS_DIR, 'exports')
+POLL_SECONDS = float(os.environ.get('JOBS_POLL_MS', 1000)) / 1000
+HEARTBEAT_SECONDS = float(os.environ.get('JOBS_HEARTBEAT_SECONDS', 5))
+STALE_SECONDS = float(os.environ.get('JOBS_STALE_SECONDS', 60))
+BACKOFF_SECONDS = float(os.environ.get('JOBS_BACKOFF_SECONDS', 10))
+MAX_BACKOFF_SECONDS = float(os.environ.get('JOBS_MAX_BACKOFF_SECONDS', 3600))
+# given to the running jobs to finish when the pool stops, they are killed and queued again after
+SHUTDOWN_SECONDS = float(os.environ.get('JOBS_SHUTDOWN_SECONDS', 30))
+STATUSES = ('queued', 'running', 'succeeded', 'failed', 'cancelled')
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+jobs_cli = AppGroup('jobs', help="Background jobs")
+
+class JobFailed(Exception):
+    """Raised by a job that must not be retried"""
+
+class JobCancelled(Exception):
+    """Raised in a job that was cancelled (or taken back from its worker) while it ran"""
+
+class JobType:
+    def __init__(self, name, handler, validate, concurrency, max_attempts):
+        self.name = name
+        self.handler = handler
+        self.validate = validate
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+
+JOB_TYPES = {}
+
+def job_type(name, concurrency=1, max_attempts=3, validate=None):
+    """
+    Registers handler(job) for the jobs of type `name`, it returns the JSON
+    result of the job. validate(params) checks the params when the job is
+    queued and returns them cleaned.
+    """
+    def decorator(handler):
+        JOB_TYPES[name] = JobType(name, handler, validate, concurrency, max_attempts)
+        return handler
+    return decorator
+
+class RunningJob:
+    """What a handler sees of its job"""
+
+    def __init__(self, job):
+        self.id = job.id
+        self.type = job.type
+        self.params = json.loads(job.params)
+        self.attempt = job.attempts
+        self.done = job.progress_done
+        self.total = job.progress_total
+        self.cancelled = False
+
+    def progress(self, done, total=None):
+        """Records the progress, saved with the next heartbeat. Raises JobCancelled once the job was cancelled"""
+        self.done = done
+        if total is not None:
+            self.total = total
+        if self.cancelled:
+            raise JobCancelled()
+
+class Heartbeat(threading.Thread):
+    """Saves the progress of a running job on its own connection, and notices when it was cancelled"""
+
+    def __init__(self, engine, job, worker):
+        super().__init__(name='job-heartbeat', daemon=True)
+        self.engine = engine
+        self.job = job
+        self.worker = worker
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(HEARTBEAT_SECONDS):
+            self.beat()
+
+    def beat(self):
+        table = Job.__table__
+        try:
+            with self.engine.begin() as connection:
+                result = connection.execute(
+                    update(table)
+                    .where(table.c.id == self.job.id, table.c.status == 'running', table.c.worker == self.worker)
+                    .values(heartbeat_at=datetime.utcnow(), progress_done=self.job.done, progress_total=self.job.total)
+                )
+        except OperationalError as error:
+            # the database is busy (a SQLite write lock held by the job itself), next time
+            logger.warning("job %s heartbeat failed: %s", self.job.id, error.__class__.__name__)
+            return
+        if result.rowcount == 0:
+            self.job.cancelled = True
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def backoff(attempt):
+    """Seconds before retrying a job that failed its `attempt`th run"""
+    return min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+def is_permanent(error):
+    if isinstance(error, JobFailed):
+        return True
+    # the import errors are APIExceptions, the ones caused by a busy or lost database are worth a retry
+    return isinstance(error, APIException) and not isinstance(error.__context__, OperationalError)
+
+def lock_job_type(type_name):
+    """Until the end of the transaction no other claim of this type runs (PostgreSQL)"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # "jobs" in the high half keeps the key apart from other advisory locks
+        db.session.execute(select(func.pg_advisory_xact_lock(0x6a6f6273 << 32 | zlib.crc32(type_name.encode()))))
+
+def worker_name(pid=None):
+    return "{}:{}".format(socket.gethostname(), pid or os.getpid())
+
+def release_jobs(condition, error):
+    """Queues again the running jobs matching `condition` (their worker is gone), fails the ones out of attempts"""
+    table = Job.__table__
+    now = datetime.utcnow()
+    running = (table.c.status == 'running') & condition
+    requeued = db.session.execute(
+        update(table).where(running, table.c.attempts < table.c.max_attempts)
+        .values(status='queued', run_after=now, worker=None, error=error)
+    ).rowcount
+    failed = db.session.execute(
+        update(table).where(running).values(status='failed', finished_at=now, error=error)
+    ).rowcount
+    db.session.commit()
+    if requeued or failed:
+        logger.warning("%s: %d jobs queued again, %d failed", error, requeued, failed)
+    return requeued + failed
+
+def is_local_worker_alive(name):
+    """True when `name` is a worker process still running on this host"""
+    host, _, pid = (name or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, run by another user
+        return True
+    return True
+
+def release_stale_jobs():
+    table = Job.__table__
+    stale = table.c.heartbeat_at < datetime.utcnow() - timedelta(seconds=STALE_SECONDS)
+    jobs = db.session.execute(select(table.c.id, table.c.worker).where(table.c.status == 'running', stale)).all()
+    lost = [job_id for job_id, worker in jobs if not is_local_worker_alive(worker)]
+    if not lost:
+        db.session.commit()
+        return 0
+    return release_jobs(stale & table.c.id.in_(lost), "worker lost (no heartbeat)")
+
+class Worker:
+    def __init__(self, name, types):
+        self.name = name
+        self.types = types
+
+    def claim(self):
+        """The next due job of a type below its concurrency, marked running for this worker, or None"""
+        table = Job.__table__
+        now = datetime.utcnow()
+        running = dict(db.session.execute(
+            select(table.c.type, func.count()).where(table.c.status == 'running').group_by(table.c.type)
+        ).all())
+        types = [name for name in self.types if running.get(name, 0) < JOB_TYPES[name].concurrency]
+        if not types:
+            db.session.commit()
+            return None
+        candidates = db.session.execute(
+            select(table.c.id, table.c.type)
+            .where(table.c.status == 'queued', table.c.run_after <= now, table.c.type.in_(types))
+            .order_by(table.c.run_after, table.c.id).limit(10)
+        ).all()
+        db.session.commit()
+        for job_id, type_name in candidates:
+            # checked again in the UPDATE, another worker may have claimed a job meanwhile. Under the
+            # lock this UPDATE sees the claims committed before it, not just the ones its snapshot had
+            lock_job_type(type_name)
+            running_now = select(func.count()).select_from(table) \
+                .where(table.c.type == type_name, table.c.status == 'running').scalar_subquery()
+            result = db.session.execute(
+                update(table)
+                .where(table.c.id == job_id, table.c.status == 'queued', running_now < JOB_TYPES[type_name].concurrency)
+                .values(status='running', worker=self.name, attempts=table.c.attempts + 1, started_at=now, heartbeat_at=now)
+            )
+            db.session.commit()
+            if result.rowcount:
+                return db.session.get(Job, job_id)
+        return None
+
+    def finish(self, job_id, **values):
+        """Updates the job unless it is no longer ours (cancelled, or released as stale)"""
+        table = Job.__table__
+        db.session.execute(
+            update(table).where(table.c.id == job_id, table.c.status == 'running', table.c.worker == self.name).values(**values)
+        )
+        db.session.commit()
+
+    def run(self, job):
+        running = RunningJob(job)
+        job_type = JOB_TYPES[job.type]
+        heartbeat = Heartbeat(db.engine, running, self.name)
+        heartbeat.start()
+        logger.info("job %s (%s) started, attempt %s of %s", job.id, job.type, job.attempts, job.max_attempts)
+        start = time.perf_counter()
+        try:
+            result = job_type.handler(running)
+        except Exception as error:
+            db.session.rollback()
+            heartbeat.stop()
+            if isinstance(error, JobCancelled):
+                logger.info("job %s cancelled", job.id)
+                return
+            message = "{}: {}".format(error.__class__.__name__, getattr(error, 'message', None) or error)[:2000]
+            if is_permanent(error) or running.attempt >= job_type.max_attempts:
+                logger.exception("job %s failed", job.id)
+                self.finish(job.id, status='failed', finished_at=datetime.utcnow(), error=message,
+                            progress_done=running.done, progress_total=running.total)
+            else:
+                delay = backoff(running.attempt)
+                logger.warning("job %s failed (%s), retried in %.0fs", job.id, message, delay)
+                self.finish(job.id, status='queued', worker=None, error=message,
+                            run_after=datetime.utcnow() + timedelta(seconds=delay),
+                            progress_done=running.done, progress_total=running.total)
+            return
+        heartbeat.stop()
+        logger.info("job %s succeeded in %.1fs", job.id, time.perf_counter() - start)
+        self.finish(job.id, status='succeeded', finished_at=datetime.utcnow(), result=json.dumps(result), error=None,
+                    progress_done=running.total if running.total is not None else running.done, progress_total=running.total)
+
+    def work(self, stop):
+        """Runs jobs until `stop` is set, the job running then is finished first"""
+        next_stale_check = 0
+        while not stop.is_set():
+            if time.monotonic() >= next_stale_check:
+                release_stale_jobs()
+                next_stale_check = time.monotonic() + STALE_SECONDS / 2
+            job = self.claim()
+            if job is None:
+                # no connection is held while idle
+                db.session.close()
+                stop.wait(POLL_SECONDS)
+                continue
+            self.run(job)
+            db.session.close()
+
+def _worker_process(app, types):
+    reset_after_fork(app)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    # Ctrl-C reaches the whole process group, the pool stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with app.app_context():
+        Worker(worker_name(), types).work(stop)
+
+class WorkerPool:
+    """Worker processes forked from this one, restarted when they die"""
+
+    def __init__(self, app, processes, types):
+        self.app = app
+        self.processes = processes
+        self.types = types
+        self.workers = {}
+        self.stopping = False
+        self.context = multiprocessing.get_context('fork')
+
+    def start_worker(self, index):
+        process = self.context.Process(target=_worker_process, args=(self.app, self.types), name='jobs-worker-{}'.format(index))
+        process.start()
+        self.workers[index] = process
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        # the workers must not share the connections of this process
+        db.engine.dispose()
+        for index in range(self.processes):
+            self.start_worker(index)
+        logger.info("%d job workers started for: %s", self.processes, ", ".join(self.types))
+        while not self.stopping:
+            time.sleep(1)
+            for index, process in list(self.workers.items()):
+                if not process.is_alive() and not self.stopping:
+                    logger.warning("job worker %s exited with code %s, restarted", process.pid, process.exitcode)
+                    release_jobs(Job.__table__.c.worker == worker_name(process.pid), "worker exited")
+                    self.start_worker(index)
+        for process in self.workers.values():
+            process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_SECONDS
+        for process in self.workers.values():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+                release_jobs(Job.__table__.c.worker == worker_name(process.pid), "worker stopped")
+
+def enqueue(type_name, params=None, run_after=None):
+    """Queues a job, returns it"""
+    job_type = JOB_TYPES.get(type_name)
+    if job_type is None:
+        raise APIException("unknown job type, available: {}".format(", ".join(JOB_TYPES)), status_code=400)
+    params = params or {}
+    if not isinstance(params, dict):
+        raise APIException("params must be an object", status_code=400)
+    if job_type.validate is not None:
+        params = job_type.validate(params)
+    now = datetime.utcnow()
+    job = Job(type=type_name, params=json.dumps(params), status='queued', attempts=0,
+              max_attempts=job_type.max_attempts, run_after=run_after or now, created_at=now)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def wants_async():
+    return request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+def enqueue_request():
+    """Queues the job in the body of the current request, {"type": ..., "params": {...}}"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data.get('type'):
+        raise APIException("the body must be a JSON object with a type and optional params", status_code=400)
+    return enqueue(data['type'], data.get('params'))
+
+def list_jobs_request():
+    """Latest jobs first, filtered with ?status= and ?type="""
+    limit = get_page_args()
+    statement = select(Job).order_by(Job.id.desc()).limit(limit)
+    status = request.args.get('status')
+    if status:
+        if status not in STATUSES:
+            raise APIException("status must be one of: {}".format(", ".join(STATUSES)), status_code=400)
+        statement = statement.where(Job.status == status)
+    if request.args.get('type'):
+        statement = statement.where(Job.type == request.args['type'])
+    return [job.serialize() for job in db.session.execute(statement).scalars()]
+
+def cancel_job(job):
+    """Cancels a queued or running job, a running one stops at its next progress report"""
+    table = Job.__table__
+    result = db.session.execute(
+        update(table).where(table.c.id == job.id, table.c.status.in_(('queued', 'running')))
+        .values(status='cancelled', finished_at=datetime.utcnow())
+    )
+    db.session.commit()
+    if result.rowcount == 0:
+        raise APIException("job already {}".format(job.status), status_code=409)
+    db.session.refresh(job)
+    return job
+
+def enqueue_import_request():
+    """Saves the body of an /import?async=1 request to UPLOADS_DIR and queues its import"""
+    import_format, table_name, import_id, on_conflict = import_args(request.args)
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    path = os.path.join(UPLOADS_DIR, "{}.{}".format(uuid.uuid4().hex, import_format))
+    with open(path, 'wb') as upload:
+        while True:
+            chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            upload.write(chunk)
+    return enqueue('import', {'path': path, 'format': import_format, 'table': table_name,
+                              'import_id': import_id, 'on_conflict': on_conflict})
+
+def export_path(job):
+    """The file written by a succeeded export job, or None"""
+    if job.type != 'export' or job.status != 'succeeded':
+        return None
+    path = json.loads(job.result)['path']
+    return path if os.path.exists(path) else None
+
+# Job types
+
+def _int_param(params, name, default):
+    try:
+        value = int(params.get(name, default))
+    except (TypeError, ValueError):
+        value = 0
+    if value < 1:
+        raise APIException("{} must be a positive integer".format(name), status_code=400)
+    return value
+
+def _validate_import(params):
+    import_format, table_name, import_id, on_conflict = import_args(params)
+    path = os.path.realpath(params.get('path') or '')
+    if not path.startswith(os.path.realpath(JOBS_DIR) + os.sep) or not os.path.isfile(path):
+        raise APIException("path must be a file in {}".format(JOBS_DIR), status_code=400)
+    return {'path': path, 'format': import_format, 'table': table_name, 'import_id': import_id, 'on_conflict': on_conflict}
+
+@job_type('import', concurrency=1, max_attempts=5, validate=_validate_import)
+def import_job(job):
+    """Catalog import of a file, resumed from its checkpoint when retried"""
+    params = job.params
+    size = os.path.getsize(params['path'])
+    result = import_file(params['path'], params['format'], params['table'], params['import_id'], params['on_conflict'],
+                         progress=lambda records, offset: job.progress(offset, size))
+    job.progress(size, size)
+    if os.path.dirname(params['path']) == os.path.realpath(UPLOADS_DIR):
+        os.remove(params['path'])
+    return dict(result, import_id=params['import_id'])
+
+def _validate_export(params):
+    export_format = params.get('format', 'ndjson')
+    if export_format not in CATALOG_FORMATS:
+        raise APIException("format must be one of: {}".format(", ".join(CATALOG_FORMATS)), status_code=400)
+    tables = params.get('tables')
+    if isinstance(tables, list):
+        tables = ",".join(tables)
+    return {'format': export_format, 'tables': parse_tables(tables, export_format == 'csv')}
+
+@job_type('export', concurrency=2, validate=_validate_export)
+def export_job(job):
+    """Catalog export to a file in EXPORTS_DIR, served by /jobs/<id>/result"""
+    export_format, tables = job.params['format'], job.params['tables']
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    path = os.path.join(EXPORTS_DIR, "catalog-{}.{}".format(job.id, export_format))
+    # a retry or a reader never sees a partial file under the final name
+    partial = path + '.partial'
+    with open(partial, 'wb') as output:
+        for done, table_name in enumerate(tables, 1):
+            for chunk in export_csv(table_name) if export_format == 'csv' else export_ndjson([table_name]):
+                output.write(chunk)
+            job.progress(done, len(tables))
+    os.replace(partial, path)
+    return {'path': path, 'format': export_format, 'bytes': os.path.getsize(path)}
+
+@job_type('reindex_search', concurrency=1)
+def reindex_search_job(job):
+    """Rebuilds the search index"""
+    return {'indexed': rebuild_search_index(job.progress)}
+
+@job_type('reconcile_favorites', concurrency=1,
+          validate=lambda params: {'batch_size': _int_param(params, 'batch_size', 10000)})
+def reconcile_favorites_job(job):
+    """Recounts the favorite_count the leaderboards are read from"""
+    return {'corrected': reconcile_favorite_counts(job.params['batch_size'])}
+
+@job_type('prune_changes', concurrency=1,
+          validate=lambda params: {'days': _int_param(params, 'days', int(os.environ.get('CHANGES_RETENTION_DAYS', 30)))})
+def prune_changes_job(job):
+    """Drops the old change log entries"""
+    return {'deleted': prune_changes(job.params['days'])}
+
+def parse_concurrency(value):
+    """{type: concurrency} from `type=n,type=n`"""
+    limits = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        name, _, limit = item.strip().partition('=')
+        if name not in JOB_TYPES:
+            raise ValueError("JOBS_CONCURRENCY: unknown job type {}".format(name))
+        limits[name] = int(limit)
+    return limits
+
+def parse_types(value):
+    types = [name for name in (value or '').split(',') if name] or list(JOB_TYPES)
+    unknown = [name for name in types if name not in JOB_TYPES]
+    if unknown:
+        raise click.BadParameter("unknown job types: {}".format(", ".join(unknown)))
+    return types
+
+@jobs_cli.command('worker')
+@click.option('--processes', default=int(os.environ.get('JOBS_PROCESSES', 2)), help="worker processes")
+@click.option('--types', help="comma separated job types to run, every type by default")
+def worker_command(processes, types):
+    """Runs queued jobs until stopped (SIGTERM or Ctrl-C)"""
+    WorkerPool(current_app._get_current_object(), processes, parse_types(types)).run()
+
+@jobs_cli.command('enqueue')
+@click.argument('type_name', metavar='TYPE')
+@click.option('--params', default='{}', help="JSON object")
+def enqueue_command(type_name, params):
+    """Queues a job"""
+    try:
+        job = enqueue(type_name, json.loads(params))
+    except (ValueError, APIException) as error:
+        raise click.ClickException(getattr(error, 'message', None) or str(error))
+    click.echo("job {} queued".format(job.id))
+
+@jobs_cli.command('prune')
+@click.option('--days', default=7, help="finished jobs kept, in days")
+def prune_command(days):
+    """Deletes the jobs finished before, and the files of their exports"""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    finished = select(Job).where(Job.status.in_(('succeeded', 'failed', 'cancelled')), Job.finished_at < cutoff)
+    jobs = db.session.execute(finished).scalars().all()
+    for job in jobs:
+        path = export_path(job)
+        if path is not None:
+            os.remove(path)
+    db.session.execute(delete(Job.__table__).where(Job.id.in_([job.id for job in jobs])))
+    db.session.commit()
+    click.echo("{} jobs deleted".format(len(jobs)))
+
+def setup_jobs(app):
+    for name, limit in parse_concurrency(os.environ.get('JOBS_CONCURRENCY')).items():
+        JOB_TYPES[name].concurrency = limit
+    app.cli.add_command(jobs_cli)
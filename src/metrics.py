@@ -0,0 +1,154 @@
+"""
+Per-request performance instrumentation: latency histograms per endpoint,
+SQL statement counts and time (from SQLAlchemy engine events), a slow query
+log, Server-Timing response headers and a Prometheus text exposition.
+Metrics are kept per worker process.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque, defaultdict
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('api.performance')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_MS', 200)) / 1000
+# more statements than this in one request is almost always an N+1
+STATEMENTS_WARNING = int(os.environ.get('STATEMENTS_PER_REQUEST_WARNING', 50))
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+    def exposition(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, round(self.total, 6)))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, self.count))
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.statements = defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+        self.db_seconds = defaultdict(float)
+        self.serialize_seconds = defaultdict(float)
+        self.slow_queries = deque(maxlen=100)
+
+    def observe_request(self, labels, seconds, statements, db_seconds, serialize_seconds):
+        with self.lock:
+            self.latency[labels].observe(seconds)
+            self.statements[labels[:2]].observe(statements)
+            self.db_seconds[labels[:2]] += db_seconds
+            self.serialize_seconds[labels[:2]] += serialize_seconds
+
+registry = Registry()
+
+def record_timing(name, seconds):
+    """Adds time spent in a phase of the current request (e.g. 'serialize')"""
+    if has_app_context() and 'request_timings' in g:
+        g.request_timings[name] = g.request_timings.get(name, 0.0) + seconds
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - connection.info['query_start'].pop()
+    if has_app_context() and 'request_timings' in g:
+        g.request_statements += 1
+        g.request_timings['db'] = g.request_timings.get('db', 0.0) + seconds
+    if seconds >= SLOW_QUERY_SECONDS:
+        endpoint = request.endpoint if has_app_context() and 'request_timings' in g else None
+        registry.slow_queries.append({
+            "statement": statement,
+            "ms": round(seconds * 1000, 3),
+            "executemany": executemany,
+            "endpoint": endpoint,
+            "at": time.time(),
+        })
+        logger.warning("slow query (%.1f ms) in %s: %s", seconds * 1000, endpoint, statement)
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # a statement that raised never reaches after_cursor_execute
+    if context.connection is not None:
+        started = context.connection.info.get('query_start')
+        if started:
+            started.pop()
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.request_statements = 0
+    g.request_timings = {}
+
+def _finish_request(response):
+    if 'request_start' not in g:
+        return response
+    seconds = time.perf_counter() - g.request_start
+    timings = g.request_timings
+    endpoint = request.endpoint or 'unmatched'
+    registry.observe_request(
+        (endpoint, request.method, str(response.status_code)),
+        seconds, g.request_statements, timings.get('db', 0.0), timings.get('serialize', 0.0)
+    )
+    if g.request_statements > STATEMENTS_WARNING:
+        logger.warning("%s ran %d SQL statements in one request", endpoint, g.request_statements)
+
+    server_timing = ['db;dur={:.2f};desc="{} queries"'.format(timings.get('db', 0.0) * 1000, g.request_statements)]
+    for name, value in timings.items():
+        if name != 'db':
+            server_timing.append('{};dur={:.2f}'.format(name, value * 1000))
+    server_timing.append('total;dur={:.2f}'.format(seconds * 1000))
+    response.headers['Server-Timing'] = ', '.join(server_timing)
+    return response
+
+def prometheus_text(extra_gauges=()):
+    """Prometheus text exposition of every metric of this worker"""
+    lines = [
+        '# HELP api_request_duration_seconds Request latency per endpoint',
+        '# TYPE api_request_duration_seconds histogram',
+    ]
+    with registry.lock:
+        for (endpoint, method, status), histogram in sorted(registry.latency.items()):
+            labels = 'endpoint="{}",method="{}",status="{}"'.format(endpoint, method, status)
+            lines += histogram.exposition('api_request_duration_seconds', labels)
+        lines += ['# HELP api_request_sql_statements SQL statements run per request', '# TYPE api_request_sql_statements histogram']
+        for (endpoint, method), histogram in sorted(registry.statements.items()):
+            lines += histogram.exposition('api_request_sql_statements', 'endpoint="{}",method="{}"'.format(endpoint, method))
+        lines += ['# HELP api_request_db_seconds_total Time spent in SQL', '# TYPE api_request_db_seconds_total counter']
+        for (endpoint, method), value in sorted(registry.db_seconds.items()):
+            lines.append('api_request_db_seconds_total{{endpoint="{}",method="{}"}} {}'.format(endpoint, method, round(value, 6)))
+        lines += ['# HELP api_request_serialize_seconds_total Time spent encoding responses', '# TYPE api_request_serialize_seconds_total counter']
+        for (endpoint, method), value in sorted(registry.serialize_seconds.items()):
+            lines.append('api_request_serialize_seconds_total{{endpoint="{}",method="{}"}} {}'.format(endpoint, method, round(value, 6)))
+    for name, help_text, value in extra_gauges:
+        lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} gauge'.format(name), '{} {}'.format(name, value)]
+    return '\n'.join(lines) + '\n'
+
+def setup_metrics(app):
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
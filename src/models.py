@@ -1,14 +1,21 @@
+import json
 from flask_sqlalchemy import SQLAlchemy
+from replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(db.Model):
     __tablename__ = 'user'
+    serialize_fields = ('id', 'name', 'email', 'is_active')
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120))
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password = db.Column(db.String(80), nullable=False)
+    # scrypt hash, see passwords.py
+    password = db.Column(db.String(255), nullable=False)
     is_active = db.Column(db.Boolean, nullable=False)
+    # bumped by every update, compared with If-Match (see updates.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
     
 
     def __repr__(self):
@@ -19,17 +26,20 @@ class User(db.Model):
             "id": self.id,
             "name": self.name,
             "email": self.email,
-            "is_active": self.is_active,
-            "password": self.password
-            
+            "is_active": self.is_active
         }
 
 class Planet(db.Model):
     __tablename__ = 'planet'
+    serialize_fields = ('id', 'name', 'climate', 'population', 'favorite_count')
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(250), nullable=False)
+    name = db.Column(db.String(250), nullable=False, index=True)
     climate = db.Column(db.String(250))
-    population = db.Column(db.Integer, nullable=True)
+    population = db.Column(db.Integer, nullable=True, index=True)
+    # kept up to date by favorite_writes.py, fixed by `flask favorites reconcile`
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return f"Planeta {self.id} de nombre {self.name}"
@@ -39,15 +49,19 @@ class Planet(db.Model):
             "id": self.id,
             "name": self.name,
             "climate": self.climate,
-            "population": self.population
+            "population": self.population,
+            "favorite_count": self.favorite_count
         }
     
 class FavoritePlanet(db.Model):
     __tablename__ = 'favorite_planets'
+    __table_args__ = (
+        db.Index('ix_favorite_planets_user_id_planet_id', 'user_id', 'planet_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     user_id_relationship = db.relationship(User)
-    planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'))
+    planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'), index=True)
     planet_relationship = db.relationship(Planet) 
     
     def __repr__(self):
@@ -62,10 +76,17 @@ class FavoritePlanet(db.Model):
 
 class Character(db.Model):
     __tablename__ = 'character'
+    serialize_fields = ('id', 'name', 'species', 'gender', 'homeworld_id', 'favorite_count')
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(250))
-    species = db.Column(db.String(250))
+    name = db.Column(db.String(250), index=True)
+    species = db.Column(db.String(250), index=True)
     gender = db.Column(db.String(250))
+    homeworld_id = db.Column(db.Integer, db.ForeignKey('planet.id', ondelete='SET NULL'), nullable=True, index=True)
+    homeworld = db.relationship(Planet, backref='residents')
+    # kept up to date by favorite_writes.py, fixed by `flask favorites reconcile`
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
     
 
     def __repr__(self):
@@ -76,15 +97,20 @@ class Character(db.Model):
             "id": self.id,
             "name": self.name,
             "species": self.species,
-            "gender": self.gender
+            "gender": self.gender,
+            "homeworld_id": self.homeworld_id,
+            "favorite_count": self.favorite_count
         }
     
 class FavoriteCharacter(db.Model):
     __tablename__ = 'favorite_characters'
+    __table_args__ = (
+        db.Index('ix_favorite_characters_user_id_character_id', 'user_id', 'character_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     user_id_relationship = db.relationship(User)
-    character_id = db.Column(db.Integer, db.ForeignKey('character.id'))
+    character_id = db.Column(db.Integer, db.ForeignKey('character.id'), index=True)
     character_relationship = db.relationship(Character) 
 
     def __repr__(self):
@@ -100,8 +126,11 @@ class FavoriteCharacter(db.Model):
 
 class Vehicle_Starship(db.Model):
     __tablename__ = 'vehicle_starship'
+    serialize_fields = ('id', 'name', 'favorite_count')
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20), unique=True)
+    # kept up to date by favorite_writes.py, fixed by `flask favorites reconcile`
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
 
     def __repr__(self):
         return f"Vehicle {self.id} de nombre {self.name}"
@@ -110,14 +139,39 @@ class Vehicle_Starship(db.Model):
         return {
             "id": self.id,
             "name": self.name,
+            "favorite_count": self.favorite_count
         }
     
+class VehiclePilot(db.Model):
+    __tablename__ = 'vehicle_pilots'
+    __table_args__ = (
+        db.Index('ix_vehicle_pilots_vehicle_starship_id_character_id', 'vehicle_starship_id', 'character_id', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    vehicle_starship_id = db.Column(db.Integer, db.ForeignKey('vehicle_starship.id', ondelete='CASCADE'), nullable=False)
+    character_id = db.Column(db.Integer, db.ForeignKey('character.id', ondelete='CASCADE'), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"Character {self.character_id} pilota vehiculo {self.vehicle_starship_id}"
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "vehicle_starship_id": self.vehicle_starship_id,
+            "character_id": self.character_id
+        }
+
+Vehicle_Starship.pilots = db.relationship(Character, secondary=VehiclePilot.__table__, backref='vehicles', viewonly=True)
+
 class FavoriteVehicleStarship(db.Model):
     __tablename__ = 'favorite_vehicles_starships'
+    __table_args__ = (
+        db.Index('ix_favorite_vehicles_starships_user_id_vehicle_starship_id', 'user_id', 'vehicle_starship_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     user_id_relationship = db.relationship(User)
-    vehicle_starship_id = db.Column(db.Integer, db.ForeignKey('vehicle_starship.id'))
+    vehicle_starship_id = db.Column(db.Integer, db.ForeignKey('vehicle_starship.id'), index=True)
     vehicle_starship_relationship = db.relationship(Vehicle_Starship) 
 
     def __repr__(self):
@@ -130,6 +184,87 @@ class FavoriteVehicleStarship(db.Model):
             "vehicle_starship_id": self.vehicle_starship_id
         }
 
+class TableVersion(db.Model):
+    __tablename__ = 'table_version'
+    table_name = db.Column(db.String(80), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"Tabla {self.table_name} version {self.version}"
+
+class ImportCheckpoint(db.Model):
+    __tablename__ = 'import_checkpoint'
+    import_id = db.Column(db.String(120), primary_key=True)
+    # input records committed so far and where they end in the input file
+    records = db.Column(db.BigInteger, nullable=False, default=0)
+    byte_offset = db.Column(db.BigInteger, nullable=False, default=0)
+    finished = db.Column(db.Boolean, nullable=False, default=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"Import {self.import_id}: {self.records} registros"
+
+class ChangeLog(db.Model):
+    __tablename__ = 'change_log'
+    # without AUTOINCREMENT SQLite reuses the seqs of a pruned tail, clients would miss changes
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    table_name = db.Column(db.String(80), nullable=False)
+    # None when one statement wrote many rows of the table
+    row_id = db.Column(db.Integer)
+    op = db.Column(db.String(10), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"Cambio {self.seq}: {self.op} {self.table_name} {self.row_id}"
+
+class Job(db.Model):
+    __tablename__ = 'job'
+    __table_args__ = (
+        db.Index('ix_job_status_run_after', 'status', 'run_after'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(40), nullable=False)
+    # JSON
+    params = db.Column(db.Text, nullable=False)
+    # queued, running, succeeded, failed or cancelled
+    status = db.Column(db.String(20), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    # a queued job runs from then on, later than created_at when retried with backoff
+    run_after = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    worker = db.Column(db.String(80))
+    progress_done = db.Column(db.BigInteger)
+    progress_total = db.Column(db.BigInteger)
+    # JSON
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+
+    def __repr__(self):
+        return f"Job {self.id} {self.type}: {self.status}"
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "type": self.type,
+            "params": json.loads(self.params),
+            "status": self.status,
+            "attempts": self.attempts,
+            "max_attempts": self.max_attempts,
+            "progress": {"done": self.progress_done, "total": self.progress_total},
+            "result": json.loads(self.result) if self.result else None,
+            "error": self.error,
+            "run_after": self.run_after.isoformat(),
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
 '''class Favorite(db.Model):
     __tablename__ = 'favorite_planets'
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,86 @@
+"""
+Keyset (cursor) pagination and streaming helpers for the collection endpoints
+"""
+from flask import Response, request, stream_with_context
+from sqlalchemy import select
+from models import db
+from serialization import encode, columns, rows_to_dicts
+from utils import APIException
+from includes import expand
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+# rows fetched per round trip from the server-side cursor when streaming
+STREAM_CHUNK_SIZE = 500
+
+def parse_page_args(args):
+    """Validates `limit` from a query string mapping, `after` is read by filters.parse_listing"""
+    try:
+        limit = int(args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise APIException("limit must be an integer", status_code=400)
+    if limit < 1 or limit > MAX_LIMIT:
+        raise APIException("limit must be between 1 and {}".format(MAX_LIMIT), status_code=400)
+    return limit
+
+def get_page_args():
+    return parse_page_args(request.args)
+
+def wants_stream():
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+def keyset_statement(model, limit, fields, listing):
+    """
+    SELECT for one page of the listing as plain tuples of `fields`. The page
+    starts right after the cursor (`id > after` by default), so it is served
+    from an index and every page costs the same no matter how deep the client
+    has paged. One extra row is fetched to know if there is a next page
+    without a COUNT(*).
+    """
+    statement = select(*columns(model, fields), *listing.sort_columns())
+    return listing.apply(statement).limit(limit + 1)
+
+def split_page(rows, limit, listing):
+    """Returns the rows of the page and the cursor for the next one"""
+    next_cursor = listing.cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def keyset_page(model, limit, fields, listing):
+    rows = db.session.execute(keyset_statement(model, limit, fields, listing)).all()
+    return split_page(rows, limit, listing)
+
+def stream_collection(model, fields, listing, includes=()):
+    """
+    Streams the whole listing as the usual {"msg": "ok", "result": [...]}
+    document, reading the rows from a server-side cursor in chunks so memory
+    stays flat however big the table is. Included rows are loaded per chunk.
+    """
+    statement = listing.apply(select(*columns(model, fields)))
+
+    def generate():
+        result = db.session.execute(statement.execution_options(stream_results=True, yield_per=STREAM_CHUNK_SIZE))
+        yield '{"msg": "ok", "result": ['
+        separator = ''
+        for chunk in result.partitions(STREAM_CHUNK_SIZE):
+            # encode the chunk as an array and strip the brackets
+            yield separator + encode(expand(model, rows_to_dicts(fields, chunk), includes)).decode()[1:-1]
+            separator = ','
+        yield ']}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def parse_offset_args(args):
+    """Validates `limit` and `offset` for endpoints whose ordering has no single key column"""
+    try:
+        limit = int(args.get('limit', DEFAULT_LIMIT))
+        offset = int(args.get('offset', 0))
+    except ValueError:
+        raise APIException("limit and offset must be integers", status_code=400)
+    if limit < 1 or limit > MAX_LIMIT:
+        raise APIException("limit must be between 1 and {}".format(MAX_LIMIT), status_code=400)
+    if offset < 0:
+        raise APIException("offset can't be negative", status_code=400)
+    return limit, offset
+
+def get_offset_args():
+    return parse_offset_args(request.args)
@@ -0,0 +1,139 @@
+"""
+Password hashing with scrypt (memory hard, in the standard library).
+
+A hash takes tens of milliseconds of CPU, so it runs in a small bounded pool
+of threads (hashlib releases the GIL while hashing) instead of on every
+request thread at once. When the pool and its queue are full, callers get a
+503 right away, so a burst of logins can't starve the rest of the API.
+
+Stored format: scrypt$<n>$<r>$<p>$<salt>$<hash> (base64). Legacy plain text
+passwords are stored as plain$<password> (see migration 9d4e2b7f1a38), they
+are rehashed on the next login or by `flask passwords rehash`. Anything else
+is malformed and no password verifies against it.
+"""
+import os
+import re
+import hmac
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, update
+from models import db, User
+from utils import APIException
+
+SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14))
+SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', 8))
+SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', 1))
+WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+# hashes allowed to wait for a worker before new ones are rejected
+QUEUE_SIZE = int(os.environ.get('PASSWORD_HASH_QUEUE', 16))
+RETRY_AFTER_SECONDS = 1
+PREFIX = 'scrypt'
+LEGACY_PREFIX = 'plain$'
+_HASHED = re.compile(r'scrypt\$\d+\$\d+\$\d+\$[A-Za-z0-9+/]+={0,2}\$[A-Za-z0-9+/]+={0,2}\Z')
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(WORKERS + QUEUE_SIZE)
+
+def _get_executor():
+    # threads don't survive a fork, a forked worker starts its own pool
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='password-hash')
+            _executor_pid = os.getpid()
+        return _executor
+
+def _run(function, *args):
+    if not _slots.acquire(blocking=False):
+        raise APIException("Too many password operations in progress, try again later",
+                           status_code=503, headers={'Retry-After': str(RETRY_AFTER_SECONDS)})
+    try:
+        return _get_executor().submit(function, *args).result()
+    finally:
+        _slots.release()
+
+def _b64(data):
+    return base64.b64encode(data).decode()
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+def _hash(password):
+    salt = os.urandom(16)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return '$'.join((PREFIX, str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P), _b64(salt), _b64(digest)))
+
+def _verify(password, stored):
+    if is_legacy(stored):
+        return hmac.compare_digest(password.encode(), stored[len(LEGACY_PREFIX):].encode())
+    if not is_hashed(stored):
+        return False
+    _, n, r, p, salt, digest = stored.split('$')
+    return hmac.compare_digest(_scrypt(password, base64.b64decode(salt), int(n), int(r), int(p)), base64.b64decode(digest))
+
+# verified when the user doesn't exist, so the response time doesn't tell
+_DUMMY_HASH = '$'.join((PREFIX, str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P), _b64(b'\0' * 16), _b64(b'\0' * 32)))
+
+def unusable_password():
+    """A well-formed hash of a random digest: no password verifies against it"""
+    return '$'.join((PREFIX, str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P), _b64(os.urandom(16)), _b64(os.urandom(32))))
+
+def is_hashed(stored):
+    return isinstance(stored, str) and _HASHED.match(stored) is not None
+
+def is_legacy(stored):
+    return stored.startswith(LEGACY_PREFIX)
+
+def needs_rehash(stored):
+    """Legacy passwords and hashes made with other parameters"""
+    return not is_hashed(stored) or stored.split('$')[1:4] != [str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P)]
+
+def hash_password(password):
+    return _run(_hash, password)
+
+def verify_password(password, stored):
+    """True when `password` matches the stored value, `stored` None runs a dummy check"""
+    if stored is None:
+        _run(_verify, password, _DUMMY_HASH)
+        return False
+    return _run(_verify, password, stored)
+
+def rehash_legacy_passwords(batch_size=100):
+    """Hashes the legacy passwords still stored, `batch_size` users per transaction. Returns how many"""
+    table = User.__table__
+    rehashed = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(table.c.id, table.c.password)
+            .where(table.c.id > last_id, table.c.password.startswith(LEGACY_PREFIX))
+            .order_by(table.c.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return rehashed
+        for user_id, stored in rows:
+            # a login may have rehashed it meanwhile, then the stored value no longer matches
+            result = db.session.execute(
+                update(table).where(table.c.id == user_id, table.c.password == stored)
+                .values(password=_hash(stored[len(LEGACY_PREFIX):]))
+            )
+            rehashed += result.rowcount
+        db.session.commit()
+        last_id = rows[-1].id
+
+passwords_cli = AppGroup('passwords', help="Password storage maintenance")
+
+@passwords_cli.command('rehash')
+@click.option('--batch-size', default=100, help="users per transaction")
+def rehash_command(batch_size):
+    """Hashes the legacy plain text passwords"""
+    click.echo("{} passwords rehashed".format(rehash_legacy_passwords(batch_size)))
+
+def setup_passwords(app):
+    app.cli.add_command(passwords_cli)
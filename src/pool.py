@@ -0,0 +1,97 @@
+"""
+Engine and connection pool options read from the environment, and a
+QueuePool that keeps statistics about its checkouts
+"""
+import os
+import time
+import threading
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+def env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes')
+
+class PoolStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record_checkout(self, wait, overflow):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_seconds_total += wait
+            self.wait_seconds_max = max(self.wait_seconds_max, wait)
+            if overflow:
+                self.overflow_checkouts += 1
+
+    def record_timeout(self):
+        with self.lock:
+            self.timeouts += 1
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool measuring how long each checkout waited for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.record_timeout()
+            raise
+        self.stats.record_checkout(time.perf_counter() - start, self.overflow() > 0)
+        return connection
+
+def engine_options(database_url):
+    """SQLALCHEMY_ENGINE_OPTIONS for the given database"""
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': env_bool('DB_POOL_PRE_PING', True),
+    }
+    statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    if database_url.startswith('postgresql') and statement_timeout:
+        options['connect_args'] = {'options': '-c statement_timeout={}'.format(statement_timeout)}
+    elif database_url.startswith('sqlite'):
+        # pooled SQLite connections are handed to whichever thread checks them out
+        options['connect_args'] = {'check_same_thread': False}
+    return options
+
+def async_engine_options(database_url):
+    """Same sizing for the async engine of asgi.py"""
+    options = engine_options(database_url)
+    options['poolclass'] = AsyncAdaptedQueuePool
+    options.pop('connect_args', None)
+    statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    if database_url.startswith('postgresql') and statement_timeout:
+        options['connect_args'] = {'server_settings': {'statement_timeout': str(statement_timeout)}}
+    return options
+
+def pool_status(pool):
+    status = {
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        'overflow': pool.overflow(),
+    }
+    stats = getattr(pool, 'stats', None)
+    if stats is not None:
+        with stats.lock:
+            status.update({
+                'checkouts': stats.checkouts,
+                'overflow_checkouts': stats.overflow_checkouts,
+                'timeouts': stats.timeouts,
+                'wait_ms_avg': round(stats.wait_seconds_total / stats.checkouts * 1000, 3) if stats.checkouts else 0.0,
+                'wait_ms_max': round(stats.wait_seconds_max * 1000, 3),
+            })
+    return status
@@ -0,0 +1,68 @@
+"""
+Startup profiles, APP_PROFILE:
+
+    full  the API, /admin and /swagger.json (the default)
+    api   the API only, for workers that never serve the admin
+
+In the full profile the admin is built on the first /admin request, so a
+worker that only serves the API never imports flask_admin or builds its views.
+"""
+import os
+import threading
+from models import db
+from cache import SQLiteBackend
+from admission import SQLiteBuckets
+import replicas
+
+PROFILES = ('full', 'api')
+
+class LazyMount:
+    """WSGI middleware serving `prefix` with an app built by `factory` on its first request"""
+
+    def __init__(self, wsgi_app, prefix, factory):
+        self.wsgi_app = wsgi_app
+        self.prefix = prefix
+        self.factory = factory
+        self.mounted = None
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path != self.prefix and not path.startswith(self.prefix + '/'):
+            return self.wsgi_app(environ, start_response)
+        if self.mounted is None:
+            with self.lock:
+                if self.mounted is None:
+                    self.mounted = self.factory()
+        return self.mounted(environ, start_response)
+
+def _create_admin_app(app):
+    # imported here, the api profile never loads flask_admin
+    from admin import create_admin_app
+    return create_admin_app(app)
+
+def setup_profile(app):
+    profile = os.environ.get('APP_PROFILE', 'full')
+    if profile not in PROFILES:
+        raise ValueError("APP_PROFILE must be one of: {}".format(", ".join(PROFILES)))
+    app.config['APP_PROFILE'] = profile
+    if profile == 'full':
+        app.wsgi_app = LazyMount(app.wsgi_app, '/admin', lambda: _create_admin_app(app))
+    return profile
+
+def reset_after_fork(app):
+    """
+    Drops what a worker inherited from the gunicorn master with preload_app:
+    pooled connections and SQLite handles must not be shared by two processes.
+    """
+    with app.app_context():
+        db.engine.dispose(close=False)
+    if replicas.router is not None:
+        for replica in replicas.router.replicas:
+            replica.engine.dispose(close=False)
+    cache = app.extensions.get('response_cache')
+    if cache is not None and isinstance(cache.backend, SQLiteBackend):
+        cache.backend.local = threading.local()
+    admission = app.extensions.get('admission')
+    if admission is not None and isinstance(admission.buckets, SQLiteBuckets):
+        admission.buckets.local = threading.local()
@@ -0,0 +1,244 @@
+"""
+Read replica routing.
+
+DATABASE_REPLICA_URLS (comma separated) lists read replicas of DATABASE_URL.
+The SELECTs of GET and HEAD requests go to one replica per request, picked
+round robin among the healthy ones. Everything else uses the primary: other
+methods, writes, and every statement of a request after its first write.
+
+Once a request commits a write the client gets a cookie sending its reads to
+the primary for REPLICA_STICKY_SECONDS, so it reads its own writes while the
+replicas catch up. An X-Read-Primary: 1 header does the same for one request.
+
+A background thread checks the replicas every REPLICA_CHECK_SECONDS. A
+replica that fails, or misses a write committed on the primary more than
+REPLICA_MAX_LAG_SECONDS ago, is out of rotation until it catches up. Writes
+are detected with the table_version rows, so the check works on any
+database, including two SQLite files standing in for a primary and its
+replica. Each primary version is remembered with the time it was reached,
+the lag of a replica is the age of the first version it doesn't have yet
+(not of the primary's latest write, which is always recent under steady
+writes). With no healthy replica, reads go to the primary.
+"""
+import os
+import time
+import logging
+import threading
+import itertools
+from datetime import datetime
+from flask import g, request, has_app_context, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, select
+import tracking
+from pool import engine_options, pool_status
+
+logger = logging.getLogger('api.replicas')
+
+STICKY_COOKIE = 'read_primary_until'
+
+def _is_plain_select(clause):
+    return getattr(clause, 'is_select', False) and getattr(clause, '_for_update_arg', None) is None
+
+class RoutingSession(Session):
+    """Sends the SELECTs of replica eligible requests to the replica picked for them"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and clause is not None and has_app_context():
+            if not self._flushing and _is_plain_select(clause):
+                replica = g.get('db_replica')
+                if replica is not None:
+                    g.db_replica_used = True
+                    return replica
+            else:
+                # the rest of the request must see what it wrote
+                read_from_primary()
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+class Replica:
+    def __init__(self, url):
+        self.engine = create_engine(url, **engine_options(url))
+        # out of rotation until the first check passes
+        self.healthy = False
+        self.lag_seconds = None
+        self.error = None
+        self.checked_at = None
+
+    def status(self):
+        return {
+            'url': self.engine.url.render_as_string(hide_password=True),
+            'healthy': self.healthy,
+            'lag_seconds': self.lag_seconds,
+            'error': self.error,
+            'checked_at': self.checked_at.isoformat() if self.checked_at else None,
+            'pool': pool_status(self.engine.pool),
+        }
+
+class ReplicaRouter:
+    def __init__(self, app, urls, max_lag, interval, sticky_seconds):
+        self.app = app
+        self.replicas = [Replica(url) for url in urls]
+        self.max_lag = max_lag
+        self.interval = interval
+        self.sticky_seconds = sticky_seconds
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # table -> [(version, when the primary had it)], oldest first
+        self.seen = {}
+        self.thread = None
+        self.pid = None
+        for replica in self.replicas:
+            event.listen(replica.engine, 'handle_error', self._on_error(replica))
+
+    def _on_error(self, replica):
+        def handle_error(context):
+            # don't wait for the next check to stop sending requests to a replica that went away
+            if context.is_disconnect or context.connection is None:
+                replica.healthy = False
+                replica.error = str(context.original_exception)
+                logger.warning("replica %s failed, taken out of rotation", replica.engine.url.render_as_string(hide_password=True))
+        return handle_error
+
+    def pick(self):
+        """The engine of a healthy replica, None when there is none"""
+        self._ensure_thread()
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self.counter) % len(healthy)].engine
+
+    def _ensure_thread(self):
+        # started on first use and again in forked workers, threads don't survive a fork
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name='replica-checks', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                logger.exception("replica health check failed")
+            time.sleep(self.interval)
+
+    def _observe(self, primary, now):
+        for table, row in primary.items():
+            seen = self.seen.setdefault(table, [])
+            if not seen or seen[-1][0] < row.version:
+                seen.append((row.version, row.updated_at or now))
+            # past max_lag only the newest entry matters, a replica missing it is out anyway
+            expired = [index for index, (_, at) in enumerate(seen) if (now - at).total_seconds() > self.max_lag]
+            if len(expired) > 1:
+                del seen[:expired[-1]]
+
+    def _missing_since(self, table, version):
+        """When the primary got the first version of `table` after `version`, None if there is none"""
+        for seen_version, at in self.seen.get(table, ()):
+            if seen_version > version:
+                return at
+        return None
+
+    def check(self, now=None):
+        # models imports this module
+        from models import db, TableVersion
+        statement = select(TableVersion.table_name, TableVersion.version, TableVersion.updated_at)
+        with self.app.app_context():
+            with db.engine.connect() as connection:
+                primary = {row.table_name: row for row in connection.execute(statement)}
+        now = now or datetime.utcnow()
+        self._observe(primary, now)
+        for replica in self.replicas:
+            was_healthy = replica.healthy if replica.checked_at else True
+            try:
+                with replica.engine.connect() as connection:
+                    versions = dict(connection.execute(select(TableVersion.table_name, TableVersion.version)).all())
+            except Exception as error:
+                replica.healthy, replica.lag_seconds, replica.error = False, None, str(error)
+            else:
+                # age of the oldest write the replica is known to be missing
+                missing = [self._missing_since(table, versions.get(table, 0)) for table in primary]
+                missing = [at for at in missing if at is not None]
+                replica.lag_seconds = round(max(0.0, (now - min(missing)).total_seconds()), 3) if missing else 0.0
+                replica.healthy = replica.lag_seconds <= self.max_lag
+                replica.error = None if replica.healthy else "lagging"
+            replica.checked_at = now
+            if was_healthy and not replica.healthy:
+                logger.warning("replica %s out of rotation: %s", replica.engine.url.render_as_string(hide_password=True), replica.error)
+            elif replica.healthy and not was_healthy:
+                logger.warning("replica %s back in rotation", replica.engine.url.render_as_string(hide_password=True))
+
+    def status(self):
+        return [replica.status() for replica in self.replicas]
+
+router = None
+
+def read_from_primary():
+    """Sends the remaining statements of the current request to the primary"""
+    if has_app_context():
+        g.pop('db_replica', None)
+
+def sticky_seconds():
+    """How long a writer reads from the primary, 0 without replicas"""
+    return router.sticky_seconds if router is not None else 0
+
+def mark_written():
+    """The client of the current request gets the primary cookie, as if it committed a write"""
+    if has_request_context():
+        request.environ['replicas.wrote'] = True
+
+def served_by_replica():
+    return has_app_context() and g.get('db_replica_used', False)
+
+def cache_ttl(ttl):
+    """
+    TTL for a cached response. One read from a replica may predate a write
+    that already invalidated the cache, so it is kept REPLICA_MAX_LAG_SECONDS at most.
+    """
+    if router is None or not served_by_replica():
+        return ttl
+    return min(ttl, router.max_lag) if ttl else router.max_lag
+
+def replicas_status():
+    return router.status() if router is not None else []
+
+def _route_request():
+    if request.method not in ('GET', 'HEAD') or request.headers.get('X-Read-Primary') == '1':
+        return
+    try:
+        sticky = float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        sticky = False
+    if not sticky:
+        g.db_replica = router.pick()
+
+def _note_commit(writes):
+    # request.environ is shared by the app contexts pushed while handling the request
+    mark_written()
+
+def _stick_to_primary(response):
+    if request.environ.get('replicas.wrote'):
+        response.set_cookie(STICKY_COOKIE, str(int(time.time() + router.sticky_seconds)),
+                            max_age=router.sticky_seconds, httponly=True, samesite='Lax')
+    return response
+
+def setup_replicas(app):
+    global router
+    urls = [url.strip().replace("postgres://", "postgresql://") for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    if not urls:
+        return None
+    router = ReplicaRouter(
+        app,
+        urls,
+        max_lag=float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 5)),
+        interval=float(os.environ.get('REPLICA_CHECK_SECONDS', 2)),
+        sticky_seconds=int(os.environ.get('REPLICA_STICKY_SECONDS', 10)),
+    )
+    app.extensions['replicas'] = router
+    app.before_request(_route_request)
+    app.after_request(_stick_to_primary)
+    tracking.commit_listeners.append(_note_commit)
+    return router
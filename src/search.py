@@ -0,0 +1,130 @@
+"""
+Ranked prefix / fuzzy search over planets, characters and vehicles.
+Uses the FTS5 index on SQLite and trigram indexes on Postgres, both created
+by migration d41e7a9c05b2 and kept up to date by the database itself.
+"""
+import re
+from sqlalchemy import text, bindparam, select, func, literal, cast, null, String, union_all
+from models import db, Planet, Character, Vehicle_Starship
+
+# kind number stored in the SQLite FTS rowid (id * 4 + kind)
+KINDS = ('planet', 'character', 'vehicle_starship')
+SEARCH_INDEX_TABLES = ('search_index', 'search_index_config', 'search_index_content', 'search_index_data', 'search_index_docsize', 'search_index_idx')
+
+# (kind, table, column indexed as `extra`) and the Postgres trigram indexes, as created by the migration
+SEARCH_SOURCES = (('planet', 'planet', None), ('character', 'character', 'species'), ('vehicle_starship', 'vehicle_starship', None))
+TRIGRAM_INDEXES = ('ix_planet_name_trgm', 'ix_character_name_trgm', 'ix_character_species_trgm', 'ix_vehicle_starship_name_trgm')
+
+SQLITE_SEARCH = """
+SELECT rowid % 4 AS kind, rowid / 4 AS id, name, extra, -bm25(search_index, 10.0, 2.0) AS score
+FROM search_index
+WHERE search_index MATCH :match {kind_filter}
+ORDER BY bm25(search_index, 10.0, 2.0), rowid
+LIMIT :limit OFFSET :offset
+"""
+
+POSTGRES_SEARCH = """
+SELECT kind, id, name, extra, score FROM (
+    SELECT 'planet' AS kind, id, name, NULL AS extra,
+           similarity(name, :q) + CASE WHEN name ILIKE :prefix THEN 1 ELSE 0 END AS score
+    FROM planet WHERE name % :q OR name ILIKE :prefix
+    UNION ALL
+    SELECT 'character', id, name, species,
+           GREATEST(similarity(name, :q), similarity(species, :q) * 0.5)
+           + CASE WHEN name ILIKE :prefix THEN 1 WHEN species ILIKE :prefix THEN 0.5 ELSE 0 END
+    FROM "character" WHERE name % :q OR species % :q OR name ILIKE :prefix OR species ILIKE :prefix
+    UNION ALL
+    SELECT 'vehicle_starship', id, name, NULL,
+           similarity(name, :q) + CASE WHEN name ILIKE :prefix THEN 1 ELSE 0 END
+    FROM vehicle_starship WHERE name % :q OR name ILIKE :prefix
+) AS matches
+WHERE kind IN :kinds
+ORDER BY score DESC, kind, id
+LIMIT :limit OFFSET :offset
+"""
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Keeps autogenerated migrations from dropping the FTS tables, which have no model"""
+    return not (type_ == 'table' and name in SEARCH_INDEX_TABLES)
+
+def _fts_query(q):
+    # every word must match as a prefix, quoted so FTS operators in the input are literal
+    terms = re.findall(r'\w+', q)
+    return ' '.join('"{}"*'.format(term) for term in terms)
+
+def _like_prefix(q):
+    # backslash is the default LIKE escape character on Postgres
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def _has_fts_index(session):
+    return session.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'")).first() is not None
+
+def _fallback_statement(q, kinds, limit, offset):
+    """Databases without a search index only get prefix matches on the name"""
+    prefix = re.sub(r'[%_\\]', '', q) + '%'
+    selects = {
+        'planet': select(literal('planet').label('kind'), Planet.id, Planet.name, cast(null(), String).label('extra')).where(Planet.name.like(prefix)),
+        'character': select(literal('character'), Character.id, Character.name, Character.species).where(Character.name.like(prefix)),
+        'vehicle_starship': select(literal('vehicle_starship'), Vehicle_Starship.id, Vehicle_Starship.name, cast(null(), String)).where(Vehicle_Starship.name.like(prefix)),
+    }
+    matches = union_all(*[selects[kind] for kind in kinds]).subquery()
+    return select(matches, literal(1.0).label('score')).order_by(matches.c.name, matches.c.kind, matches.c.id).limit(limit + 1).offset(offset)
+
+def search(q, kinds, limit, offset=0):
+    """Returns (results, next_offset) with the best matches first"""
+    session = db.session
+    dialect = session.get_bind().dialect.name
+    params = {'limit': limit + 1, 'offset': offset}
+
+    if dialect == 'sqlite' and _has_fts_index(session):
+        match = _fts_query(q)
+        if not match:
+            return [], None
+        kind_numbers = [KINDS.index(kind) for kind in kinds]
+        kind_filter = "AND rowid % 4 IN ({})".format(", ".join(str(number) for number in kind_numbers))
+        rows = session.execute(text(SQLITE_SEARCH.format(kind_filter=kind_filter)), dict(params, match=match)).all()
+        rows = [(KINDS[row.kind], row.id, row.name, row.extra, row.score) for row in rows]
+    elif dialect == 'postgresql':
+        statement = text(POSTGRES_SEARCH).bindparams(bindparam('kinds', expanding=True))
+        rows = session.execute(statement, dict(params, q=q, prefix=_like_prefix(q), kinds=list(kinds))).all()
+    else:
+        rows = session.execute(_fallback_statement(q, kinds, limit, offset)).all()
+
+    results = []
+    for kind, row_id, name, extra, score in rows[:limit]:
+        result = {"type": kind, "id": row_id, "name": name, "score": round(float(score), 4)}
+        if kind == 'character':
+            result["species"] = extra
+        results.append(result)
+    next_offset = offset + limit if len(rows) > limit else None
+    return results, next_offset
+
+def rebuild_search_index(progress=None):
+    """
+    Rebuilds the search index from the tables, for an index that drifted
+    (rows written with the triggers disabled, a restored backup...).
+    `progress(done, total)` is called after each table. Returns the rows indexed.
+    """
+    session = db.session
+    dialect = session.get_bind().dialect.name
+    indexed = 0
+    if dialect == 'sqlite' and _has_fts_index(session):
+        session.execute(text("DELETE FROM search_index"))
+        for done, (kind, table, extra) in enumerate(SEARCH_SOURCES, 1):
+            result = session.execute(text(
+                'INSERT INTO search_index (rowid, name, extra) SELECT id * 4 + {}, name, {} FROM "{}"'.format(KINDS.index(kind), extra or 'NULL', table)
+            ))
+            indexed += result.rowcount
+            if progress is not None:
+                progress(done, len(SEARCH_SOURCES))
+        session.commit()
+        session.execute(text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+        session.commit()
+    elif dialect == 'postgresql':
+        for done, index in enumerate(TRIGRAM_INDEXES, 1):
+            session.execute(text("REINDEX INDEX {}".format(index)))
+            session.commit()
+            if progress is not None:
+                progress(done, len(TRIGRAM_INDEXES))
+        indexed = sum(session.execute(select(func.count()).select_from(model)).scalar() for model in (Planet, Character, Vehicle_Starship))
+    return indexed
@@ -0,0 +1,68 @@
+"""
+Fast JSON encoding and column based serialization for the collection endpoints.
+Rows are selected as plain tuples of the needed columns (no ORM objects are
+built) and encoded with orjson when it is installed.
+"""
+import json
+import time
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+from utils import APIException
+from metrics import record_timing
+
+try:
+    import orjson
+except ImportError:  # the stdlib encoder is used instead
+    orjson = None
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes with orjson when available"""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return encode(obj, self.default).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        start = time.perf_counter()
+        if orjson is None:
+            response = super().response(*args, **kwargs)
+        else:
+            obj = self._prepare_response_obj(args, kwargs)
+            response = self._app.response_class(encode(obj, self.default), mimetype=self.mimetype)
+        record_timing('serialize', time.perf_counter() - start)
+        return response
+
+def encode(obj, default=None):
+    """Encodes to JSON bytes"""
+    if orjson is None:
+        return json.dumps(obj, default=default or DefaultJSONProvider.default).encode()
+    return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+def parse_fields(model, requested):
+    """
+    Columns requested with ?fields=id,name (sparse fieldset), all the
+    serialized fields of the model by default. The id is always included,
+    the keyset pagination needs it.
+    """
+    if not requested:
+        return model.serialize_fields
+    fields = [field.strip() for field in requested.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in model.serialize_fields]
+    if unknown:
+        raise APIException("unknown fields: {}".format(", ".join(unknown)), status_code=400)
+    return tuple(dict.fromkeys(['id'] + fields))
+
+def get_fields(model):
+    return parse_fields(model, request.args.get('fields'))
+
+def columns(model, fields):
+    return [getattr(model, field) for field in fields]
+
+def rows_to_dicts(fields, rows):
+    return [dict(zip(fields, row)) for row in rows]
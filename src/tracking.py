@@ -0,0 +1,44 @@
+"""
+Keeps track of the rows written in each database transaction so the read side
+(response cache, ...) can react to them without every handler having to know about it
+"""
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+# fn(session, table, pk, op), called inside the transaction right after the write
+write_listeners = []
+# fn(writes), called once the transaction is committed. `writes` is a set of (table, pk)
+commit_listeners = []
+
+def record_write(session, table, pk=None, op='update'):
+    """
+    Registers a write to `table`. `pk` is the id of the affected row, or None
+    when one statement touched many rows (bulk inserts, imports, ...). `op` is
+    insert, update, delete, bulk, or count when only favorite_count changed.
+    ORM writes are recorded automatically on flush, code that writes with
+    core insert/update/delete statements must call this itself.
+    """
+    session.info.setdefault('writes', set()).add((table, pk))
+    for listener in write_listeners:
+        listener(session, table, pk, op)
+
+@event.listens_for(Session, 'after_flush')
+def _record_flushed_objects(session, flush_context):
+    # new/dirty/deleted still hold the pre-flush state here
+    for op, objects in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objects:
+            if op == 'update' and not session.is_modified(obj, include_collections=False):
+                continue
+            pk = inspect(obj).mapper.primary_key_from_instance(obj)
+            record_write(session, obj.__tablename__, pk[0] if len(pk) == 1 else None, op)
+
+@event.listens_for(Session, 'after_commit')
+def _notify_commit(session):
+    writes = session.info.pop('writes', None)
+    if writes:
+        for listener in commit_listeners:
+            listener(writes)
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_writes(session):
+    session.info.pop('writes', None)
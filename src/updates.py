@@ -0,0 +1,182 @@
+"""
+Optimistic concurrency for the PUT / PATCH endpoints.
+
+Users, planets and characters have a version column, bumped by every update
+(the ORM does it for its own writes, version_id_col). An update is one
+`UPDATE ... SET ..., version = version + 1 WHERE id = ? [AND version = ?]`,
+no SELECT first. The new version comes from RETURNING (PostgreSQL) or the
+If-Match version; only SQLite updates without If-Match read it back.
+
+    If-Match: "<version>"     the update only applies to that version, else 412.
+                              The ETag of the detail GET works as is, only the
+                              part before its dot is compared.
+    no If-Match               last write wins, unless UPDATES_REQUIRE_IF_MATCH
+                              is set (then 428)
+
+Only the columns in the body are written, each value must have the type of
+its column (400 otherwise). PUT takes a JSON object and, as
+before, ignores unknown keys. PATCH takes a JSON object too (a merge patch,
+unknown keys are a 400) or, as application/json-patch+json, a JSON Patch
+whose replace / add / remove operations set columns and whose test
+operations become conditions of the UPDATE (409 when one fails).
+
+favorite_count changes are not updates of the row and keep its version.
+"""
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError, DataError
+from flask import request, jsonify
+from models import db
+from utils import APIException
+from pool import env_bool
+from versioning import detail_etag
+import tracking
+
+REQUIRE_IF_MATCH = env_bool('UPDATES_REQUIRE_IF_MATCH', False)
+JSON_PATCH = 'application/json-patch+json'
+PATCH_OPS = ('add', 'replace', 'remove', 'test')
+TYPE_NAMES = {int: 'an integer', float: 'a number', str: 'a string', bool: 'true or false'}
+# the range of Integer columns, 32 bits on PostgreSQL and MySQL
+MIN_INTEGER, MAX_INTEGER = -2 ** 31, 2 ** 31 - 1
+
+def if_match_versions():
+    """
+    The versions accepted by the If-Match header, None without one (or with *).
+    A tag that is not a version matches nothing.
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    versions = set()
+    for tag in if_match.as_set():
+        version = tag.split('.', 1)[0]
+        if version.isdigit():
+            versions.add(int(version))
+    return versions
+
+def _check_value(model, field, value):
+    """A 400 unless `value` fits the column, the database would refuse it or fail with a 500"""
+    column = model.__table__.c[field]
+    if value is None:
+        if not column.nullable:
+            raise APIException("{} can't be null".format(field), status_code=400)
+        return
+    python_type = column.type.python_type
+    if isinstance(value, bool) and python_type is not bool:
+        valid = False
+    elif python_type is int:
+        valid = isinstance(value, int) and MIN_INTEGER <= value <= MAX_INTEGER
+    elif python_type is float:
+        valid = isinstance(value, (int, float))
+    else:
+        valid = isinstance(value, python_type)
+    if not valid:
+        raise APIException("{} must be {}".format(field, TYPE_NAMES.get(python_type, python_type.__name__)), status_code=400)
+    length = getattr(column.type, 'length', None)
+    if length and len(value) > length:
+        raise APIException("{} is longer than {} characters".format(field, length), status_code=400)
+
+def _json_patch_values(fields, operations):
+    """(values, tests) of a JSON Patch, every path is a top-level /field"""
+    if not isinstance(operations, list):
+        raise APIException("a JSON Patch is a list of operations", status_code=400)
+    values, tests = {}, {}
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('op') not in PATCH_OPS:
+            raise APIException("unsupported JSON Patch operation, supported: {}".format(", ".join(PATCH_OPS)), status_code=400)
+        field = str(operation.get('path', '')).lstrip('/')
+        if field not in fields:
+            raise APIException("unknown path {}, patchable: {}".format(operation.get('path'), ", ".join('/' + name for name in fields)), status_code=400)
+        if operation['op'] != 'remove' and 'value' not in operation:
+            raise APIException("{} of {} needs a value".format(operation['op'], operation['path']), status_code=400)
+        if operation['op'] == 'test':
+            tests[field] = operation['value']
+        else:
+            values[field] = operation.get('value') if operation['op'] != 'remove' else None
+    return values, tests
+
+def update_args(model, fields):
+    """
+    (values, tests) of the current PUT or PATCH request, limited to `fields`.
+    `tests` are {column: expected value} conditions, only JSON Patch has them.
+    """
+    if REQUIRE_IF_MATCH and not request.if_match:
+        raise APIException("If-Match is required, send the ETag of the row", status_code=428)
+    data = request.get_json(force=True, silent=True)
+    if request.method == 'PATCH' and request.mimetype == JSON_PATCH:
+        values, tests = _json_patch_values(fields, data)
+    elif not isinstance(data, dict):
+        raise APIException("the body must be a JSON object", status_code=400)
+    else:
+        unknown = [key for key in data if key not in fields]
+        if request.method == 'PATCH' and unknown:
+            raise APIException("unknown fields: {}, patchable: {}".format(", ".join(unknown), ", ".join(fields)), status_code=400)
+        values, tests = {key: value for key, value in data.items() if key in fields}, {}
+    for field, value in list(values.items()) + list(tests.items()):
+        if field in model.__table__.c:
+            _check_value(model, field, value)
+    return values, tests
+
+def conditional_update(model, row_id, values, tests=None):
+    """
+    Writes `values` to the row in one UPDATE, if it still has an If-Match
+    version and matches `tests`. Returns the new version, None when there is
+    no such row; a failed condition raises a 412 (If-Match) or 409 (tests).
+    """
+    table = model.__table__
+    versions = if_match_versions()
+    conditions = [table.c.id == row_id]
+    if versions is not None:
+        conditions.append(table.c.version.in_(versions))
+    conditions += [table.c[field].is_(None) if value is None else table.c[field] == value for field, value in (tests or {}).items()]
+
+    version = None
+    if values:
+        statement = update(table).where(*conditions).values(dict(values, version=table.c.version + 1))
+        returning = db.session.get_bind().dialect.full_returning
+        if returning:
+            statement = statement.returning(table.c.version)
+        try:
+            result = db.session.execute(statement)
+        except IntegrityError:
+            db.session.rollback()
+            raise APIException("the update conflicts with another row (duplicate value?)", status_code=409)
+        except DataError:
+            db.session.rollback()
+            raise APIException("a value doesn't fit its column", status_code=400)
+        if returning:
+            version = result.scalar()
+            applied = version is not None
+        else:
+            applied = result.rowcount == 1
+    else:
+        applied = db.session.execute(select(table.c.id).where(*conditions)).first() is not None
+    if applied:
+        if values:
+            tracking.record_write(db.session, table.name, row_id, 'update')
+        if version is None:
+            # with a single If-Match version the new one is known, else it is read in the same transaction
+            if values and versions is not None and len(versions) == 1:
+                version = next(iter(versions)) + 1
+            else:
+                version = db.session.execute(select(table.c.version).where(table.c.id == row_id)).scalar()
+        db.session.commit()
+        return version
+
+    # why it failed, only read on this path
+    db.session.rollback()
+    current = db.session.execute(select(table.c.version).where(table.c.id == row_id)).scalar()
+    if current is None:
+        return None
+    if versions is not None and current not in versions:
+        etag, _ = detail_etag(table.name, row_id)
+        raise APIException("the row was modified, its version is now {}".format(current), status_code=412,
+                           headers={'ETag': '"{}"'.format(etag)})
+    raise APIException("a JSON Patch test failed", status_code=409)
+
+def updated_response(message, table, row_id, version):
+    """
+    Response of an update, with the new version as body field and the ETag
+    the detail GET now has (usable in the next If-Match and If-None-Match)
+    """
+    etag, _ = detail_etag(table, row_id)
+    return jsonify({"message": message, "version": version}), 200, {'ETag': '"{}"'.format(etag)}
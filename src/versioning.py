@@ -0,0 +1,160 @@
+"""
+Per-table version counters and conditional GET (ETag / Last-Modified) support
+"""
+import hashlib
+from datetime import datetime
+from functools import wraps
+from flask import current_app, request, make_response, g
+from sqlalchemy import event, select, insert, update, literal
+from sqlalchemy.orm import Session
+from models import db, TableVersion
+import tracking
+from formats import format_variant
+from includes import included_tables
+
+# tables served by conditional GET endpoints, the rest are not versioned
+VERSIONED_TABLES = {'user', 'planet', 'character', 'vehicle_starship', 'vehicle_pilots'}
+# favorite_count is versioned on its own, a favorite add or remove leaves the rest of the row alone
+COUNTED_TABLES = {'planet', 'character', 'vehicle_starship'}
+
+def counts_table(table):
+    """Name under which the favorite_count version of `table` is stored"""
+    return table + ':favorite_count'
+
+def bump_version(session, table, pk=None, op='update'):
+    """Write listener, bumps the table version (or its counts version) once per transaction"""
+    if table not in VERSIONED_TABLES:
+        return
+    if op == 'count':
+        table = counts_table(table)
+    bumped = session.info.setdefault('bumped_tables', set())
+    if table in bumped:
+        return
+    bumped.add(table)
+    now = datetime.utcnow()
+    connection = session.connection()
+    result = connection.execute(
+        update(TableVersion.__table__)
+        .where(TableVersion.table_name == table)
+        .values(version=TableVersion.version + 1, updated_at=now)
+    )
+    if result.rowcount == 0:
+        connection.execute(insert(TableVersion.__table__).values(table_name=table, version=1, updated_at=now))
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _reset_bumped_tables(session):
+    session.info.pop('bumped_tables', None)
+
+tracking.write_listeners.append(bump_version)
+
+def table_version_statement(table):
+    return select(TableVersion.version, TableVersion.updated_at).where(TableVersion.table_name == table)
+
+def table_version(table):
+    row = db.session.execute(table_version_statement(table)).first()
+    return (row.version, row.updated_at) if row else (0, None)
+
+def table_versions_statement(tables):
+    return select(TableVersion.table_name, TableVersion.version, TableVersion.updated_at).where(TableVersion.table_name.in_(tables))
+
+def read_table_versions(rows, tables):
+    """[(version, updated_at)] of `tables` from the result of table_versions_statement"""
+    found = {row.table_name: (row.version, row.updated_at) for row in rows}
+    return [found.get(table, (0, None)) for table in tables]
+
+def table_versions(tables):
+    """table_version of several tables in one query"""
+    return read_table_versions(db.session.execute(table_versions_statement(tables)).all(), tables)
+
+def row_versions_statement(table, row_id, tables):
+    """The version column of one row of `table` and the versions of `tables`, in one query"""
+    rows = db.metadata.tables[table]
+    row_version = select(rows.c.version).where(rows.c.id == row_id).scalar_subquery()
+    # one result row even when no table has a version yet
+    one = select(literal(1).label('one')).subquery()
+    return select(row_version.label('row_version'), TableVersion.table_name, TableVersion.version, TableVersion.updated_at) \
+        .select_from(one).outerjoin(TableVersion, TableVersion.table_name.in_(tables))
+
+def read_row_versions(rows, tables):
+    """(row version, table versions) from the result of row_versions_statement"""
+    found = {row.table_name: (row.version, row.updated_at) for row in rows if row.table_name is not None}
+    return rows[0].row_version, [found.get(table, (0, None)) for table in tables]
+
+def compute_etag(table, version, full_path):
+    return hashlib.sha1("{}:{}:{}".format(table, version, full_path).encode()).hexdigest()
+
+def row_etag(row_version, etag):
+    """
+    ETag of a detail endpoint: the row version, then the usual hash. If-Match
+    only needs the part before the dot, see updates.if_match_versions.
+    """
+    return "{}.{}".format(row_version or 0, etag)
+
+def depends_on(table, detail):
+    """The versions a GET of `table` is built from: the table, the included ones and their counts"""
+    fields = request.args.get('fields')
+    # a detail returns every field, a list only the requested ones
+    counted = detail or not fields or 'favorite_count' in [field.strip() for field in fields.split(',')]
+    tables = [table] + ([counts_table(table)] if counted and table in COUNTED_TABLES else [])
+    for related in included_tables(table):
+        tables += [related] + ([counts_table(related)] if related in COUNTED_TABLES else [])
+    return tuple(tables)
+
+def resource_etag(tables, versions, full_path, detail=False, row_version=None):
+    """(ETag, Last-Modified) of a GET built from `tables` at `versions`"""
+    version = '.'.join(str(number) for number, _ in versions)
+    updated_at = max((updated for _, updated in versions if updated is not None), default=None)
+    etag = compute_etag('+'.join(tables), version, format_variant(full_path))
+    if detail:
+        etag = row_etag(row_version, etag)
+    if updated_at is not None:
+        # HTTP dates have a one second resolution
+        updated_at = updated_at.replace(microsecond=0)
+    return etag, updated_at
+
+def detail_etag(table, row_id):
+    """(ETag, Last-Modified) of the detail GET of a row at the current request's URL, one query"""
+    tables = depends_on(table, True)
+    rows = db.session.execute(row_versions_statement(table, row_id, tables)).all()
+    row_version, versions = read_row_versions(rows, tables)
+    return resource_etag(tables, versions, request.full_path, True, row_version)
+
+def conditional(table, id_arg=None):
+    """
+    Adds a strong ETag and Last-Modified to a GET endpoint, derived from the
+    version of `table` (and of the tables embedded with ?include=) and the
+    requested URL. When the client already has the current version it gets a
+    304 and the view (and its queries) never runs. Detail endpoints name the
+    view argument holding the row id in `id_arg`, their ETag starts with the
+    row version, for If-Match on updates.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if id_arg is not None:
+                etag, updated_at = detail_etag(table, kwargs[id_arg])
+            else:
+                tables = depends_on(table, False)
+                versions = table_versions(tables) if len(tables) > 1 else [table_version(table)]
+                etag, updated_at = resource_etag(tables, versions, request.full_path)
+            # the key of the response in the cache, see cache.cached
+            g.resource_etag = etag
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = updated_at is not None and request.if_modified_since is not None \
+                    and updated_at <= request.if_modified_since.replace(tzinfo=None)
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if updated_at is not None:
+                response.last_modified = updated_at
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,80 @@
+"""
+The app runs against throwaway SQLite files: a primary built with the
+project's migrations, and a second file standing in for a read replica.
+
+    $ python -m pytest tests
+"""
+import os
+import sys
+import sqlite3
+import tempfile
+import pytest
+
+DIRECTORY = tempfile.mkdtemp(prefix='api-tests-')
+PRIMARY = os.path.join(DIRECTORY, 'primary.db')
+REPLICA = os.path.join(DIRECTORY, 'replica.db')
+
+# read when the app module is imported
+os.environ['DATABASE_URL'] = 'sqlite:///' + PRIMARY
+os.environ['DATABASE_REPLICA_URLS'] = 'sqlite:///' + REPLICA
+os.environ['REPLICA_MAX_LAG_SECONDS'] = '5'
+os.environ['JOBS_DIR'] = os.path.join(DIRECTORY, 'jobs')
+os.environ['CACHE_BACKEND'] = 'memory'
+# the background favorites flush never runs on its own, tests flush explicitly
+os.environ['FAVORITES_FLUSH_MS'] = str(3600 * 1000)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from flask_migrate import upgrade
+from sqlalchemy import delete
+from app import app as flask_app
+from models import db, Planet, User
+from cache import MemoryBackend
+import replicas
+
+@pytest.fixture(scope='session')
+def app():
+    with flask_app.app_context():
+        upgrade(directory=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations'))
+    # the tests run the replica checks themselves
+    replicas.router._ensure_thread = lambda: None
+    return flask_app
+
+@pytest.fixture(autouse=True)
+def clean(app):
+    yield
+    with app.app_context():
+        db.session.remove()
+        for table in reversed(db.metadata.sorted_tables):
+            if table.name != 'alembic_version':
+                db.session.execute(delete(table))
+        db.session.commit()
+    app.extensions['response_cache'].backend = MemoryBackend()
+    queue = app.extensions['favorite_writes']
+    queue.pending, queue.size, queue.sticky = {}, 0, {}
+    for replica in replicas.router.replicas:
+        replica.healthy, replica.checked_at = False, None
+    replicas.router.seen = {}
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def copy_to_replica():
+    """The replica catches up: it gets a copy of the primary"""
+    source, target = sqlite3.connect(PRIMARY), sqlite3.connect(REPLICA)
+    with target:
+        source.backup(target)
+    source.close()
+    target.close()
+
+def add_planet(client, name, **fields):
+    response = client.post('/planet', json=dict({"name": name, "climate": "arid", "population": 1}, **fields))
+    assert response.status_code == 201, response.get_data()
+    with client.application.app_context():
+        return Planet.query.filter_by(name=name).one().id
+
+def add_user(client, name):
+    response = client.post('/user', json={"name": name, "email": name + "@example.com", "password": "x", "is_active": True})
+    assert response.status_code == 201, response.get_data()
+    with client.application.app_context():
+        return User.query.filter_by(name=name).one().id
@@ -0,0 +1,70 @@
+import threading
+import pytest
+from flask import Flask, jsonify
+from utils import APIException
+from admission import setup_admission, long_lived
+
+@pytest.fixture
+def limited(monkeypatch):
+    """A bare app behind the admission checks, configured from the environment of the test"""
+    def build(**env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        app = Flask(__name__)
+        release = threading.Event()
+
+        @app.errorhandler(APIException)
+        def handle(error):
+            return jsonify(error.to_dict()), error.status_code, error.headers
+
+        @app.route('/fast')
+        def fast():
+            return jsonify("ok")
+
+        @app.route('/slow')
+        def slow():
+            release.wait(5)
+            return jsonify("ok")
+
+        @app.route('/poll')
+        @long_lived
+        def poll():
+            return jsonify("ok")
+
+        setup_admission(app)
+        app.release = release
+        return app
+    return build
+
+def test_an_empty_bucket_is_a_429(limited):
+    client = limited(RATE_LIMIT_BACKEND='memory', RATE_LIMIT_RATE='0.01', RATE_LIMIT_BURST='2').test_client()
+    responses = [client.get('/fast') for _ in range(3)]
+    assert [response.status_code for response in responses] == [200, 200, 429]
+    assert responses[0].headers['X-RateLimit-Remaining'] == '1'
+    assert int(responses[2].headers['Retry-After']) >= 1
+    # another client has its own bucket
+    assert client.get('/fast', environ_base={'REMOTE_ADDR': '10.0.0.2'}).status_code == 200
+
+def test_an_api_key_gets_its_own_rate(limited):
+    client = limited(RATE_LIMIT_BACKEND='memory', RATE_LIMIT_RATE='0.01', RATE_LIMIT_BURST='1', RATE_LIMIT_API_KEYS='partner=0.01/3').test_client()
+    assert [client.get('/fast', headers={'X-API-Key': 'partner'}).status_code for _ in range(4)] == [200, 200, 200, 429]
+    assert [client.get('/fast', headers={'X-API-Key': 'made-up'}).status_code for _ in range(2)] == [200, 429]
+
+def test_requests_past_the_concurrency_limit_get_a_503(limited):
+    app = limited(MAX_CONCURRENT_REQUESTS='1', ADMISSION_QUEUE_SIZE='0')
+    busy = threading.Thread(target=lambda: app.test_client().get('/slow'))
+    busy.start()
+    try:
+        client = app.test_client()
+        for _ in range(100):
+            response = client.get('/fast')
+            if response.status_code == 503:
+                break
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        # a long poll takes no slot
+        assert client.get('/poll').status_code == 200
+    finally:
+        app.release.set()
+        busy.join()
+    assert app.test_client().get('/fast').status_code == 200
@@ -0,0 +1,51 @@
+import asyncio
+import pytest
+from conftest import add_planet
+
+@pytest.fixture
+def asgi(app):
+    import asgi
+    return asgi
+
+def get(asgi, path, query=b'', headers=()):
+    """(status, headers, body) of a GET through the ASGI application"""
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query,
+             'headers': [(b'host', b'localhost')] + list(headers), 'client': ('127.0.0.1', 1)}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        try:
+            await asgi.application(scope, receive, send)
+        finally:
+            await asgi.engine.dispose()
+
+    asyncio.run(run())
+    start, body = messages[0], b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], {name.decode(): value.decode() for name, value in start['headers']}, body
+
+def test_only_real_query_keys_fall_back_to_flask(asgi):
+    assert asgi.match_route({'type': 'http', 'method': 'GET', 'path': '/planets', 'query_string': b'xinclude=1', 'headers': []})[0] is not None
+    assert asgi.match_route({'type': 'http', 'method': 'GET', 'path': '/planets', 'query_string': b'include=', 'headers': []})[0] is None
+    assert asgi.match_route({'type': 'http', 'method': 'GET', 'path': '/planets', 'query_string': b'stream=true', 'headers': []})[0] is None
+
+def test_query_args_read_like_flask(asgi):
+    args = asgi.Request({'method': 'GET', 'path': '/planets', 'query_string': b'name=&climate=arid&climate=frozen', 'headers': []}, b'').args
+    assert args.get('name') == ''
+    assert args.getlist('climate') == ['arid', 'frozen']
+
+def test_native_routes_answer_like_flask(client, asgi):
+    planet_id = add_planet(client, "Tatooine")
+    flask_response = client.get('/planets?climate=arid')
+    status, headers, body = get(asgi, '/planets', b'climate=arid')
+    assert status == 200
+    assert headers['etag'] == flask_response.headers['ETag']
+    assert b'Tatooine' in body
+
+    status, headers, body = get(asgi, '/planet/{}'.format(planet_id), headers=[(b'if-none-match', client.get('/planet/{}'.format(planet_id)).headers['ETag'].encode())])
+    assert status == 304
@@ -0,0 +1,44 @@
+from models import Planet, Vehicle_Starship, Character
+from conftest import add_planet
+
+def bulk(client, path, items):
+    response = client.post(path, json=items)
+    assert response.status_code == 200, response.get_data()
+    return response.json
+
+def test_created_rows_report_their_ids(client, app):
+    tatooine = add_planet(client, "Tatooine")
+    result = bulk(client, '/characters/bulk', [
+        {"name": "Luke", "homeworld_id": tatooine}, {"species": "droid"}, {"name": "R2-D2", "species": "droid"}])
+    assert (result['created'], result['error']) == (2, 1)
+    assert result['results'][1] == {"index": 1, "status": "error", "error": "missing required fields: name"}
+    with app.app_context():
+        assert [result['results'][index]['id'] for index in (0, 2)] == [
+            Character.query.filter_by(name=name).one().id for name in ("Luke", "R2-D2")]
+
+def test_a_missing_homeworld_is_an_item_error(client, app):
+    result = bulk(client, '/characters/bulk', [{"name": "Luke", "homeworld_id": 999}, {"name": "Leia", "homeworld_id": "x"}])
+    assert [item['error'] for item in result['results']] == ["homeworld_id 999 does not exist", "homeworld_id must be an integer"]
+    with app.app_context():
+        assert Character.query.count() == 0
+
+def test_a_duplicate_name_is_an_item_error(client, app):
+    bulk(client, '/vehicles_starships/bulk', [{"name": "X-wing"}])
+    result = bulk(client, '/vehicles_starships/bulk', [{"name": "X-wing"}, {"name": "Y-wing"}, {"name": "Y-wing"}])
+    assert [item['status'] for item in result['results']] == ["error", "created", "error"]
+    with app.app_context():
+        assert sorted(vehicle.name for vehicle in Vehicle_Starship.query.all()) == ["X-wing", "Y-wing"]
+
+def test_upsert_updates_by_the_unique_name(client):
+    created = bulk(client, '/vehicles_starships/bulk', [{"name": "X-wing"}])['results'][0]['id']
+    result = bulk(client, '/vehicles_starships/bulk?upsert=true', [{"name": "X-wing"}, {"name": "TIE"}])
+    assert [(item['status'], item['id'] == created) for item in result['results']] == [("updated", True), ("created", False)]
+
+def test_upsert_needs_a_unique_key(client):
+    assert client.post('/planets/bulk?upsert=true', json=[{"name": "Tatooine"}]).status_code == 400
+
+def test_ids_stay_right_across_statements(client, app):
+    result = bulk(client, '/planets/bulk', [{"name": "Planet {}".format(index), "population": index} for index in range(700)])
+    with app.app_context():
+        names = {planet.id: planet.name for planet in Planet.query.all()}
+    assert all(names[item['id']] == "Planet {}".format(item['index']) for item in result['results'])
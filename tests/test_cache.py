@@ -0,0 +1,33 @@
+import sqlite3
+from conftest import PRIMARY, add_planet
+
+def test_a_write_invalidates_the_cached_responses(client):
+    planet_id = add_planet(client, "Tatooine")
+    path = '/planet/{}'.format(planet_id)
+    assert client.get(path).headers['X-Cache'] == 'MISS'
+    assert client.get(path).headers['X-Cache'] == 'HIT'
+    assert client.get('/planets').headers['X-Cache'] == 'MISS'
+    assert client.get('/planets').headers['X-Cache'] == 'HIT'
+
+    assert client.put(path, json={"climate": "frozen"}).status_code == 200
+    response = client.get(path)
+    assert response.headers['X-Cache'] == 'MISS'
+    assert response.json['planet']['climate'] == "frozen"
+    response = client.get('/planets')
+    assert response.headers['X-Cache'] == 'MISS'
+    assert response.json['result'][0]['climate'] == "frozen"
+
+def test_a_write_of_another_worker_is_seen(client):
+    planet_id = add_planet(client, "Tatooine")
+    path = '/planet/{}'.format(planet_id)
+    client.get(path)
+    client.get('/planets')
+
+    # what another process writing the row commits, this one's cache never hears of it
+    with sqlite3.connect(PRIMARY) as connection:
+        connection.execute("UPDATE planet SET climate = 'frozen', version = version + 1 WHERE id = ?", (planet_id,))
+        connection.execute("UPDATE table_version SET version = version + 1 WHERE table_name = 'planet'")
+    response = client.get(path)
+    assert response.headers['X-Cache'] == 'MISS'
+    assert response.json['planet']['climate'] == "frozen"
+    assert client.get('/planets').json['result'][0]['climate'] == "frozen"
@@ -0,0 +1,52 @@
+import json
+import pytest
+from sqlalchemy import delete
+from models import db, Planet, User
+from conftest import add_planet, add_user
+
+TOKEN = {'X-Internal-Token': 'secret'}
+
+@pytest.fixture
+def token(monkeypatch):
+    monkeypatch.setenv('INTERNAL_STATS_TOKEN', 'secret')
+
+def test_the_data_routes_are_closed_without_a_token(client, monkeypatch):
+    monkeypatch.delenv('INTERNAL_STATS_TOKEN', raising=False)
+    assert client.get('/export').status_code == 403
+    assert client.post('/import?import_id=x', data='').status_code == 403
+    assert client.post('/jobs', json={"type": "prune_changes"}).status_code == 403
+    assert client.get('/jobs').status_code == 403
+    assert client.get('/jobs/1').status_code == 403
+    assert client.delete('/jobs/1').status_code == 403
+    assert client.get('/jobs/1/result').status_code == 403
+    # the stats stay open
+    assert client.get('/metrics').status_code == 200
+
+def test_a_wrong_token_is_refused(client, token):
+    assert client.get('/export', headers={'X-Internal-Token': 'guess'}).status_code == 403
+    assert client.get('/export', headers=TOKEN).status_code == 200
+
+def test_an_export_imports_back(app, client, token):
+    planet_id = add_planet(client, "Hoth", climate="frozen")
+    user_id = add_user(client, "leia")
+    body = client.get('/export?tables=user,planet', headers=TOKEN).get_data(as_text=True)
+    records = [json.loads(line) for line in body.splitlines()]
+    assert {record['table'] for record in records} == {'user', 'planet'}
+    assert all('password' not in record['row'] for record in records)
+
+    with app.app_context():
+        for model in (User, Planet):
+            db.session.execute(delete(model))
+        db.session.commit()
+    response = client.post('/import?import_id=round-trip', data=body, headers=TOKEN, content_type='application/x-ndjson')
+    assert response.status_code == 200, response.get_data()
+    assert response.json['imported'] == 2
+    with app.app_context():
+        assert db.session.get(Planet, planet_id).climate == "frozen"
+        # no hash over HTTP: the user comes back disabled
+        assert not db.session.get(User, user_id).is_active
+
+def test_an_import_needs_password_hashes(client, token):
+    line = json.dumps({"table": "user", "row": {"id": 1, "name": "x", "email": "x@example.com", "password": "x", "is_active": True}})
+    response = client.post('/import?import_id=plain', data=line + "\n", headers=TOKEN, content_type='application/x-ndjson')
+    assert response.status_code == 400
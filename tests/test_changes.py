@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from sqlalchemy import update
+from models import db, ChangeLog
+import changes
+from changes import settled, prune_changes, GAP_SECONDS
+from conftest import add_planet
+
+def entry(seq, age=0):
+    return SimpleNamespace(seq=seq, changed_at=datetime.utcnow() - timedelta(seconds=age))
+
+def age_entries(app, days):
+    with app.app_context():
+        db.session.execute(update(ChangeLog.__table__).values(changed_at=datetime.utcnow() - timedelta(days=days)))
+        db.session.commit()
+
+def changed_seqs(client, since):
+    response = client.get('/changes?since={}'.format(since))
+    assert response.status_code == 200, response.get_data()
+    return [change['seq'] for change in response.json['result']]
+
+def test_changes_since_a_seq(client):
+    planet_id = add_planet(client, "Tatooine")
+    since = client.get('/changes').json['next']
+    client.put('/planet/{}'.format(planet_id), json={"climate": "frozen"})
+    hoth = add_planet(client, "Hoth")
+
+    response = client.get('/changes?since={}'.format(since)).json
+    assert [(change['seq'], change['table'], change['id'], change['op']) for change in response['result']] == [
+        (since + 1, 'planet', planet_id, 'update'), (since + 2, 'planet', hoth, 'insert')]
+    assert response['result'][0]['row']['climate'] == "frozen"
+    assert response['next'] == since + 2
+    assert changed_seqs(client, since + 2) == []
+
+def test_a_young_gap_holds_back_the_entries_after_it():
+    assert [e.seq for e in settled([entry(4), entry(6), entry(7)], 3)] == [4]
+    assert [e.seq for e in settled([entry(5)], 3)] == []
+    # an old gap is a rolled back transaction
+    old = GAP_SECONDS + 1
+    assert [e.seq for e in settled([entry(4, old), entry(6, old), entry(7)], 3)] == [4, 6, 7]
+
+def test_asking_from_before_the_pruned_entries_is_gone(client, app):
+    add_planet(client, "Tatooine")
+    first = client.get('/changes').json['next']
+    add_planet(client, "Hoth")
+    age_entries(app, 40)
+    add_planet(client, "Endor")
+    with app.app_context():
+        assert prune_changes(30) == 2
+
+    assert client.get('/changes?since={}'.format(first - 1)).status_code == 410
+    assert changed_seqs(client, first + 1) == [first + 2]
+
+def test_pruning_keeps_the_seq_to_sync_from(client, app):
+    add_planet(client, "Tatooine")
+    add_planet(client, "Hoth")
+    age_entries(app, 40)
+    with app.app_context():
+        assert prune_changes(30) == 1
+    since = client.get('/changes').json['next']
+
+    add_planet(client, "Endor")
+    assert changed_seqs(client, since) == [since + 1]
+
+def test_waiters_past_the_cap_get_a_503(client, monkeypatch):
+    monkeypatch.setattr(changes.waiters, 'limit', 1)
+    add_planet(client, "Tatooine")
+    since = client.get('/changes').json['next']
+    assert client.get('/changes?since={}&wait=0.01'.format(since)).status_code == 200
+    # the slot was given back
+    assert changes.waiters.count == 0
+
+    changes.waiters.enter()
+    try:
+        response = client.get('/changes?since={}&wait=1'.format(since))
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == str(changes.RETRY_AFTER_SECONDS)
+        assert client.get('/changes', headers={'Accept': 'text/event-stream'}).status_code == 503
+        # nothing to wait for: a poll with a change or without wait is answered
+        assert client.get('/changes?since={}'.format(since)).status_code == 200
+        add_planet(client, "Hoth")
+        assert changed_seqs(client, since) == [since + 1]
+        assert client.get('/changes?since={}&wait=1'.format(since)).status_code == 200
+    finally:
+        changes.waiters.leave()
+
+def test_an_event_stream_gives_its_slot_back_when_closed(client, monkeypatch):
+    monkeypatch.setattr(changes.waiters, 'limit', 1)
+    response = client.get('/changes', headers={'Accept': 'text/event-stream'})
+    assert response.status_code == 200
+    assert changes.waiters.count == 1
+    response.close()
+    assert changes.waiters.count == 0
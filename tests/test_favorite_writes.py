@@ -0,0 +1,105 @@
+import sqlite3
+import pytest
+from flask import Flask
+from sqlalchemy import event
+import favorite_writes
+from models import db, Planet, FavoritePlanet
+from conftest import PRIMARY, add_planet, add_user
+
+@pytest.fixture
+def queue(app):
+    return app.extensions['favorite_writes']
+
+def favorite(client, op, user_id, planet_id):
+    path = '/user/{}/favorites/planet/{}'.format(user_id, planet_id)
+    response = client.post(path) if op == 'add' else client.delete(path)
+    assert response.status_code == 202
+    return response
+
+def favorite_planets(client, user_id):
+    response = client.get('/user/favorites', json={"user_id": user_id})
+    return [item['planet']['id'] for item in response.json['results']['planets']]
+
+def favorite_count(app, planet_id):
+    with app.app_context():
+        return Planet.query.get(planet_id).favorite_count
+
+def test_operations_on_the_same_target_are_coalesced(client, app, queue):
+    luke = add_user(client, "luke")
+    tatooine, hoth = add_planet(client, "Tatooine"), add_planet(client, "Hoth")
+    favorite(client, 'add', luke, tatooine)
+    favorite(client, 'remove', luke, tatooine)
+    favorite(client, 'add', luke, hoth)
+    favorite(client, 'add', luke, hoth)
+    assert queue.pending == {luke: {('planet', tatooine): 'remove', ('planet', hoth): 'add'}}
+    assert queue.size == 2
+
+    queue.flush()
+    assert queue.pending == {} and queue.size == 0
+    with app.app_context():
+        assert [row.planet_id for row in FavoritePlanet.query.all()] == [hoth]
+    assert favorite_count(app, tatooine) == 0
+    assert favorite_count(app, hoth) == 1
+
+def test_counts_change_by_the_rows_really_written(client, app, queue):
+    luke, leia = add_user(client, "luke"), add_user(client, "leia")
+    tatooine = add_planet(client, "Tatooine")
+    favorite(client, 'add', luke, tatooine)
+    queue.flush()
+    # a second add of an existing favorite and a remove of a missing one change nothing
+    favorite(client, 'add', luke, tatooine)
+    favorite(client, 'add', leia, tatooine)
+    favorite(client, 'remove', leia, add_planet(client, "Hoth"))
+    queue.flush()
+    assert favorite_count(app, tatooine) == 2
+
+    favorite(client, 'remove', luke, tatooine)
+    queue.flush()
+    assert favorite_count(app, tatooine) == 1
+
+def test_a_read_flushes_the_reading_user_first(client, queue):
+    luke, leia = add_user(client, "luke"), add_user(client, "leia")
+    tatooine = add_planet(client, "Tatooine")
+    favorite(client, 'add', luke, tatooine)
+    favorite(client, 'add', leia, tatooine)
+    assert favorite_planets(client, luke) == [tatooine]
+    # the other users keep their operations queued, in order
+    assert queue.pending == {leia: {('planet', tatooine): 'add'}}
+
+    favorite(client, 'remove', luke, tatooine)
+    favorite(client, 'add', luke, tatooine)
+    favorite(client, 'remove', luke, tatooine)
+    assert favorite_planets(client, luke) == []
+
+def test_a_row_another_worker_wrote_meanwhile_is_counted_once(client, app, queue):
+    luke = add_user(client, "luke")
+    tatooine = add_planet(client, "Tatooine")
+    favorite(client, 'add', luke, tatooine)
+
+    def other_worker(connection, cursor, statement, parameters, context, executemany):
+        # the same favorite, committed by another process between our read and our insert
+        if statement.startswith('INSERT OR IGNORE INTO ' + FavoritePlanet.__tablename__):
+            other = sqlite3.connect(PRIMARY)
+            with other:
+                other.execute("INSERT INTO {} (user_id, planet_id) VALUES (?, ?)".format(FavoritePlanet.__tablename__), (luke, tatooine))
+                other.execute("UPDATE planet SET favorite_count = favorite_count + 1 WHERE id = ?", (tatooine,))
+            other.close()
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', other_worker)
+    try:
+        queue.flush()
+    finally:
+        event.remove(engine, 'before_cursor_execute', other_worker)
+    assert favorite_count(app, tatooine) == 1
+
+def test_several_workers_write_immediately_by_default(monkeypatch):
+    monkeypatch.setattr(favorite_writes, 'queue', favorite_writes.queue)
+    monkeypatch.delenv('FAVORITES_DURABILITY', raising=False)
+    monkeypatch.setenv('WEB_CONCURRENCY', '4')
+    assert favorite_writes.setup_favorite_writes(Flask(__name__)).durability == 'immediate'
+    monkeypatch.setenv('WEB_CONCURRENCY', '1')
+    assert favorite_writes.setup_favorite_writes(Flask(__name__)).durability == 'batched'
+    monkeypatch.setenv('WEB_CONCURRENCY', '4')
+    monkeypatch.setenv('FAVORITES_DURABILITY', 'batched')
+    assert favorite_writes.setup_favorite_writes(Flask(__name__)).durability == 'batched'
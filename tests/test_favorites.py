@@ -0,0 +1,42 @@
+from models import Character
+from conftest import add_planet, add_user
+
+def add_favorite(client, user_id, kind, target_id):
+    assert client.post('/user/{}/favorites/{}/{}'.format(user_id, kind, target_id)).status_code in (200, 202)
+
+def favorites_of(client, user_ids, **args):
+    response = client.post('/users/favorites', json={"user_ids": user_ids}, query_string=args)
+    assert response.status_code == 200, response.get_data()
+    return response.json
+
+def test_the_items_carry_the_target_fields(client, app):
+    luke = add_user(client, "luke")
+    tatooine = add_planet(client, "Tatooine", population=200000)
+    client.post('/character', json={"name": "Luke", "species": "human", "gender": "male", "homeworld_id": tatooine})
+    with app.app_context():
+        character_id = Character.query.filter_by(name="Luke").one().id
+    add_favorite(client, luke, 'planet', tatooine)
+    add_favorite(client, luke, 'character', character_id)
+
+    results = favorites_of(client, [luke])['results'][str(luke)]
+    assert results['planets'][0]['planet'] == {
+        "id": tatooine, "name": "Tatooine", "climate": "arid", "population": 200000, "favorite_count": 1}
+    assert results['characters'][0]['character'] == {
+        "id": character_id, "name": "Luke", "species": "human", "gender": "male", "homeworld_id": tatooine, "favorite_count": 1}
+
+def test_every_user_gets_a_page_of_their_own(client):
+    luke, leia = add_user(client, "luke"), add_user(client, "leia")
+    planets = [add_planet(client, "Planet {}".format(index)) for index in range(3)]
+    for planet_id in planets:
+        add_favorite(client, luke, 'planet', planet_id)
+    add_favorite(client, leia, 'planet', planets[0])
+
+    page = favorites_of(client, [luke, leia], limit=2)
+    assert [item['planet']['id'] for item in page['results'][str(luke)]['planets']] == planets[:2]
+    assert [item['planet']['id'] for item in page['results'][str(leia)]['planets']] == planets[:1]
+    assert page['next_offset'] == 2
+
+    page = favorites_of(client, [luke, leia], limit=2, offset=2)
+    assert [item['planet']['id'] for item in page['results'][str(luke)]['planets']] == planets[2:]
+    assert page['results'][str(leia)]['planets'] == []
+    assert page['next_offset'] is None
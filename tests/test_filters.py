@@ -0,0 +1,44 @@
+import json
+import base64
+from conftest import add_planet
+
+def listing(client, query):
+    response = client.get('/planets?' + query)
+    assert response.status_code == 200, response.get_data()
+    return response.json
+
+def names(client, query):
+    return [planet['name'] for planet in listing(client, query)['result']]
+
+def cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def test_filters_and_sort_run_in_sql(client):
+    add_planet(client, "Tatooine", population=200000)
+    add_planet(client, "Hoth", climate="frozen", population=0)
+    add_planet(client, "Naboo", climate="temperate", population=4500000000)
+    assert names(client, 'population__gte=1e5&sort=-population') == ["Naboo", "Tatooine"]
+    assert names(client, 'climate__in=frozen,temperate&sort=name') == ["Hoth", "Naboo"]
+    assert names(client, 'climate__ne=arid&population__lt=1') == ["Hoth"]
+
+def test_rows_without_a_value_come_last_on_every_page(client):
+    add_planet(client, "Tatooine", population=200000)
+    add_planet(client, "Unknown", population=None)
+    add_planet(client, "Hoth", population=0)
+    add_planet(client, "Uncharted", population=None)
+    # the id breaks the ties, in the direction of the sort
+    expected = {'population': ["Hoth", "Tatooine", "Unknown", "Uncharted"],
+                '-population': ["Tatooine", "Hoth", "Uncharted", "Unknown"]}
+    for sort, order in expected.items():
+        seen, after = [], ''
+        while after is not None:
+            page = listing(client, 'sort={}&limit=1&after={}'.format(sort, after))
+            seen += [planet['name'] for planet in page['result']]
+            after = page['next']
+        assert seen == order
+
+def test_invalid_values_are_refused(client):
+    for query in ('population=1e400', 'population=inf', 'population=99999999999999999999', 'population=x', 'sort=climate',
+                  'sort=population&after=' + cursor([{"a": 1}, 1]), 'sort=population&after=' + cursor(["1", 1]),
+                  'sort=population&after=' + cursor([1, None]), 'after=x'):
+        assert client.get('/planets?' + query).status_code == 400, query
@@ -0,0 +1,42 @@
+import json
+import msgpack
+import pyarrow.ipc
+from conftest import add_planet
+
+def test_json_is_the_default(client):
+    add_planet(client, "Hoth")
+    response = client.get('/planets')
+    assert response.mimetype == 'application/json'
+    assert 'Accept' in response.headers['Vary']
+
+def test_msgpack_has_the_json_shape(client):
+    planet_id = add_planet(client, "Hoth")
+    for accept in ('application/msgpack', 'application/x-msgpack'):
+        response = client.get('/planets', headers={'Accept': accept})
+        assert response.mimetype == 'application/msgpack'
+        assert msgpack.unpackb(response.get_data(), raw=False) == client.get('/planets').json
+    response = client.get('/planet/{}'.format(planet_id), headers={'Accept': 'application/msgpack'})
+    assert msgpack.unpackb(response.get_data(), raw=False) == client.get('/planet/{}'.format(planet_id)).json
+
+def test_arrow_has_a_column_per_field(client):
+    hoth = add_planet(client, "Hoth", population=10)
+    add_planet(client, "Tatooine", population=20)
+    response = client.get('/planets?fields=name,population&limit=1', headers={'Accept': 'application/vnd.apache.arrow.stream'})
+    assert response.mimetype == 'application/vnd.apache.arrow.stream'
+    table = pyarrow.ipc.open_stream(response.get_data()).read_all()
+    assert table.to_pydict() == {'id': [hoth], 'name': ["Hoth"], 'population': [10]}
+    assert json.loads(table.schema.metadata[b'next']) == client.get('/planets?fields=name,population&limit=1').json['next']
+
+def test_formats_not_offered_are_refused(client):
+    planet_id = add_planet(client, "Hoth")
+    assert client.get('/planets', headers={'Accept': 'text/csv'}).status_code == 406
+    # Arrow is for collections only
+    assert client.get('/planet/{}'.format(planet_id), headers={'Accept': 'application/vnd.apache.arrow.stream'}).status_code == 406
+    assert client.get('/planets?include=residents', headers={'Accept': 'application/vnd.apache.arrow.stream'}).status_code == 406
+
+def test_a_stream_is_a_json_array(client):
+    add_planet(client, "Hoth")
+    add_planet(client, "Tatooine")
+    response = client.get('/planets?stream=true', headers={'Accept': 'application/msgpack'})
+    assert response.mimetype == 'application/json'
+    assert [planet['name'] for planet in json.loads(response.get_data())['result']] == ["Hoth", "Tatooine"]
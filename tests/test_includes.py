@@ -0,0 +1,51 @@
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from sqlalchemy import text
+from models import db, Character
+from search import include_object
+from conftest import add_planet
+
+def add_character(client, name, **fields):
+    response = client.post('/character', json=dict({"name": name, "species": "human"}, **fields))
+    assert response.status_code == 201, response.get_data()
+    with client.application.app_context():
+        return Character.query.filter_by(name=name).one().id
+
+def test_related_rows_are_embedded(client):
+    tatooine = add_planet(client, "Tatooine")
+    luke = add_character(client, "Luke", homeworld_id=tatooine)
+    add_character(client, "Leia")
+    response = client.post('/vehicles_starships/bulk', json=[{"name": "X-wing"}])
+    x_wing = response.json['results'][0]['id']
+    assert client.post('/vehicle_starship/{}/pilots/{}'.format(x_wing, luke)).status_code == 200
+
+    characters = client.get('/characters?include=homeworld,vehicles').json['result']
+    assert [(c['name'], c['homeworld'] and c['homeworld']['name'], [v['name'] for v in c['vehicles']]) for c in characters] == [
+        ("Luke", "Tatooine", ["X-wing"]), ("Leia", None, [])]
+    planets = client.get('/planets?include=residents').json['result']
+    assert [resident['name'] for resident in planets[0]['residents']] == ["Luke"]
+    vehicles = client.get('/vehicles_starships?include=pilots').json['result']
+    assert [pilot['name'] for pilot in vehicles[0]['pilots']] == ["Luke"]
+    assert client.get('/character/{}?include=homeworld'.format(luke)).json['character']['homeworld']['id'] == tatooine
+
+def test_unknown_includes_are_refused(client):
+    assert client.get('/planets?include=homeworld').status_code == 400
+
+def test_a_deleted_planet_leaves_its_residents_homeless(client):
+    tatooine = add_planet(client, "Tatooine")
+    luke = add_character(client, "Luke", homeworld_id=tatooine)
+    path = '/character/{}'.format(luke)
+    assert client.get(path).json['character']['homeworld_id'] == tatooine
+    assert client.delete('/planet/{}'.format(tatooine)).status_code == 200
+    # the cached character follows
+    assert client.get(path).json['character']['homeworld_id'] is None
+
+def test_the_schema_matches_the_models(app):
+    with app.app_context():
+        connection = db.session.connection()
+        context = MigrationContext.configure(connection, opts={'include_object': include_object})
+        foreign_keys = [diff for diff in compare_metadata(context, db.metadata) if diff[0] in ('add_fk', 'remove_fk')]
+        triggers = db.session.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'character'")).scalars().all()
+    assert foreign_keys == []
+    # rebuilding the table for the foreign key kept the search index triggers
+    assert sorted(triggers) == ['character_search_delete', 'character_search_insert', 'character_search_update']
@@ -0,0 +1,72 @@
+import subprocess
+import sys
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import update
+from models import db, Job
+from jobs import Worker, enqueue, release_stale_jobs, worker_name, STALE_SECONDS
+
+@pytest.fixture
+def context(app):
+    with app.app_context():
+        yield
+
+def make_stale(job_id, worker):
+    db.session.execute(update(Job.__table__).where(Job.__table__.c.id == job_id).values(
+        worker=worker, heartbeat_at=datetime.utcnow() - timedelta(seconds=STALE_SECONDS + 1)))
+    db.session.commit()
+
+def status(job_id):
+    db.session.expire_all()
+    return db.session.get(Job, job_id).status
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+def test_a_type_runs_no_more_jobs_than_its_concurrency(context):
+    first, second = enqueue('reindex_search').id, enqueue('reindex_search').id
+    prune = enqueue('prune_changes').id
+    one, two = Worker('host:1', ['reindex_search']), Worker('host:2', ['reindex_search', 'prune_changes'])
+
+    assert one.claim().id == first
+    # reindex_search runs one job at a time, the other types are not held back
+    assert two.claim().id == prune
+    assert two.claim() is None
+    assert status(second) == 'queued'
+
+    one.finish(first, status='succeeded', finished_at=datetime.utcnow())
+    assert two.claim().id == second
+    assert one.claim() is None
+
+def test_a_claimed_job_is_not_claimed_again(context):
+    job_id = enqueue('reindex_search').id
+    assert Worker('host:1', ['reindex_search']).claim().id == job_id
+    db.session.execute(update(Job.__table__).values(status='queued'))
+    assert Worker('host:2', ['reindex_search']).claim().id == job_id
+    job = db.session.get(Job, job_id)
+    assert (job.worker, job.attempts) == ('host:2', 2)
+
+def test_stale_jobs_of_lost_workers_are_queued_again(context):
+    types = ('reindex_search', 'prune_changes', 'reconcile_favorites')
+    jobs = [enqueue(type_name).id for type_name in types]
+    worker = Worker('host:1', types)
+    for _ in types:
+        worker.claim()
+    make_stale(jobs[0], 'elsewhere:1')
+    make_stale(jobs[1], worker_name(dead_pid()))
+    # this process is alive, its job only looks stale (a blocked heartbeat)
+    make_stale(jobs[2], worker_name())
+
+    assert release_stale_jobs() == 2
+    assert [status(job_id) for job_id in jobs] == ['queued', 'queued', 'running']
+
+def test_a_stale_job_out_of_attempts_fails(context):
+    job_id = enqueue('reindex_search').id
+    db.session.execute(update(Job.__table__).values(max_attempts=1))
+    db.session.commit()
+    Worker('host:1', ['reindex_search']).claim()
+    make_stale(job_id, 'elsewhere:1')
+    assert release_stale_jobs() == 1
+    assert status(job_id) == 'failed'
@@ -0,0 +1,44 @@
+from sqlalchemy import update
+from models import db, Planet
+from conftest import add_planet, add_user
+
+def leaderboard(client, **args):
+    response = client.get('/leaderboards/planets', query_string=args)
+    assert response.status_code == 200, response.get_data()
+    return [(row['name'], row['favorite_count']) for row in response.json['result']]
+
+def test_the_most_favorited_come_first(app, client):
+    luke, leia = add_user(client, "luke"), add_user(client, "leia")
+    add_planet(client, "Dagobah")
+    hoth = add_planet(client, "Hoth")
+    tatooine = add_planet(client, "Tatooine")
+    assert leaderboard(client) == []
+
+    for user_id, planet_id in ((luke, hoth), (leia, hoth), (leia, tatooine)):
+        assert client.post('/user/{}/favorites/planet/{}'.format(user_id, planet_id)).status_code == 202
+    app.extensions['favorite_writes'].flush()
+    # the cached leaderboard follows the new counts
+    assert leaderboard(client) == [("Hoth", 2), ("Tatooine", 1)]
+    assert leaderboard(client, limit=1) == [("Hoth", 2)]
+
+    client.delete('/user/{}/favorites/planet/{}'.format(luke, hoth))
+    app.extensions['favorite_writes'].flush()
+    # a tie is broken by id
+    assert leaderboard(client) == [("Hoth", 1), ("Tatooine", 1)]
+
+def test_the_limit_is_checked(client):
+    assert client.get('/leaderboards/planets?limit=x').status_code == 400
+    assert client.get('/leaderboards/planets?limit=0').status_code == 400
+    assert client.get('/leaderboards/planets?limit=100000').status_code == 400
+
+def test_reconcile_fixes_drifted_counts(app, client):
+    luke = add_user(client, "luke")
+    hoth = add_planet(client, "Hoth")
+    client.post('/user/{}/favorites/planet/{}'.format(luke, hoth))
+    app.extensions['favorite_writes'].flush()
+    with app.app_context():
+        db.session.execute(update(Planet).values(favorite_count=7))
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=['favorites', 'reconcile'])
+    assert "planet: 1 corrected" in result.output
+    assert leaderboard(client) == [("Hoth", 1)]
@@ -0,0 +1,27 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from models import db
+from conftest import add_planet
+
+def test_responses_carry_server_timing(client):
+    add_planet(client, "Tatooine")
+    timing = client.get('/planets').headers['Server-Timing']
+    assert timing.startswith('db;dur=')
+    assert 'total;dur=' in timing
+
+def test_a_failed_statement_leaves_no_start_time(app):
+    with app.app_context():
+        connection = db.session.connection()
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM no_such_table"))
+        assert connection.info['query_start'] == []
+        db.session.rollback()
+
+def test_metrics_are_guarded_by_the_internal_token(client, monkeypatch):
+    monkeypatch.setenv('INTERNAL_STATS_TOKEN', 'secret')
+    assert client.get('/metrics').status_code == 403
+    response = client.get('/metrics', headers={'X-Internal-Token': 'secret'})
+    assert response.status_code == 200
+    assert b'api_request_duration_seconds_bucket' in response.data
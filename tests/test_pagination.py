@@ -0,0 +1,24 @@
+from conftest import add_planet
+
+def test_pages_follow_the_cursor(client):
+    ids = [add_planet(client, "Planet {}".format(index)) for index in range(5)]
+    seen, after = [], ''
+    for _ in range(3):
+        page = client.get('/planets?limit=2&after={}'.format(after)).json
+        seen += [planet['id'] for planet in page['result']]
+        after = page['next']
+        if after is None:
+            break
+    assert seen == ids
+    assert after is None
+
+def test_a_stream_returns_the_whole_listing(client):
+    ids = [add_planet(client, "Planet {}".format(index)) for index in range(3)]
+    response = client.get('/planets?stream=true&limit=1')
+    assert response.is_streamed
+    assert [planet['id'] for planet in response.json['result']] == ids
+
+def test_an_invalid_limit_is_refused(client):
+    assert client.get('/planets?limit=0').status_code == 400
+    assert client.get('/planets?limit=x').status_code == 400
+    assert client.get('/planets?after=x').status_code == 400
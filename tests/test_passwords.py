@@ -0,0 +1,62 @@
+import os
+from flask_migrate import upgrade, downgrade
+from sqlalchemy import insert
+from models import db, User
+from passwords import hash_password, is_hashed
+from conftest import add_user
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+def stored_password(app, user_id):
+    with app.app_context():
+        return db.session.get(User, user_id).password
+
+def add_stored(app, email, password):
+    with app.app_context():
+        user_id = db.session.execute(insert(User).values(name=email, email=email, password=password, is_active=True)).inserted_primary_key[0]
+        db.session.commit()
+        return user_id
+
+def login(client, email, password):
+    return client.post('/login', json={"email": email, "password": password}).status_code
+
+def test_passwords_are_stored_hashed(app, client):
+    user_id = add_user(client, "leia")
+    assert is_hashed(stored_password(app, user_id))
+    assert login(client, "leia@example.com", "x") == 200
+    assert login(client, "leia@example.com", "y") == 401
+
+def test_a_legacy_password_is_rehashed_on_login(app, client):
+    user_id = add_stored(app, "han@example.com", "plain$solo")
+    assert login(client, "han@example.com", "plain$solo") == 401
+    assert login(client, "han@example.com", "solo") == 200
+    assert is_hashed(stored_password(app, user_id))
+    assert login(client, "han@example.com", "solo") == 200
+
+def test_a_malformed_hash_verifies_nothing(app, client):
+    add_stored(app, "lando@example.com", "scrypt$calrissian")
+    assert login(client, "lando@example.com", "scrypt$calrissian") == 401
+
+def test_the_migration_marks_what_is_not_a_hash(app):
+    with app.app_context():
+        downgrade(directory=MIGRATIONS, revision='f3b8c5d21e96')
+    hashed = hash_password("x")
+    ids = [add_stored(app, email, password) for email, password in (("a@example.com", "x"), ("b@example.com", "scrypt$x"), ("c@example.com", hashed))]
+    with app.app_context():
+        upgrade(directory=MIGRATIONS)
+    assert [stored_password(app, user_id) for user_id in ids] == ["plain$x", "plain$scrypt$x", hashed]
+
+def test_the_rehash_command_hashes_the_legacy_passwords(app, client):
+    ids = [add_stored(app, "{}@example.com".format(name), "plain$" + name) for name in ("chewie", "r2")]
+    hashed = stored_password(app, add_user(client, "leia"))
+    result = app.test_cli_runner().invoke(args=['passwords', 'rehash', '--batch-size', '1'])
+    assert "2 passwords rehashed" in result.output
+    assert all(is_hashed(stored_password(app, user_id)) for user_id in ids)
+    assert login(client, "r2@example.com", "r2") == 200
+    assert stored_password(app, ids[-1] + 1) == hashed
+
+def test_a_password_must_be_a_string(app, client):
+    response = client.post('/user', json={"name": "x", "email": "x@example.com", "password": 1, "is_active": True})
+    assert response.status_code == 400
+    user_id = add_user(client, "leia")
+    assert client.patch('/user/{}'.format(user_id), json={"password": ["x"]}).status_code == 400
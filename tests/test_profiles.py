@@ -0,0 +1,40 @@
+import os
+import sys
+import json
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# runs in a fresh interpreter, what the app imports at startup is the point
+SCRIPT = """
+import sys, json
+from app import app
+client = app.test_client()
+loaded = lambda: {name: name in sys.modules for name in ('flask_admin', 'flask_swagger')}
+result = {'startup': loaded(), 'api': client.get('/planets').status_code, 'after_api': loaded()}
+result['swagger'] = client.get('/swagger.json').status_code
+result['admin'] = client.get('/admin/').status_code
+result['after_admin'] = loaded()
+print(json.dumps(result))
+"""
+
+def run_profile(profile):
+    env = dict(os.environ, APP_PROFILE=profile)
+    completed = subprocess.run([sys.executable, '-c', SCRIPT], cwd=SRC, env=env, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.splitlines()[-1])
+
+def test_the_full_profile_loads_admin_and_swagger_on_first_use(app):
+    result = run_profile('full')
+    assert result['startup'] == {'flask_admin': False, 'flask_swagger': False}
+    assert result['api'] == 200
+    assert result['after_api'] == {'flask_admin': False, 'flask_swagger': False}
+    assert result['swagger'] == 200
+    assert result['admin'] == 200
+    assert result['after_admin'] == {'flask_admin': True, 'flask_swagger': True}
+
+def test_the_api_profile_serves_the_api_only(app):
+    result = run_profile('api')
+    assert result['api'] == 200
+    assert result['swagger'] == 404
+    assert result['admin'] == 404
+    assert result['after_admin'] == {'flask_admin': False, 'flask_swagger': False}
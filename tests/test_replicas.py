@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+import sqlite3
+import pytest
+import replicas
+from conftest import REPLICA, copy_to_replica, add_planet
+
+@pytest.fixture
+def router(app, monkeypatch):
+    # replica reads would be hidden by cached primary responses
+    monkeypatch.delitem(app.extensions, 'response_cache')
+    return replicas.router
+
+@pytest.fixture
+def writer(app):
+    """A client of its own, the one reading must not get the primary cookie"""
+    return app.test_client()
+
+def planet_names(client, **headers):
+    return [planet['name'] for planet in client.get('/planets', headers=headers).json['result']]
+
+def test_reads_go_to_a_replica_in_sync(client, writer, router):
+    add_planet(writer, "Tatooine")
+    copy_to_replica()
+    router.check()
+    assert router.replicas[0].healthy
+    assert router.replicas[0].lag_seconds == 0
+
+    add_planet(writer, "Hoth")
+    assert planet_names(client) == ["Tatooine"]
+    assert planet_names(client, **{'X-Read-Primary': '1'}) == ["Tatooine", "Hoth"]
+
+def test_no_replica_before_the_first_check(client, writer, router):
+    add_planet(writer, "Tatooine")
+    assert planet_names(client) == ["Tatooine"]
+
+def test_a_writer_reads_from_the_primary(client, writer, router):
+    copy_to_replica()
+    router.check()
+    add_planet(writer, "Tatooine")
+    assert any(cookie.name == replicas.STICKY_COOKIE for cookie in writer.cookie_jar)
+    assert planet_names(writer) == ["Tatooine"]
+    assert planet_names(client) == []
+
+def test_a_lagging_replica_is_evicted_under_steady_writes(client, writer, router):
+    add_planet(writer, "Tatooine")
+    copy_to_replica()
+    start = datetime.utcnow()
+    router.check(now=start)
+
+    add_planet(writer, "Hoth")
+    router.check(now=start + timedelta(seconds=1))
+    replica = router.replicas[0]
+    assert replica.healthy
+    assert planet_names(client) == ["Tatooine"]
+
+    # the primary keeps getting writes, its latest one is always recent
+    for second in range(2, 10):
+        add_planet(writer, "Planet {}".format(second))
+        router.check(now=start + timedelta(seconds=second))
+    assert not replica.healthy
+    assert replica.error == "lagging"
+    assert replica.lag_seconds > router.max_lag
+    assert len(planet_names(client)) == 10
+
+    copy_to_replica()
+    router.check(now=start + timedelta(seconds=10))
+    assert replica.healthy and replica.lag_seconds == 0
+
+def test_a_failing_replica_is_out_of_rotation(router):
+    copy_to_replica()
+    router.check()
+    assert router.replicas[0].healthy
+    with sqlite3.connect(REPLICA) as connection:
+        connection.execute("DROP TABLE table_version")
+    router.check()
+    assert not router.replicas[0].healthy
+    assert router.replicas[0].error
@@ -0,0 +1,38 @@
+from sqlalchemy import text
+from models import db
+from conftest import add_planet
+
+def search(client, q, **args):
+    response = client.get('/search', query_string=dict(args, q=q))
+    assert response.status_code == 200, response.get_data()
+    return [(result['type'], result['name']) for result in response.json['result']]
+
+def test_prefixes_of_every_word_match(client):
+    add_planet(client, "Tatooine")
+    client.post('/character', json={"name": "Luke Skywalker", "species": "human"})
+    client.post('/vehicles_starships/bulk', json=[{"name": "Sand crawler"}])
+    assert search(client, "tato") == [('planet', "Tatooine")]
+    assert search(client, "sky") == [('character', "Luke Skywalker")]
+    assert search(client, "hum") == [('character', "Luke Skywalker")]
+    assert search(client, "sand craw", type='vehicle_starship') == [('vehicle_starship', "Sand crawler")]
+    assert search(client, "sand", type='planet') == []
+
+def test_the_index_follows_the_writes(client):
+    path = '/planet/{}'.format(add_planet(client, "Tatooine"))
+    client.put(path, json={"name": "Hoth"})
+    assert search(client, "tato") == []
+    assert search(client, "hoth") == [('planet', "Hoth")]
+    client.delete(path)
+    assert search(client, "hoth") == []
+
+def test_operators_in_the_query_are_literal(client):
+    add_planet(client, "Tatooine")
+    assert search(client, 'tato" OR "x') == []
+    assert client.get('/search?q=').status_code == 400
+    assert client.get('/search?q=x&type=user').status_code == 400
+
+def test_only_indexed_columns_fire_the_update_triggers(app):
+    with app.app_context():
+        triggers = dict(db.session.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%_search_update'")).all())
+    assert set(triggers) == {'planet_search_update', 'character_search_update', 'vehicle_starship_search_update'}
+    assert 'AFTER UPDATE OF name, species ON character' in triggers['character_search_update']
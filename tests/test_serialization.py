@@ -0,0 +1,16 @@
+from conftest import add_planet
+
+def test_a_sparse_fieldset_keeps_the_id(client):
+    add_planet(client, "Tatooine", population=200000)
+    response = client.get('/planets?fields=name')
+    assert response.mimetype == 'application/json'
+    assert response.json['result'] == [{"id": response.json['result'][0]['id'], "name": "Tatooine"}]
+
+def test_every_serialized_field_by_default(client):
+    planet_id = add_planet(client, "Tatooine", population=200000)
+    assert client.get('/planets').json['result'] == [
+        {"id": planet_id, "name": "Tatooine", "climate": "arid", "population": 200000, "favorite_count": 0}]
+
+def test_unknown_and_hidden_fields_are_refused(client):
+    assert client.get('/planets?fields=name,size').status_code == 400
+    assert client.get('/users?fields=password').status_code == 400
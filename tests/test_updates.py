@@ -0,0 +1,59 @@
+import pytest
+from sqlalchemy import update
+from sqlalchemy.orm.exc import StaleDataError
+from app import handle_stale_data
+from models import db, Planet, Character
+from conftest import add_planet
+
+def test_if_match_applies_to_the_current_version_only(client):
+    path = '/planet/{}'.format(add_planet(client, "Tatooine"))
+    etag = client.get(path).headers['ETag']
+
+    response = client.put(path, json={"climate": "frozen"}, headers={'If-Match': etag})
+    assert response.status_code == 200
+    assert response.json['version'] == 2
+    # the ETag of the GET that follows
+    assert response.headers['ETag'] == client.get(path).headers['ETag']
+    assert client.get(path, headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    response = client.put(path, json={"climate": "temperate"}, headers={'If-Match': etag})
+    assert response.status_code == 412
+    assert response.headers['ETag'] == client.get(path).headers['ETag']
+    assert client.get(path).json['planet']['climate'] == "frozen"
+
+    assert client.put(path, json={"climate": "temperate"}, headers={'If-Match': response.headers['ETag']}).status_code == 200
+
+def test_values_of_the_wrong_type_are_refused(client):
+    path = '/planet/{}'.format(add_planet(client, "Tatooine"))
+    for body in ({"population": "many"}, {"population": True}, {"population": 2 ** 40}, {"name": ["x"]}, {"name": "x" * 251}, {"name": None}):
+        response = client.patch(path, json=body)
+        assert response.status_code == 400, body
+    operations = [{"op": "test", "path": "/population", "value": {"gt": 1}}]
+    assert client.patch(path, json=operations, content_type='application/json-patch+json').status_code == 400
+    assert client.patch(path, json={"population": 3}).status_code == 200
+
+    assert client.post('/character', json={"name": "Luke", "species": "human"}).status_code == 201
+    with client.application.app_context():
+        character_path = '/character/{}'.format(Character.query.filter_by(name="Luke").one().id)
+    assert client.patch(character_path, json={"homeworld_id": "x"}).status_code == 400
+    assert client.patch(character_path, json={"homeworld": {"id": 1}}).status_code == 400
+
+def test_a_failed_json_patch_test_is_a_conflict(client):
+    path = '/planet/{}'.format(add_planet(client, "Tatooine"))
+    operations = [{"op": "test", "path": "/climate", "value": "frozen"}, {"op": "replace", "path": "/population", "value": 2}]
+    response = client.patch(path, json=operations, content_type='application/json-patch+json')
+    assert response.status_code == 409
+    assert client.get(path).json['planet']['population'] == 1
+
+def test_an_orm_write_with_a_stale_version_is_a_conflict(client, app):
+    planet_id = add_planet(client, "Tatooine")
+    with app.test_request_context():
+        planet = db.session.get(Planet, planet_id)
+        # another writer updates the row after it was loaded
+        db.session.execute(update(Planet.__table__).where(Planet.__table__.c.id == planet_id).values(version=Planet.__table__.c.version + 1))
+        db.session.delete(planet)
+        with pytest.raises(StaleDataError) as error:
+            db.session.commit()
+        response, status = handle_stale_data(error.value)
+        assert status == 409
+        assert db.session.get(Planet, planet_id) is not None
@@ -0,0 +1,31 @@
+from conftest import add_planet, add_user
+
+def revalidate(client, path, etag):
+    return client.get(path, headers={'If-None-Match': etag}).status_code
+
+def test_an_unchanged_resource_is_not_modified(client):
+    path = '/planet/{}'.format(add_planet(client, "Tatooine"))
+    for url in (path, '/planets'):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert revalidate(client, url, response.headers['ETag']) == 304
+        assert client.get(url, headers={'If-Modified-Since': response.headers['Last-Modified']}).status_code == 304
+
+def test_a_write_changes_the_etags(client):
+    path = '/planet/{}'.format(add_planet(client, "Tatooine"))
+    detail, listing = client.get(path).headers['ETag'], client.get('/planets').headers['ETag']
+    client.put(path, json={"climate": "frozen"})
+    assert revalidate(client, path, detail) == 200
+    assert revalidate(client, '/planets', listing) == 200
+
+def test_a_favorite_only_changes_what_shows_its_count(client, app):
+    planet_id = add_planet(client, "Tatooine")
+    luke = add_user(client, "luke")
+    paths = ['/planets', '/planets?fields=id,name', '/planet/{}'.format(planet_id), '/leaderboards/planets', '/users']
+    etags = {path: client.get(path).headers['ETag'] for path in paths}
+
+    client.post('/user/{}/favorites/planet/{}'.format(luke, planet_id))
+    app.extensions['favorite_writes'].flush()
+    assert {path: revalidate(client, path, etag) for path, etag in etags.items()} == {
+        '/planets': 200, '/planets?fields=id,name': 304, '/planet/{}'.format(planet_id): 200,
+        '/leaderboards/planets': 200, '/users': 304}